@@ -0,0 +1,58 @@
+# Small-object throughput of FHK_CRD: one call per object vs. the batch calls
+#
+#   python -m benchmarks.bench_fhk_batch -n 1000000 --dir /some/scratch
+#
+# Prints objects/s for each operation both ways, and the speedup.
+
+import argparse
+import os
+import tempfile
+import time
+
+from hkfs import FHK_CRD
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    rv = fn()
+    return time.perf_counter() - t0, rv
+
+def run(hk, datas, batch, chunk):
+    keys = []
+    results = {}
+    def chunks(seq):
+        for i in range(0, len(seq), chunk):
+            yield seq[i:i + chunk]
+    if batch:
+        results['create'], _ = timed(lambda: [keys.extend(hk.create_many(c)) for c in chunks(datas)])
+        results['exists'], _ = timed(lambda: [hk.exists_many(c) for c in chunks(keys)])
+        results['read'], _ = timed(lambda: [hk.read_many(c) for c in chunks(keys)])
+        results['delete'], _ = timed(lambda: [hk.delete_many(c) for c in chunks(keys)])
+    else:
+        results['create'], _ = timed(lambda: [keys.append(hk.create(d)) for d in datas])
+        results['exists'], _ = timed(lambda: [hk.exists(k) for k in keys])
+        results['read'], _ = timed(lambda: [hk.read(k) for k in keys])
+        results['delete'], _ = timed(lambda: [hk.delete(k) for k in keys])
+    return results
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="FHK_CRD small-object throughput, single calls vs batches")
+    ap.add_argument('-n', type=int, default=100000, help="objects (default %(default)s)")
+    ap.add_argument('--size', type=int, default=100, help="bytes per object (default %(default)s)")
+    ap.add_argument('--chunk', type=int, default=10000, help="objects per batch call (default %(default)s)")
+    ap.add_argument('--dir', default=None, help="scratch directory on the filesystem to test")
+    args = ap.parse_args(argv)
+
+    datas = [i.to_bytes(8, 'little') + os.urandom(max(0, args.size - 8)) for i in range(args.n)]
+    print(f"{args.n} objects of {args.size} bytes")
+    by_mode = {}
+    for batch in (False, True):
+        with tempfile.TemporaryDirectory(dir=args.dir) as d:
+            by_mode[batch] = run(FHK_CRD(d), datas, batch, args.chunk)
+    for op in ('create', 'exists', 'read', 'delete'):
+        single, batched = by_mode[False][op], by_mode[True][op]
+        print(f"{op:8} single {args.n / single:10.0f}/s  batch {args.n / batched:10.0f}/s"
+              f"  x{single / batched:.2f}")
+
+if __name__ == '__main__':
+    main()
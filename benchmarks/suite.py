@@ -0,0 +1,191 @@
+# Throughput benchmarks for ingest and store, with JSON results
+#
+#   python -m benchmarks.suite --dir /scratch/on/fs/under/test --out results.json
+#   python -m benchmarks.suite --compare old.json new.json
+#
+# Measures files/s and MB/s for LJ.key_from_file, LJ.assimilate_tree (in
+# walk order, and in each physical order of --orders, with fadvise hints) and
+# FHK_CRD create/read/exists/delete, each with a cold and a warm page cache.
+# Cold is approximated by posix_fadvise(DONTNEED) on every file, after an
+# fsync; --drop-caches (root) drops the whole page cache instead.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from hkfs import FHK_CRD, __version__
+from lj import LJ
+
+from .synth import make_objects, make_tree
+
+
+def evict(root):
+    # Push the files under root out of the page cache, as best we can
+    for dirpath, dirs, files in os.walk(root):
+        for name in files:
+            fd = os.open(os.path.join(dirpath, name), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+def warm(root):
+    for dirpath, dirs, files in os.walk(root):
+        for name in files:
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                while f.read(1 << 20):
+                    pass
+
+def prepare_cache(root, cache, args):
+    if cache == 'warm':
+        warm(root)
+    elif args.drop_caches:
+        drop_caches()
+    else:
+        evict(root)
+
+def result(name, cache, files, nbytes, seconds):
+    return {'name': name, 'cache': cache, 'files': files, 'bytes': nbytes,
+            'seconds': seconds, 'files_per_s': files / seconds,
+            'mb_per_s': nbytes / seconds / 1e6}
+
+def timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+def bench_key_from_file(scratch, args, cache):
+    src = os.path.join(scratch, 'src')
+    files, nbytes = make_tree(src, args.files, args.sizes, args.dup_ratio, args.depth,
+                              args.fanout, args.seed)
+    lj = LJ(os.path.join(scratch, 'pile'))
+    paths = [os.path.join(d, n) for d, _, names in os.walk(src) for n in names]
+    prepare_cache(src, cache, args)
+    def run():
+        for path in paths:
+            with open(path, 'rb') as f:
+                lj.key_from_file(f)
+    return result('LJ.key_from_file', cache, files, nbytes, timed(run))
+
+def bench_assimilate_tree(scratch, args, cache):
+    src = os.path.join(scratch, 'src')
+    pile = os.path.join(scratch, 'pile')
+    os.mkdir(pile)
+    files, nbytes = make_tree(src, args.files, args.sizes, args.dup_ratio, args.depth,
+                              args.fanout, args.seed)
+    lj = LJ(pile, workers=args.workers)
+    prepare_cache(src, cache, args)
+    name = 'LJ.assimilate_tree' + (f' workers={args.workers}' if args.workers > 1 else '')
+    return result(name, cache, files, nbytes, timed(lambda: lj.assimilate_tree(src)))
+
+def bench_assimilate_tree_ordered(scratch, args, cache):
+    # The same tree as bench_assimilate_tree, visited in physical order
+    rv = []
+    for order in args.orders:
+        src = os.path.join(scratch, order, 'src')
+        pile = os.path.join(scratch, order, 'pile')
+        os.makedirs(pile)
+        files, nbytes = make_tree(src, args.files, args.sizes, args.dup_ratio, args.depth,
+                                  args.fanout, args.seed)
+        lj = LJ(pile, workers=args.workers, order=order, fadvise=True)
+        prepare_cache(src, cache, args)
+        rv.append(result(f'LJ.assimilate_tree order={order}', cache, files, nbytes,
+                         timed(lambda: lj.assimilate_tree(src))))
+    return rv
+
+def bench_fhk(scratch, args, cache):
+    store = os.path.join(scratch, 'store')
+    os.mkdir(store)
+    hk = FHK_CRD(store)
+    datas = make_objects(args.objects, args.object_sizes, 0.0, args.seed)
+    n, nbytes = len(datas), sum(len(d) for d in datas)
+    keys = []
+    rv = [result('FHK_CRD.create', cache, n, nbytes,
+                 timed(lambda: keys.extend(hk.create(d) for d in datas)))]
+    prepare_cache(store, cache, args)
+    rv.append(result('FHK_CRD.read', cache, n, nbytes, timed(lambda: [hk.read(k) for k in keys])))
+    prepare_cache(store, cache, args)
+    rv.append(result('FHK_CRD.exists', cache, n, 0, timed(lambda: [hk.exists(k) for k in keys])))
+    rv.append(result('FHK_CRD.delete', cache, n, 0, timed(lambda: [hk.delete(k) for k in keys])))
+    return rv
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(args):
+    results = []
+    for cache in args.cache:
+        for bench in (bench_key_from_file, bench_assimilate_tree,
+                      bench_assimilate_tree_ordered, bench_fhk):
+            scratch = tempfile.mkdtemp(prefix='hkfs-bench-', dir=args.dir)
+            try:
+                rv = bench(scratch, args, cache)
+            finally:
+                shutil.rmtree(scratch)
+            results.extend(rv if isinstance(rv, list) else [rv])
+    params = {k: v for k, v in vars(args).items() if k not in ('out', 'compare')}
+    return {'version': __version__, 'revision': git_revision(), 'python': platform.python_version(),
+            'machine': platform.machine(), 'params': params, 'results': results}
+
+def compare(old_path, new_path):
+    # Print new/old throughput for each benchmark both files have
+    def load(path):
+        with open(path) as f:
+            return {(r['name'], r['cache']): r for r in json.load(f)['results']}
+    old, new = load(old_path), load(new_path)
+    for k in sorted(old.keys() & new.keys()):
+        ratio = new[k]['files_per_s'] / old[k]['files_per_s']
+        print(f"{k[0]:40} {k[1]:5} {old[k]['files_per_s']:12.0f} -> "
+              f"{new[k]['files_per_s']:12.0f} files/s  x{ratio:.2f}")
+
+def print_results(rv):
+    for r in rv['results']:
+        print(f"{r['name']:40} {r['cache']:5} {r['files_per_s']:12.0f} files/s "
+              f"{r['mb_per_s']:10.1f} MB/s")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="hkfs ingest and store benchmarks")
+    ap.add_argument('--dir', default=None, help="scratch directory on the filesystem to test")
+    ap.add_argument('--out', default=None, help="write JSON results here")
+    ap.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files")
+    ap.add_argument('--files', type=int, default=2000, help="files in the source tree")
+    ap.add_argument('--sizes', default='lognormal:9:2', help="file size distribution")
+    ap.add_argument('--dup-ratio', type=float, default=0.2, help="fraction of duplicate files")
+    ap.add_argument('--depth', type=int, default=2)
+    ap.add_argument('--fanout', type=int, default=4)
+    ap.add_argument('--workers', type=int, default=1, help="hashing threads for assimilate_tree")
+    ap.add_argument('--orders', nargs='*', choices=('inode', 'extent'), default=['inode', 'extent'],
+                    help="physical orders to compare with the plain walk")
+    ap.add_argument('--objects', type=int, default=10000, help="objects for FHK_CRD")
+    ap.add_argument('--object-sizes', default='fixed:1000', help="object size distribution")
+    ap.add_argument('--cache', nargs='+', choices=('cold', 'warm'), default=['cold', 'warm'])
+    ap.add_argument('--drop-caches', action='store_true', help="drop the page cache for cold runs (root)")
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    rv = run_suite(args)
+    print_results(rv)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(rv, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Synthetic source trees and objects for benchmarks
+# * File sizes from a distribution: fixed:N, uniform:LO:HI, lognormal:MU:SIGMA
+#   (of ln bytes), or a weighted mix, as "fixed:100@0.9,fixed:1000000@0.1"
+# * A fraction of files repeat the contents of earlier ones
+# * Directories to a given depth and fanout
+# Deterministic for a given seed.
+
+import os
+import random
+
+
+def parse_sizes(spec):
+    # -> function of a random.Random giving a size in bytes
+    choices = []
+    for part in spec.split(','):
+        dist, _, weight = part.partition('@')
+        kind, *args = dist.split(':')
+        args = [float(a) for a in args]
+        if kind == 'fixed':
+            fn = lambda r, n=int(args[0]): n
+        elif kind == 'uniform':
+            fn = lambda r, lo=int(args[0]), hi=int(args[1]): r.randint(lo, hi)
+        elif kind == 'lognormal':
+            fn = lambda r, mu=args[0], sigma=args[1]: int(r.lognormvariate(mu, sigma))
+        else:
+            raise ValueError(f"unknown size distribution: {kind!r}")
+        choices.append((fn, float(weight or 1)))
+    fns, weights = zip(*choices)
+    return lambda r: r.choices(fns, weights)[0](r)
+
+def contents(r, sizes, dup_ratio, previous):
+    # Yield file contents forever; dup_ratio of them repeat earlier ones
+    while True:
+        if previous and r.random() < dup_ratio:
+            yield r.choice(previous)
+        else:
+            data = r.randbytes(sizes(r))
+            previous.append(data)
+            if len(previous) > 1000:
+                previous.pop(r.randrange(len(previous)))
+            yield data
+
+def dir_paths(depth, fanout):
+    # All directory paths (relative) of a tree of this depth and fanout
+    paths = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(p, f"d{i}") for p in level for i in range(fanout)]
+        paths.extend(level)
+    return paths
+
+def make_tree(root, files, sizes='lognormal:9:2', dup_ratio=0.2, depth=2, fanout=4, seed=0):
+    # Make a tree of files under root; returns (files, bytes)
+    r = random.Random(seed)
+    size_fn = parse_sizes(sizes)
+    dirs = dir_paths(depth, fanout)
+    for d in dirs:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    total = 0
+    gen = contents(r, size_fn, dup_ratio, [])
+    for n in range(files):
+        data = next(gen)
+        with open(os.path.join(root, dirs[n % len(dirs)], f"f{n}"), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return files, total
+
+def make_objects(n, sizes='fixed:100', dup_ratio=0.0, seed=0):
+    r = random.Random(seed)
+    gen = contents(r, parse_sizes(sizes), dup_ratio, [])
+    return [next(gen) for _ in range(n)]
@@ -1,3 +1,19 @@
 __version__ = '0.1.0'
 from .main import main
 from .hkv import FHK_CRD
+from .inode_index import InodeIndex
+from .stat_cache import StatCache
+from .dupscan import DupScanner
+from .merkle import MerkleIndex
+from .hashing import FileHasher
+from .dirfd import DirFds
+from .aio import AsyncFHK_CRD, AsyncLJ, DeviceLimiter
+from .verify import Verifier
+from .orphans import find_orphans, sweep_orphans
+from .metrics import Metrics, NULL_METRICS, ProgressSink, StatsSink
+from .journal import Journal, export_since
+from .cache import BlockCache
+from .keyfilter import KeyFilter
+from .compress import recompress
+from .du import du, unique_files
+from .server import PileServer
@@ -0,0 +1,112 @@
+# ## asyncio interface
+# * The blocking work (filesystem calls, hashing) runs on a bounded thread pool
+# * In-flight operations are limited per device, shared by all stores on it
+#   that use the same DeviceLimiter
+# * Cancellation: an operation already handed to a thread runs to its end
+#   (the store's creates are atomic), and a streamed create that is cancelled
+#   discards its temporary; nothing half-written is left under a key
+
+import asyncio
+import functools
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DeviceLimiter():
+    # One semaphore per st_dev. Belongs to one event loop.
+    def __init__(self, max_in_flight=16):
+        self.max_in_flight = max_in_flight
+        self._semaphores = {}
+
+    def for_path(self, path):
+        dev = os.stat(path).st_dev
+        sem = self._semaphores.get(dev)
+        if sem is None:
+            sem = self._semaphores[dev] = asyncio.Semaphore(self.max_in_flight)
+        return sem
+
+
+class _AsyncFacade():
+    def __init__(self, directory, executor, max_workers, limiter):
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.limiter = limiter or DeviceLimiter()
+        self._directory = directory
+        self._sem = None # looked up on first use, inside the event loop
+
+    async def _in_thread(self, fn, *args):
+        # Run fn(*args) on the executor, holding a slot for the device.
+        # If cancelled, the thread is let finish before the cancellation goes on.
+        if self._sem is None:
+            self._sem = self.limiter.for_path(self._directory)
+        async with self._sem:
+            fut = asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(fn, *args))
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                await asyncio.wait([fut])
+                raise
+
+    def close(self):
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+
+
+class AsyncFHK_CRD(_AsyncFacade):
+    def __init__(self, store, executor=None, max_workers=8, limiter=None):
+        super().__init__(store.d, executor, max_workers, limiter)
+        self.store = store
+
+    async def exists(self, key):
+        return await self._in_thread(self.store.exists, key)
+
+    async def create(self, data):
+        return await self._in_thread(self.store.create, data)
+
+    async def create_from_file(self, file):
+        return await self._in_thread(self.store.create_from_file, file)
+
+    async def create_from_aiter(self, chunks):
+        # chunks: an async iterable of bytes, e.g. an upload body
+        w = await self._in_thread(self.store.writer)
+        try:
+            async for chunk in chunks:
+                await self._in_thread(w.write, chunk)
+            return await self._in_thread(w.commit)
+        finally:
+            # Shielded, so a second cancellation can't leave the temporary
+            await asyncio.shield(self._in_thread(w.abort))
+
+    async def read(self, key, offset=0, len=1<<31):
+        return await self._in_thread(self.store.read, key, offset, len)
+
+    async def read_into(self, key, buf, offset=0):
+        return await self._in_thread(self.store.read_into, key, buf, offset)
+
+    async def delete(self, key):
+        return await self._in_thread(self.store.delete, key)
+
+
+class AsyncLJ(_AsyncFacade):
+    def __init__(self, lj, executor=None, max_workers=8, limiter=None):
+        super().__init__(lj.d, executor, max_workers, limiter)
+        self.lj = lj
+
+    def _assimilate_path(self, path):
+        with open(path, 'rb') as f:
+            return self.lj._assimilate(f)
+
+    async def assimilate(self, path):
+        return (await self._in_thread(self._assimilate_path, path))[0]
+
+    async def assimilate_tell_key(self, path):
+        return (await self._in_thread(self._assimilate_path, path))[1]
+
+    async def assimilate_tree(self, dirname):
+        # One thread walks; the LJ's own workers setting still applies
+        return await self._in_thread(self.lj.assimilate_tree, dirname)
+
+    async def exists(self, key):
+        return await self._in_thread(self.lj.exists, key)
@@ -0,0 +1,101 @@
+# ## Read cache for immutable contents
+# * Blocks of block_size bytes, keyed by (key, block number); since contents
+#   never change, a cached block is never stale, only gone with its key
+# * Least recently used blocks go first, to keep under max_bytes
+# * A miss on the block after the last one read from the same key is taken as
+#   sequential access, and readahead more blocks come in the same read
+# * Hits, misses, blocks read ahead and evictions are counted in stats
+
+import threading
+
+from collections import OrderedDict
+
+
+class BlockCache():
+    def __init__(self, max_bytes=64 << 20, block_size=64 << 10, readahead=4):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.readahead = readahead
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'readahead': 0, 'evictions': 0}
+        self._blocks = OrderedDict() # (key, block number) -> bytes
+        self._by_key = {} # key -> its block numbers in _blocks
+        self._last = OrderedDict() # key -> last block number read, for readahead
+        self._lock = threading.Lock()
+
+    def read(self, key, offset, length, fetch):
+        # length bytes of key's contents from offset, or fewer at the end.
+        # fetch(key, offset, length) reads the contents where they're kept.
+        bs = self.block_size
+        end = offset + length
+        parts = []
+        block_no = offset // bs
+        while block_no * bs < end:
+            block = self._block(key, block_no, fetch)
+            start = block_no * bs
+            parts.append(block[max(0, offset - start):end - start])
+            if len(block) < bs:
+                break # the end of the contents
+            block_no += 1
+        return b''.join(parts)
+
+    def _block(self, key, block_no, fetch):
+        with self._lock:
+            block = self._blocks.get((key, block_no))
+            sequential = self._last.get(key) == block_no - 1
+            self._last[key] = block_no
+            self._last.move_to_end(key)
+            if len(self._last) > 1024:
+                self._last.popitem(last=False)
+            if block is not None:
+                self._blocks.move_to_end((key, block_no))
+                self.stats['hits'] += 1
+                return block
+            self.stats['misses'] += 1
+        n = 1 + (self.readahead if sequential else 0)
+        bs = self.block_size
+        data = fetch(key, block_no * bs, n * bs)
+        blocks = [data[i * bs:(i + 1) * bs] for i in range(n)]
+        # nothing past a short block
+        for i, b in enumerate(blocks):
+            if len(b) < bs:
+                del blocks[i + 1:]
+                break
+        with self._lock:
+            for i, b in enumerate(blocks):
+                k = key, block_no + i
+                if k not in self._blocks:
+                    self._blocks[k] = b
+                    self._by_key.setdefault(key, set()).add(k[1])
+                    self.bytes += len(b)
+                    if i:
+                        self.stats['readahead'] += 1
+            self._evict()
+        return blocks[0]
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._blocks:
+            (key, block_no), b = self._blocks.popitem(last=False)
+            numbers = self._by_key[key]
+            numbers.discard(block_no)
+            if not numbers:
+                del self._by_key[key]
+            self.bytes -= len(b)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        # Drop the blocks of key, as when it's deleted
+        with self._lock:
+            for block_no in self._by_key.pop(key, ()):
+                self.bytes -= len(self._blocks.pop((key, block_no)))
+            self._last.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._by_key.clear()
+            self._last.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._blocks)
@@ -0,0 +1,175 @@
+# ## Compressed tier
+# * An object may be kept compressed, as its encoded key plus '.z', in its
+#   usual fan-out directory; its key is still that of the uncompressed contents
+# * Contents are cut into frames of frame_size bytes, each compressed on its
+#   own (zlib or lzma), with an index of frame offsets at the end, so a
+#   range read decompresses only the frames it touches
+# * Layout: header (magic, codec, frame size, contents size), frames, index
+#   (offset, compressed length per frame), footer (index offset, frames, magic)
+# * recompress moves objects not read for a while into the tier; FHK_CRD
+#   reads either form
+# * The compressed form is synced before it's named, and its name before
+#   the plain file is removed, so a crash leaves one or the other whole
+
+import io
+import lzma
+import os
+import struct
+import time
+import zlib
+
+from .durability import fsync_path
+from .pile import scan_pile
+
+
+SUFFIX = '.z'
+ZLIB, LZMA = 1, 2
+CODECS = {'zlib': ZLIB, 'lzma': LZMA}
+
+_MAGIC = b'HKZ1'
+_HEADER = struct.Struct('<4sBIQ')
+_ENTRY = struct.Struct('<QI')
+_FOOTER = struct.Struct('<QI4s')
+
+
+def _compressor(codec, level):
+    if codec == ZLIB:
+        return lambda data: zlib.compress(data, 6 if level is None else level)
+    if codec == LZMA:
+        return lambda data: lzma.compress(data, preset=6 if level is None else level)
+    raise ValueError(f"unknown codec: {codec!r}")
+
+def _decompressor(codec):
+    if codec == ZLIB:
+        return zlib.decompress
+    if codec == LZMA:
+        return lzma.decompress
+    raise ValueError(f"unknown codec: {codec!r}")
+
+def compress_file(src, dst, codec='zlib', frame_size=256 << 10, level=None):
+    # Write the compressed form of the file src to dst, atomically (by way
+    # of a temporary beside it). Returns the size of dst.
+    codec = CODECS.get(codec, codec)
+    compress = _compressor(codec, level)
+    tmp = os.path.join(os.path.dirname(dst), f".tmp-{os.getpid()}-{os.path.basename(dst)}")
+    try:
+        with open(src, 'rb') as f, open(tmp, 'wb') as out:
+            size = os.fstat(f.fileno()).st_size
+            out.write(_HEADER.pack(_MAGIC, codec, frame_size, size))
+            index = []
+            while True:
+                frame = f.read(frame_size)
+                if not frame:
+                    break
+                data = compress(frame)
+                index.append(_ENTRY.pack(out.tell(), len(data)))
+                out.write(data)
+            index_offset = out.tell()
+            out.write(b''.join(index))
+            out.write(_FOOTER.pack(index_offset, len(index), _MAGIC))
+            total = out.tell()
+            # on disk before it has a name, so it's never found torn
+            out.flush()
+            os.fsync(out.fileno())
+        os.chmod(tmp, 0o444)
+        os.rename(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return total
+
+
+class CompressedReader():
+    # Range reads of a compressed object, given an fd open on it (not closed here)
+    def __init__(self, fd):
+        self.fd = fd
+        magic, codec, self.frame_size, self.size = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+        end = os.fstat(fd).st_size
+        index_offset, n_frames, magic2 = _FOOTER.unpack(os.pread(fd, _FOOTER.size, end - _FOOTER.size))
+        if magic != _MAGIC or magic2 != _MAGIC:
+            raise ValueError("not a compressed object")
+        self._decompress = _decompressor(codec)
+        raw = os.pread(fd, n_frames * _ENTRY.size, index_offset)
+        self.index = [_ENTRY.unpack_from(raw, i * _ENTRY.size) for i in range(n_frames)]
+
+    def read(self, offset=0, length=1<<31):
+        end = min(self.size, offset + length)
+        if end <= offset:
+            return b''
+        fs = self.frame_size
+        parts = []
+        for i in range(offset // fs, (end - 1) // fs + 1):
+            frame_offset, clen = self.index[i]
+            frame = self._decompress(os.pread(self.fd, clen, frame_offset))
+            start = i * fs
+            parts.append(frame[max(0, offset - start):end - start])
+        return b''.join(parts)
+
+    def frames(self):
+        # The decompressed frames in order, for reading it all
+        for frame_offset, clen in self.index:
+            yield self._decompress(os.pread(self.fd, clen, frame_offset))
+
+    def stream(self):
+        # A file-like object of the decompressed contents, to read in order
+        return _FrameStream(self.frames())
+
+
+class _FrameStream(io.RawIOBase):
+    def __init__(self, frames):
+        self._frames = frames
+        self._buf = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            frame = next(self._frames, None)
+            if frame is None:
+                return 0
+            self._buf = memoryview(frame)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+def read_compressed(path, offset=0, length=1<<31, dir_fd=None):
+    fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+    try:
+        return CompressedReader(fd).read(offset, length)
+    finally:
+        os.close(fd)
+
+def recompress(pile_directory, min_idle_seconds=30 * 24 * 3600, min_size=4096,
+               codec='zlib', frame_size=256 << 10, level=None, min_saving=0.1):
+    # Move objects not read (by atime) nor written for min_idle_seconds into
+    # the compressed tier. Objects smaller than min_size, or that compress by
+    # less than min_saving, stay as they are. A reader who finds the plain
+    # file gone finds the compressed one, which is in place first. Files
+    # with other links (LJ's pile) are left alone: this is for FHK_CRD.
+    # Returns {'files', 'bytes_in', 'bytes_out', 'skipped'}.
+    cutoff = time.time() - min_idle_seconds
+    report = {'files': 0, 'bytes_in': 0, 'bytes_out': 0, 'skipped': 0}
+    for e in scan_pile(pile_directory):
+        if e.name.endswith(SUFFIX):
+            continue
+        st = e.stat(follow_symlinks=False)
+        if (st.st_nlink != 1 or st.st_size < min_size
+            or max(st.st_atime, st.st_mtime) > cutoff):
+            continue
+        dst = e.path + SUFFIX
+        size = compress_file(e.path, dst, codec, frame_size, level)
+        if size > st.st_size * (1 - min_saving):
+            os.remove(dst)
+            report['skipped'] += 1
+            continue
+        # the compressed name is on disk before the plain one goes
+        fsync_path(os.path.dirname(e.path), directory=True)
+        os.remove(e.path)
+        report['files'] += 1
+        report['bytes_in'] += st.st_size
+        report['bytes_out'] += size
+    return report
@@ -0,0 +1,15 @@
+# ## sqlite connections
+# * WAL mode, so readers and one writer at a time can share a database
+#   across processes
+# * viz. https://rbranson.medium.com/sharing-sqlite-databases-across-containers-is-surprisingly-brilliant-bacb8d753054
+
+import sqlite3
+
+
+def connect(path, timeout=30.0):
+    # isolation_level=None: autocommit, with explicit BEGIN where batching helps
+    conn = sqlite3.connect(str(path), timeout=timeout, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+    return conn
@@ -0,0 +1,86 @@
+# ## Open directories of the hash pile
+# * Keeps fds for the leaf fan-out directories, so operations on a key are
+#   one path component for the kernel to resolve (openat, linkat, fstatat)
+#   instead of the whole path from the root
+# * Bounded: the least recently used idle fds are closed past max_open
+# ** Each fan-out level is two base64 characters, 4096 ways, so there are
+#    far too many leaves to pre-create or keep open all at once
+# * An fd in use is never closed under its user
+
+import os
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class DirFds():
+    def __init__(self, directory, max_open=1024):
+        self.root = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        self.max_open = max_open
+        self._leaves = OrderedDict() # 'abcd' -> [fd, users]
+        self._lock = threading.Lock()
+        self.opened = 0 # leaf directories opened, for the curious
+
+    @contextmanager
+    def leaf(self, encoded_key, create=False):
+        # fd of the leaf directory for encoded_key, or None if that doesn't
+        # exist and create is false
+        fd = self.acquire(encoded_key, create)
+        try:
+            yield fd
+        finally:
+            if fd is not None:
+                self.release(encoded_key)
+
+    def acquire(self, encoded_key, create=False):
+        k = encoded_key[:4]
+        with self._lock:
+            entry = self._leaves.get(k)
+            if entry is not None:
+                self._leaves.move_to_end(k)
+                entry[1] += 1
+                return entry[0]
+            fd = self._open(k, create)
+            if fd is None:
+                return None
+            self._leaves[k] = [fd, 1]
+            self.opened += 1
+            self._evict()
+            return fd
+
+    def release(self, encoded_key):
+        with self._lock:
+            self._leaves[encoded_key[:4]][1] -= 1
+            self._evict()
+
+    def _open(self, k, create):
+        rel = os.path.join(k[:2], k[2:4])
+        try:
+            return os.open(rel, os.O_RDONLY | os.O_DIRECTORY, dir_fd=self.root)
+        except FileNotFoundError:
+            if not create:
+                return None
+        for d in (k[:2], rel):
+            try:
+                os.mkdir(d, dir_fd=self.root)
+            except FileExistsError:
+                pass
+        return os.open(rel, os.O_RDONLY | os.O_DIRECTORY, dir_fd=self.root)
+
+    def _evict(self):
+        if len(self._leaves) <= self.max_open:
+            return
+        for k in [k for k, (fd, users) in self._leaves.items() if users == 0]:
+            os.close(self._leaves.pop(k)[0])
+            if len(self._leaves) <= self.max_open:
+                break
+
+    def close(self):
+        with self._lock:
+            for fd, _ in self._leaves.values():
+                os.close(fd)
+            self._leaves.clear()
+            if self.root is not None:
+                os.close(self.root)
+                self.root = None
@@ -0,0 +1,84 @@
+# ## Dedup-aware disk usage
+# * For a subtree of LJ's human-readable tree: bytes, and how many of them
+#   are unique to it or shared with names elsewhere
+# * Stat only, one pass: names are grouped by inode, and an inode all of
+#   whose links (but the pile's) are inside the subtree is unique to it
+# * pile_links: links each file has from the pile, 1 for LJ; 0 for a plain tree
+# * Each inode's bytes count once, as du does
+# * unique_files answers "find files in a directory tree that are not also
+#   somewhere else", without reading contents
+
+import os
+import stat
+
+from collections import namedtuple
+
+
+DirUsage = namedtuple('DirUsage', ['path', 'files', 'bytes', 'unique_bytes', 'shared_bytes'])
+
+
+def du(tree, pile_links=1, max_depth=None):
+    # DirUsage for tree and each directory under it (to max_depth below it),
+    # subdirectories before their parents
+    out = []
+    _scan(str(tree), 0, max_depth, pile_links, out)
+    return out
+
+def _scan(path, depth, max_depth, pile_links, out):
+    # -> {(st_dev, st_ino): [links seen in path, st_nlink, st_size]}
+    inodes = {}
+    with os.scandir(path) as it:
+        entries = list(it)
+    for e in entries:
+        if e.is_dir(follow_symlinks=False):
+            sub = _scan(e.path, depth + 1, max_depth, pile_links, out)
+            # merge the smaller into the larger
+            if len(sub) > len(inodes):
+                inodes, sub = sub, inodes
+            for ident, v in sub.items():
+                mine = inodes.get(ident)
+                if mine is None:
+                    inodes[ident] = v
+                else:
+                    mine[0] += v[0]
+        elif e.is_file(follow_symlinks=False):
+            st = e.stat(follow_symlinks=False)
+            ident = st.st_dev, st.st_ino
+            v = inodes.get(ident)
+            if v is None:
+                inodes[ident] = [1, st.st_nlink, st.st_size]
+            else:
+                v[0] += 1
+    if max_depth is None or depth <= max_depth:
+        out.append(_usage(path, inodes, pile_links))
+    return inodes
+
+def _usage(path, inodes, pile_links):
+    files = nbytes = unique = 0
+    for seen, nlink, size in inodes.values():
+        files += seen
+        nbytes += size
+        if seen >= nlink - pile_links:
+            unique += size
+    return DirUsage(path, files, nbytes, unique, nbytes - unique)
+
+def unique_files(tree, pile_links=1):
+    # Paths of the files in tree whose contents have no name outside it
+    inodes = {} # (st_dev, st_ino) -> [st_nlink, paths]
+    for root, dirs, files in os.walk(str(tree)):
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            v = inodes.get((st.st_dev, st.st_ino))
+            if v is None:
+                inodes[st.st_dev, st.st_ino] = [st.st_nlink, [path]]
+            else:
+                v[1].append(path)
+    rv = []
+    for nlink, paths in inodes.values():
+        if len(paths) >= nlink - pile_links:
+            rv.extend(paths)
+    rv.sort()
+    return rv
@@ -0,0 +1,120 @@
+# ## What would dedupe
+# * Dry run of an ingest: reports, changes nothing on disk
+# * Group files by size; a size seen once can't be a duplicate
+# * Then by a hash of the head and tail of each file
+# * Full hash only the files that still collide, with LJ's hash and key encoding,
+#   unless LJ's stat cache already knows them
+# * Hard links to one inode are one file, already deduplicated
+
+import os
+import stat
+
+from collections import defaultdict, namedtuple
+
+
+DupGroup = namedtuple('DupGroup', ['key', 'size', 'paths', 'inodes'])
+
+
+class DupReport():
+    def __init__(self):
+        self.groups = []
+        self.files = 0 # regular files seen
+        self.bytes = 0 # apparent bytes of those files
+        self.bytes_read = 0 # bytes actually read to decide
+
+    @property
+    def reclaimable_bytes(self):
+        # What an ingest would free: all but one inode of each group
+        return sum(g.size * (g.inodes - 1) for g in self.groups)
+
+    def as_dict(self, encode_key):
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'bytes_read': self.bytes_read,
+            'reclaimable_bytes': self.reclaimable_bytes,
+            'groups': [{'key': encode_key(g.key), 'size': g.size,
+                        'inodes': g.inodes, 'paths': g.paths}
+                       for g in self.groups],
+        }
+
+
+class DupScanner():
+    def __init__(self, lj, partial_len=1<<16):
+        self.lj = lj # for its hash (lj.h, lj.file_hasher) and stat cache
+        self.partial_len = partial_len
+
+    def scan(self, *dirnames):
+        report = DupReport()
+        by_size = defaultdict(list)
+        for path, st in self._walk(dirnames):
+            report.files += 1
+            report.bytes += st.st_size
+            by_size[st.st_size].append((path, st))
+
+        for size in sorted(by_size, reverse=True):
+            candidates = self._by_inode(by_size.pop(size))
+            if len(candidates) < 2:
+                continue
+            if size == 0:
+                groups = {self.lj.h(b'').digest(): candidates}
+            else:
+                if size > 2 * self.partial_len:
+                    buckets = self._bucket(candidates, lambda p: self._partial_key(report, p, size)).values()
+                else:
+                    # a partial hash would read the whole file anyway
+                    buckets = [candidates]
+                groups = {}
+                for bucket in buckets:
+                    groups.update(self._bucket(bucket, lambda p: self._full_key(report, p, size)))
+            for key, bucket in groups.items():
+                paths = sorted(p for paths in bucket for p in paths)
+                report.groups.append(DupGroup(key, size, paths, len(bucket)))
+        return report
+
+    def _walk(self, dirnames):
+        for dirname in dirnames:
+            for root, dirs, files in os.walk(dirname):
+                for name in files:
+                    path = os.path.join(root, name)
+                    st = os.lstat(path)
+                    if stat.S_ISREG(st.st_mode):
+                        yield path, st
+
+    def _by_inode(self, entries):
+        # -> list of lists of paths, one list per distinct inode
+        by_inode = defaultdict(list)
+        for path, st in entries:
+            by_inode[(st.st_dev, st.st_ino)].append(path)
+        return list(by_inode.values())
+
+    def _bucket(self, candidates, keyfun):
+        # Split candidates (lists of paths to one inode) by keyfun of the
+        # first path, keeping only buckets of two or more inodes
+        buckets = defaultdict(list)
+        for paths in candidates:
+            buckets[keyfun(paths[0])].append(paths)
+        return {k: b for k, b in buckets.items() if len(b) > 1}
+
+    def _partial_key(self, report, path, size):
+        n = self.partial_len
+        hasher = self.lj.h()
+        with open(path, 'rb') as f:
+            hasher.update(f.read(n))
+            f.seek(size - n)
+            hasher.update(f.read(n))
+        report.bytes_read += 2 * n
+        return hasher.digest()
+
+    def _full_key(self, report, path, size):
+        # The stat cache may know it, but is only read: key_from_path would
+        # store what it hashes and drop stale entries
+        cache = self.lj.stat_cache
+        if cache is not None:
+            key = cache.lookup(path, os.stat(path), forget=False)
+            if key is not None:
+                return key
+        with open(path, 'rb') as f:
+            key = self.lj.file_hasher.hash_file(f)
+        report.bytes_read += size
+        return key
@@ -0,0 +1,104 @@
+# ## Durability levels
+# * 'none': leave it to the OS, as before
+# * 'object': each create or assimilation is on disk before it returns:
+#   new contents fsynced before they get a name, then the directories
+#   changed fsynced
+# * 'group': group commit. Work is acknowledged at once, and made durable
+#   together every group_ops operations or group_ms milliseconds (checked
+#   as operations come, and on a timer for a group that goes quiet) and on
+#   flush and at exit; each directory changed in a group is fsynced once
+#   for the group
+# * Either way, contents reach the disk before any name for them does, so a
+#   crash leaves an object missing, never torn
+
+import atexit
+import os
+import threading
+import time
+import weakref
+
+
+NONE, OBJECT, GROUP = 'none', 'object', 'group'
+LEVELS = (NONE, OBJECT, GROUP)
+
+
+def fsync_path(path, directory=False):
+    fd = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability():
+    def __init__(self, level=NONE, group_ops=256, group_ms=50):
+        if level not in LEVELS:
+            raise ValueError(f"durability level must be one of {LEVELS}, not {level!r}")
+        self.level = level
+        self.group_ops = group_ops
+        self.group_ms = group_ms
+        self.syncs = 0 # fsyncs done, for the curious
+        self._dirs = set() # changed in this group
+        self._known = set() # directories seen, whose own entries are synced
+        self._ops = 0
+        self._t_commit = time.monotonic()
+        self._lock = threading.Lock()
+        self._timer = None
+        if level == GROUP:
+            atexit.register(_sync_at_exit, weakref.ref(self))
+
+    def changed(self, path, root):
+        # The entries of directory path, under root, have changed. The first
+        # time a directory is seen, its ancestors up to root count as changed
+        # too, since it may just have been made.
+        if self.level == NONE:
+            return
+        with self._lock:
+            self._dirs.add(path)
+            while path not in self._known and path != root:
+                self._known.add(path)
+                path = os.path.dirname(path)
+                self._dirs.add(path)
+            if self.level == GROUP and self._timer is None:
+                # by the deadline, even if no more operations come
+                self._timer = threading.Timer(self.group_ms / 1000, self.sync_dirs)
+                self._timer.daemon = True
+                self._timer.start()
+        if self.level == OBJECT:
+            self.sync_dirs()
+
+    def sync_file(self, fd):
+        if self.level != NONE:
+            os.fsync(fd)
+            self.syncs += 1
+
+    def op(self):
+        # Count an operation; True if a group commit is due
+        if self.level != GROUP:
+            return False
+        with self._lock:
+            self._ops += 1
+            return (self._ops >= self.group_ops
+                    or (time.monotonic() - self._t_commit) * 1000 >= self.group_ms)
+
+    def sync_dirs(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            dirs, self._dirs = self._dirs, set()
+            self._ops = 0
+            self._t_commit = time.monotonic()
+        # children before parents, so a new directory is in place before its entry is
+        for path in sorted(dirs, key=len, reverse=True):
+            try:
+                fsync_path(path, directory=True)
+            except FileNotFoundError:
+                continue # removed since: nothing left to make durable
+            self.syncs += 1
+
+
+def _sync_at_exit(ref):
+    durability = ref()
+    if durability is not None:
+        durability.sync_dirs()
@@ -0,0 +1,133 @@
+# ## Hashing file contents
+# * Streams with readinto into one reused buffer per thread: no allocation per chunk
+# * Optionally mmaps large files and hashes them in one update
+# ** Caution: a file truncated while mapped raises SIGBUS, so this is off by default
+# * blake3 hashes large files with several threads
+# * Works for any hash: a streaming factory (blake3, hashlib.sha256, ...), or a
+#   one-shot function of a buffer to a digest
+
+import io
+import mmap
+import os
+import stat
+import threading
+
+from blake3 import blake3
+
+
+class FileHasher():
+    def __init__(self, hasher=None, hashfun=None, buf_len=1<<20,
+                 mmap_threshold=None, mt_threshold=1<<27):
+        # hasher: called with no arguments, gives an object with update() and digest()
+        # hashfun: one-shot, buffer -> digest; used only when there's no hasher
+        if hasher is None and hashfun is None:
+            hasher = blake3
+        self.hasher = hasher
+        self.hashfun = hashfun
+        self.buf_len = buf_len
+        self.mmap_threshold = mmap_threshold # bytes, or None for never
+        self.mt_threshold = mt_threshold # bytes, for blake3's multithreaded mode
+        self._local = threading.local()
+
+    def new(self, size=0):
+        # A streaming hasher, multithreaded if it's blake3 and size is large
+        if self.hasher is blake3 and self.mt_threshold is not None and size >= self.mt_threshold:
+            return blake3(max_threads=blake3.AUTO)
+        return self.hasher()
+
+    def hash_bytes(self, data):
+        if self.hasher is None:
+            return self.hashfun(data)
+        h = self.new(len(data))
+        h.update(data)
+        return h.digest()
+
+    def hash_file(self, f):
+        # Digest of the contents of f from its current position to the end.
+        # Leaves f at the end.
+        fd, remaining = self._fd_and_remaining(f)
+        if self.hasher is None:
+            # One-shot: the function needs all the contents in one buffer
+            if fd is None:
+                return self.hashfun(f.read())
+            if remaining <= 0:
+                f.seek(0, io.SEEK_END)
+                return self.hashfun(b'')
+            return self._hash_mapped(f, fd, remaining, self.hashfun)
+        h = self.new(remaining or 0)
+        if fd is not None and self.mmap_threshold is not None and remaining >= self.mmap_threshold:
+            def digest_of(view):
+                h.update(view)
+                return h.digest()
+            return self._hash_mapped(f, fd, remaining, digest_of)
+        buf, view = self._buffer()
+        n = f.readinto(buf)
+        while n:
+            h.update(view[:n])
+            n = f.readinto(buf)
+        return h.digest()
+
+    def copy_file(self, src, dst, size=0):
+        # Copy src to dst, both file objects, and return the digest of what
+        # was copied. size, if known, picks the hasher (see new).
+        h = self.new(size) if self.hasher is not None else None
+        if h is None:
+            # One-shot: hash what was written once it's all there
+            pos = dst.tell()
+            self.copy(src, dst, None)
+            dst.flush()
+            dst.seek(pos)
+            return self.hash_file(dst)
+        self.copy(src, dst, h)
+        return h.digest()
+
+    def copy(self, src, dst, h):
+        # Copy src to dst through the reused buffer, updating h (if not None)
+        # with what passes. Returns the number of bytes copied.
+        total = 0
+        buf, view = self._buffer()
+        readinto = getattr(src, 'readinto', None)
+        while True:
+            if readinto is not None:
+                n = readinto(buf)
+                chunk = view[:n]
+            else:
+                chunk = src.read(self.buf_len)
+                n = len(chunk)
+            if not n:
+                break
+            if h is not None:
+                h.update(chunk)
+            dst.write(chunk)
+            total += n
+        return total
+
+    def _buffer(self):
+        # (bytearray, memoryview of it), one pair per thread
+        pair = getattr(self._local, 'buffer', None)
+        if pair is None or len(pair[0]) != self.buf_len:
+            buf = bytearray(self.buf_len)
+            pair = self._local.buffer = buf, memoryview(buf)
+        return pair
+
+    def _fd_and_remaining(self, f):
+        # (file descriptor, bytes from the position to the end), or (None, None)
+        # for things that aren't plain files
+        try:
+            fd = f.fileno()
+            pos = f.tell()
+            st = os.fstat(fd)
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None, None
+        if not stat.S_ISREG(st.st_mode):
+            return None, None
+        return fd, st.st_size - pos
+
+    def _hash_mapped(self, f, fd, remaining, digest_of):
+        pos = f.tell()
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as m:
+            with memoryview(m) as view:
+                with view[pos:pos + remaining] as part:
+                    digest = digest_of(part)
+        f.seek(pos + remaining)
+        return digest
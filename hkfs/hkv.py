@@ -5,6 +5,8 @@
 # * Range reads allowed
 # * Contents are immutable
 # * Can delete but not alter
+# * Creation is atomic: contents go to a temporary, which is linked into place
+# ** A crash leaves at worst a temporary, never a torn file under a valid key
 
 import os
 
@@ -29,60 +31,268 @@ class HK_CRD():
 
     def create_from_file(self, file):
         raise NotImplementedError
+
+    def create_from_iter(self, chunks):
+        raise NotImplementedError
         
     def read(self, key, offset, len):
         raise NotImplementedError
+
+    def read_into(self, key, buf, offset):
+        raise NotImplementedError
         
     def delete(self, key):
         raise NotImplementedError
 
+    # Batches. These defaults just loop; a store can do better.
+
+    def create_many(self, datas):
+        return [self.create(data) for data in datas]
+
+    def read_many(self, keys, offset=0, len=1<<31):
+        return [self.read(key, offset, len) for key in keys]
+
+    def exists_many(self, keys):
+        return [self.exists(key) for key in keys]
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
 
 # In[13]:
 
 
 from base64 import urlsafe_b64encode
+from contextlib import contextmanager
+from itertools import count
 from pathlib import Path
+import atexit
+import builtins
+import errno
 import hashlib
+import mmap
+import tempfile
+import threading
+import weakref
+
+from .compress import SUFFIX, read_compressed
+from .dirfd import DirFds
+from .durability import Durability, GROUP, NONE, OBJECT, fsync_path
+from .hashing import FileHasher
+from .journal import ADD, DELETE
+from .metrics import NULL_METRICS
+from .pack import PackStore
 
 class FHK_CRD(HK_CRD):
-    def __init__(self, dir, hashfun=None):
+    # hashfun: one-shot, data -> key. hasher: streaming, as hashlib.sha256 or blake3.
+    # Give either; with neither, sha256.
+    # dir_fds: keep fan-out directories open, and work relative to them
+    # metrics: an hkfs.metrics.Metrics, to time the phases of each operation
+    # journal: an hkfs.journal.Journal, to record each create and delete
+    # pack_threshold: objects smaller than this go into packfiles (hkfs.pack)
+    # under .pack in dir, instead of a file each
+    # read_cache: an hkfs.cache.BlockCache for read and read_into
+    # key_filter: an hkfs.keyfilter.KeyFilter, kept up to date with creations
+    # durability: 'none', 'object' or 'group', or an hkfs.durability.Durability.
+    # With 'group', a new object is invisible to other processes (and to
+    # Verifier) until its group commits: within group_ms, on a timer, or on
+    # flush or close, or at exit.
+    def __init__(self, dir, hashfun=None, hasher=None, dir_fds=False, metrics=None,
+                 journal=None, pack_threshold=0, read_cache=None, key_filter=None,
+                 durability=NONE):
         self.d = Path(dir)
         if hashfun:
             self.hashfun = hashfun
+        elif hasher:
+            self.hashfun = lambda x: hasher(x).digest()
         else:
+            hasher = hashlib.sha256
             self.hashfun = lambda x: hashlib.sha256(x).digest()
+        self.hasher = None if hashfun else hasher
         self.max_read_len = 1<<31
         #self.d.mkdir(parents=True, exist_ok=True)
         # ^^^ No, require the directory already to exist
         self.buf_len = 1<<20
+        self.file_hasher = FileHasher(self.hasher, self.hashfun, buf_len=self.buf_len)
+        self._dirs = set() # fan-out directories known to exist
+        self._tmp_seq = count()
+        self.listdir_threshold = 8 # exists_many lists a directory for this many keys in it
+        self.dir_fds = DirFds(self.d) if dir_fds else None
+        self.metrics = metrics or NULL_METRICS
+        self.journal = journal
+        self.pack_threshold = pack_threshold
+        self.pack = PackStore(self.d / '.pack') if pack_threshold else None
+        self.read_cache = read_cache
+        self.key_filter = key_filter
+        if isinstance(durability, str):
+            durability = Durability(durability)
+        self.durability = durability
+        if self.pack is not None:
+            self.pack.durable = durability.level != NONE
+        # With group commit, new objects wait here, key -> temporary, until
+        # their contents are synced; only then are they linked into place
+        self._pending = {}
+        self._commit_lock = threading.Lock()
+        self._commit_timer = None
+        if durability.level == GROUP:
+            atexit.register(_flush_at_exit, weakref.ref(self))
         
     def key(self, data):
         return self.hashfun(data)
 
-    # This doesn't really work with arbitrary hashfun
-    def key_from_file(f, file):
+    def key_from_file(self, file):
         file.seek(0,0)
-        h = self.hashfun
-        b = file.read(self.buf_len)
-        while b:
-            h.update(b)
-            b = file.read(self.buf_len)
-        return h.digest()
+        return self.file_hasher.hash_file(file)
     
     def _encode_key(self, kb):
         return urlsafe_b64encode(kb).rstrip(b'=').decode('ascii')
     
     def create(self, data):
-        key = self.key(data)
-        dir_path, file_path = self._dir_and_path_from_key(key)
-        dir_path.mkdir(parents=True, exist_ok=True)
-        with open(file_path, 'wb') as f:
-            f.write(data)
+        key = self._create(data)
+        self.metrics.tick()
+        return key
+
+    def _create(self, data):
+        m = self.metrics
+        with m.phase('hash'):
+            key = self.key(data)
+        m.count('bytes_hashed', len(data))
+        if self.pack is not None and len(data) < self.pack_threshold:
+            self._pack_in([(key, data)])
+            return key
+        if self._compressed_exists(key):
+            self.metrics.count('existed')
+            return key
+        with self.writer(hash=False) as w:
+            w.write(data)
+            w.commit(key)
         return key
+
+    def create_from_file(self, file):
+        # Contents of file from its current position; constant memory
+        with self.writer() as w:
+            w.write_from(file)
+            return w.commit()
+
+    def create_from_iter(self, chunks):
+        with self.writer() as w:
+            for chunk in chunks:
+                w.write(chunk)
+            return w.commit()
+
+    def writer(self, hash=True):
+        # For contents that arrive in pieces:
+        #   with hk.writer() as w: w.write(...); ...; key = w.commit()
+        # Leaving the with block without a commit discards what was written.
+        # hash=False for a caller who will give commit the key.
+        return _Writer(self, hash)
+
+    def _pack_in(self, items):
+        m = self.metrics
+        with m.phase('pack'):
+            new = self.pack.put_many(items)
+        if self.key_filter is not None:
+            self.key_filter.update(key for key, _ in items)
+        m.count('created', len(new))
+        m.count('existed', len(items) - len(new))
+        if self.journal is not None:
+            for key in new:
+                self.journal.append(ADD, key)
+
+    def _place(self, tmp_path, key):
+        # Link a complete temporary into place under key, and drop the temporary
+        if self.key_filter is not None:
+            self.key_filter.add(key)
+        if self.durability.level == GROUP:
+            with self._commit_lock:
+                if key in self._pending:
+                    os.remove(tmp_path) # same key, same contents
+                else:
+                    self._pending[key] = tmp_path
+                if self._commit_timer is None:
+                    # commit by the deadline even if nothing else comes along
+                    self._commit_timer = threading.Timer(self.durability.group_ms / 1000,
+                                                         self.flush)
+                    self._commit_timer.daemon = True
+                    self._commit_timer.start()
+            if self.durability.op():
+                self.flush()
+            return
+        self._place_now(tmp_path, key)
+        self._dir_changed(self._encode_key(key))
+
+    def _dir_changed(self, encoded_key):
+        root = str(self.d)
+        self.durability.changed(os.path.join(root, encoded_key[:2], encoded_key[2:4]), root)
+
+    def flush(self):
+        # Group commit: sync the contents of the objects waiting, link them
+        # into place, and sync the directories changed
+        with self._commit_lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+            pending = list(self._pending.items())
+            for key, tmp_path in pending:
+                fsync_path(tmp_path)
+            for key, tmp_path in pending:
+                # linked before it's dropped from _pending, so always readable
+                self._place_now(tmp_path, key, keep=True)
+                del self._pending[key]
+                os.remove(tmp_path)
+                self._dir_changed(self._encode_key(key))
+            if self.durability.level == GROUP:
+                self.durability.sync_dirs()
+        if self.pack is not None and self.durability.level != NONE:
+            self.pack.sync()
+
+    def _place_now(self, tmp_path, key, keep=False):
+        encoded_key = self._encode_key(key)
+        m = self.metrics
+        with self._leaf(encoded_key, create=True) as (dir_fd, prefix):
+            try:
+                if self._lexists(prefix + encoded_key + SUFFIX, dir_fd):
+                    raise FileExistsError # already in the compressed tier
+                with m.phase('link'):
+                    os.link(tmp_path, prefix + encoded_key, dst_dir_fd=dir_fd)
+                m.count('created')
+                if self.journal is not None:
+                    self.journal.append(ADD, key)
+            except FileExistsError:
+                m.count('existed') # same key, same contents
+        if not keep:
+            with m.phase('unlink'):
+                os.remove(tmp_path)
             
     def exists(self, key):
-        return self._path_from_key(key).exists()
+        with self.metrics.phase('exists'):
+            rv = self._exists(key)
+        self.metrics.tick()
+        return rv
+
+    def _exists(self, key):
+        if self._surely_absent(key):
+            return False
+        if key in self._pending:
+            return True
+        if self.pack is not None and self.pack.exists(key):
+            return True
+        encoded_key = self._encode_key(key)
+        with self._leaf(encoded_key) as (dir_fd, prefix):
+            return prefix is not None and (self._lexists(prefix + encoded_key, dir_fd)
+                                           or self._lexists(prefix + encoded_key + SUFFIX, dir_fd))
     
+    def _compressed_exists(self, key):
+        encoded_key = self._encode_key(key)
+        with self._leaf(encoded_key) as (dir_fd, prefix):
+            return prefix is not None and self._lexists(prefix + encoded_key + SUFFIX, dir_fd)
+
+    def _surely_absent(self, key):
+        # Only a filter that sees every write can be believed when it says no
+        kf = self.key_filter
+        return kf is not None and kf.authoritative and key not in kf
+
     def _dir_and_path_from_key(self, key):
         # Here is where the file system structure is determined for the KV store
         assert(len(key) >= 4)
@@ -93,14 +303,449 @@ class FHK_CRD(HK_CRD):
     def _path_from_key(self, key):
         _, rv = self._dir_and_path_from_key(key)
         return rv
+
+    @contextmanager
+    def _leaf(self, encoded_key, create=False):
+        # (dir_fd, prefix) such that prefix + name, dir_fd=dir_fd, names the
+        # entry for any encoded key in the same fan-out directory as this one.
+        # With dir fds, (None, None) if that directory doesn't exist and
+        # create is false.
+        if self.dir_fds is None:
+            dir_path = os.path.join(str(self.d), encoded_key[:2], encoded_key[2:4])
+            if create:
+                self._ensure_dir(dir_path)
+            yield None, dir_path + os.sep
+            return
+        with self.dir_fds.leaf(encoded_key, create) as dir_fd:
+            yield dir_fd, (None if dir_fd is None else '')
+
+    @staticmethod
+    def _lexists(entry, dir_fd):
+        try:
+            os.stat(entry, dir_fd=dir_fd, follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _open_key(self, key):
+        # A read-only fd for the contents of key
+        assert(len(key) >= 4)
+        tmp_path = self._pending.get(key)
+        if tmp_path is not None:
+            try:
+                return os.open(tmp_path, os.O_RDONLY)
+            except FileNotFoundError:
+                pass # placed since
+        encoded_key = self._encode_key(key)
+        with self._leaf(encoded_key) as (dir_fd, prefix):
+            if prefix is None:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), encoded_key)
+            return os.open(prefix + encoded_key, os.O_RDONLY, dir_fd=dir_fd)
     
     def read(self, key, offset=0, len=1<<31):
-        _, file_path = self._dir_and_path_from_key(key)
-        with open(file_path, 'rb') as f:
-            f.seek(offset)
-            rv = f.read(len)
+        if self.read_cache is not None:
+            with self.metrics.phase('read'):
+                rv = self.read_cache.read(key, offset, len, self._fetch)
+            self.metrics.count('bytes_read', builtins.len(rv))
+        else:
+            rv = self._read_uncached(key, offset, len)
+        self.metrics.tick()
+        return rv
+
+    def _read_uncached(self, key, offset=0, len=1<<31):
+        with self.metrics.phase('read'):
+            rv = self._fetch(key, offset, len)
+        self.metrics.count('bytes_read', builtins.len(rv))
         return rv
 
+    def _fetch(self, key, offset, len):
+        # The contents, without metrics: read accounts for what the caller
+        # asked, not the blocks a cache fetches
+        rv = self._read_packed(key, offset, len)
+        if rv is not None:
+            return rv
+        try:
+            fd = self._open_key(key)
+        except FileNotFoundError:
+            return self._read_compressed(key, offset, len)
+        with open(fd, 'rb') as f:
+            f.seek(offset)
+            return f.read(len)
+
+    def read_into(self, key, buf, offset=0):
+        # Fill the caller's buffer from offset; returns the number of bytes
+        # read, short only at the end of the contents
+        n = self._read_into(key, buf, offset)
+        self.metrics.tick()
+        return n
+
+    def _read_into(self, key, buf, offset):
+        if self.read_cache is not None:
+            view = memoryview(buf).cast('B')
+            data = self.read(key, offset, view.nbytes)
+            view[:builtins.len(data)] = data
+            return builtins.len(data)
+        if self.pack is not None:
+            try:
+                return self.pack.read_into(key, buf, offset)
+            except KeyError:
+                pass
+        view = memoryview(buf).cast('B')
+        with self.metrics.phase('read'):
+            try:
+                fd = self._open_key(key)
+            except FileNotFoundError:
+                data = self._read_compressed(key, offset, view.nbytes)
+                view[:builtins.len(data)] = data
+                return builtins.len(data)
+            try:
+                total = 0
+                while total < view.nbytes:
+                    n = os.preadv(fd, [view[total:]], offset + total)
+                    if n == 0:
+                        break
+                    total += n
+            finally:
+                os.close(fd)
+        self.metrics.count('bytes_read', total)
+        return total
+
+    @contextmanager
+    def view(self, key, offset=0, len=None):
+        # A read-only memoryview of the contents, mapped rather than copied,
+        # valid inside the with block. Packed and compressed contents are copied.
+        length = self.max_read_len if len is None else len
+        data = self._read_packed(key, offset, length)
+        try:
+            fd = self._open_key(key) if data is None else None
+        except FileNotFoundError:
+            data = self._read_compressed(key, offset, length)
+        if data is not None:
+            with memoryview(data) as part:
+                yield part
+            return
+        with open(fd, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if len is None else min(size, offset + len)
+            if end <= offset:
+                yield memoryview(b'')
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                with memoryview(m) as whole:
+                    with whole[offset:end] as part:
+                        yield part
+
+    def _read_packed(self, key, offset, len):
+        # Contents from the packfiles, or None if key isn't packed
+        if self.pack is None:
+            return None
+        try:
+            return self.pack.get(key, offset, len)
+        except KeyError:
+            return None
+
+    def _read_compressed(self, key, offset, len):
+        # Contents from the compressed tier; FileNotFoundError if not there either
+        encoded_key = self._encode_key(key)
+        with self._leaf(encoded_key) as (dir_fd, prefix):
+            if prefix is None:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), encoded_key)
+            return read_compressed(prefix + encoded_key + SUFFIX, offset, len, dir_fd=dir_fd)
+
+    def _remove_entry(self, dir_fd, prefix, name):
+        # Remove the plain and compressed forms of name; FileNotFoundError if neither
+        removed = False
+        for entry in (name, name + SUFFIX):
+            try:
+                os.unlink(prefix + entry, dir_fd=dir_fd)
+                removed = True
+            except FileNotFoundError:
+                pass
+        if not removed:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
     def delete(self, key):
-        _, file_path = self._dir_and_path_from_key(key)
-        os.remove(file_path)
+        if self.read_cache is not None:
+            self.read_cache.invalidate(key)
+        if key in self._pending:
+            self.flush()
+        # Every form goes: an object packed after it was stored as a file
+        # (the pack threshold set later on) is in both
+        packed = self.pack is not None and self.pack.delete(key)
+        encoded_key = self._encode_key(key)
+        with self._leaf(encoded_key) as (dir_fd, prefix):
+            try:
+                if prefix is None:
+                    raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), encoded_key)
+                with self.metrics.phase('delete'):
+                    self._remove_entry(dir_fd, prefix, encoded_key)
+            except FileNotFoundError:
+                if not packed:
+                    raise
+        if self.journal is not None:
+            self.journal.append(DELETE, key)
+        self.metrics.tick()
+
+    def close(self):
+        self.flush()
+        if self.dir_fds is not None:
+            self.dir_fds.close()
+        if self.pack is not None:
+            self.pack.close()
+
+    def _ensure_dir(self, dir_path):
+        if dir_path not in self._dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            self._dirs.add(dir_path)
+
+    # Batches: keys are grouped by fan-out directory, which is found once
+    # per group, and directories known to exist aren't made again.
+
+    def _group_by_dir(self, keys, positions=None):
+        # -> {fan-out directory: [(position in keys, encoded key), ...]}
+        # positions: of just those keys, if not all
+        groups = {}
+        if positions is None:
+            positions = range(len(keys))
+        for i in positions:
+            key = keys[i]
+            assert(len(key) >= 4)
+            name = self._encode_key(key)
+            groups.setdefault(name[:4], []).append((i, name))
+        return groups.values()
+
+    def create_many(self, datas):
+        with self.metrics.phase('create_many'):
+            rv = self._create_many(datas)
+        self.metrics.tick()
+        return rv
+
+    def _create_many(self, datas):
+        # Each object is still written to a temporary and renamed into place
+        # (so is never torn), but with four syscalls: open, write, close, rename
+        datas = list(datas)
+        if self.durability.level != NONE:
+            # contents must be synced before they're named: one at a time
+            return [self.create(data) for data in datas]
+        m = self.metrics
+        with m.phase('hash'):
+            keys = [self.key(data) for data in datas]
+        m.count('bytes_hashed', sum(builtins.len(data) for data in datas))
+        files = None
+        if self.pack is not None:
+            small = [i for i, data in enumerate(datas) if len(data) < self.pack_threshold]
+            if small:
+                self._pack_in([(keys[i], datas[i]) for i in small])
+            files = sorted(set(range(len(datas))) - set(small))
+        pid = os.getpid()
+        for items in self._group_by_dir(keys, files):
+            with self._leaf(items[0][1], create=True) as (dir_fd, prefix):
+                for i, name in items:
+                    if (self._lexists(prefix + name, dir_fd)
+                            or self._lexists(prefix + name + SUFFIX, dir_fd)):
+                        m.count('existed') # as create's FileExistsError
+                        continue
+                    tmp_path = f"{prefix}.tmp-{pid}-{next(self._tmp_seq)}"
+                    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o444,
+                                 dir_fd=dir_fd)
+                    try:
+                        try:
+                            view = memoryview(datas[i])
+                            while view:
+                                view = view[os.write(fd, view):]
+                        finally:
+                            os.close(fd)
+                        os.rename(tmp_path, prefix + name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+                    except BaseException:
+                        try:
+                            os.unlink(tmp_path, dir_fd=dir_fd)
+                        except FileNotFoundError:
+                            pass
+                        raise
+                    m.count('created')
+                    m.count('bytes_written', builtins.len(datas[i]))
+                    if self.journal is not None:
+                        self.journal.append(ADD, keys[i])
+        if self.key_filter is not None:
+            self.key_filter.update(keys)
+        return keys
+
+    def read_many(self, keys, offset=0, len=1<<31):
+        with self.metrics.phase('read_many'):
+            rv = self._read_many(keys, offset, len)
+        self.metrics.tick()
+        return rv
+
+    def _read_many(self, keys, offset, len):
+        keys = list(keys)
+        if self._pending:
+            self.flush()
+        rv = [None for _ in keys]
+        files = None
+        if self.pack is not None:
+            files = []
+            for i, key in enumerate(keys):
+                rv[i] = self._read_packed(key, offset, len)
+                if rv[i] is None:
+                    files.append(i)
+        for items in self._group_by_dir(keys, files):
+            with self._leaf(items[0][1]) as (dir_fd, prefix):
+                for i, name in items:
+                    if prefix is None:
+                        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+                    try:
+                        fd = os.open(prefix + name, os.O_RDONLY, dir_fd=dir_fd)
+                    except FileNotFoundError:
+                        rv[i] = read_compressed(prefix + name + SUFFIX, offset, len, dir_fd=dir_fd)
+                        continue
+                    try:
+                        size = os.fstat(fd).st_size
+                        rv[i] = os.pread(fd, max(0, min(len, size - offset)), offset)
+                    finally:
+                        os.close(fd)
+        self.metrics.count('bytes_read', sum(builtins.len(data) for data in rv))
+        return rv
+
+    def exists_many(self, keys):
+        with self.metrics.phase('exists_many'):
+            rv = self._exists_many(keys)
+        self.metrics.tick()
+        return rv
+
+    def _exists_many(self, keys):
+        keys = list(keys)
+        if self._pending:
+            self.flush()
+        rv = [False] * len(keys)
+        files = None
+        if self.pack is not None or self.key_filter is not None:
+            files = []
+            for i, key in enumerate(keys):
+                if self._surely_absent(key):
+                    continue
+                rv[i] = self.pack is not None and self.pack.exists(key)
+                if not rv[i]:
+                    files.append(i)
+        for items in self._group_by_dir(keys, files):
+            with self._leaf(items[0][1]) as (dir_fd, prefix):
+                if prefix is None:
+                    continue
+                if len(items) >= self.listdir_threshold:
+                    try:
+                        present = set(os.listdir(prefix or dir_fd))
+                    except FileNotFoundError:
+                        continue
+                    for i, name in items:
+                        rv[i] = name in present or name + SUFFIX in present
+                else:
+                    for i, name in items:
+                        rv[i] = (self._lexists(prefix + name, dir_fd)
+                                 or self._lexists(prefix + name + SUFFIX, dir_fd))
+        return rv
+
+    def delete_many(self, keys, missing_ok=False):
+        with self.metrics.phase('delete_many'):
+            rv = self._delete_many(keys, missing_ok)
+        self.metrics.tick()
+        return rv
+
+    def _delete_many(self, keys, missing_ok):
+        keys = list(keys)
+        if self._pending:
+            self.flush()
+        if self.read_cache is not None:
+            for key in keys:
+                self.read_cache.invalidate(key)
+        packed = set()
+        if self.pack is not None:
+            packed = {i for i, key in enumerate(keys) if self.pack.delete(key)}
+        # files too, as in delete
+        for items in self._group_by_dir(keys):
+            with self._leaf(items[0][1]) as (dir_fd, prefix):
+                for i, name in items:
+                    try:
+                        if prefix is None:
+                            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+                        self._remove_entry(dir_fd, prefix, name)
+                    except FileNotFoundError:
+                        if i not in packed:
+                            if not missing_ok:
+                                raise
+                            continue
+                    if self.journal is not None:
+                        self.journal.append(DELETE, keys[i])
+
+
+def _flush_at_exit(ref):
+    store = ref()
+    if store is not None:
+        store.flush()
+
+
+class _Writer():
+    # Writes to a temporary in the store's directory, hashing as it goes
+    def __init__(self, store, hash=True):
+        self.store = store
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.d, prefix='.tmp-')
+        self.f = open(fd, 'wb')
+        fh = store.file_hasher
+        self.h = fh.new() if hash and fh.hasher is not None else None
+        self.key = None
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        m = self.store.metrics
+        if self.h is not None:
+            with m.phase('hash'):
+                self.h.update(data)
+            m.count('bytes_hashed', len(data))
+        with m.phase('write'):
+            self.f.write(data)
+        m.count('bytes_written', len(data))
+
+    def write_from(self, file):
+        m = self.store.metrics
+        with m.phase('copy'):
+            n = self.store.file_hasher.copy(file, self.f, self.h)
+        self.size += n
+        if self.h is not None:
+            m.count('bytes_hashed', n)
+        m.count('bytes_written', n)
+        return n
+
+    def commit(self, key=None):
+        # key, if the caller already knows it, saves hashing again
+        if self.store.durability.level == OBJECT:
+            self.f.flush()
+            self.store.durability.sync_file(self.f.fileno())
+        self.f.close()
+        if key is None:
+            if self.h is not None:
+                key = self.h.digest()
+            else:
+                with open(self.tmp_path, 'rb') as f, self.store.metrics.phase('hash'):
+                    key = self.store.file_hasher.hash_file(f)
+                self.store.metrics.count('bytes_hashed', self.size)
+        store = self.store
+        if store.pack is not None and self.size < store.pack_threshold:
+            with open(self.tmp_path, 'rb') as f:
+                store._pack_in([(key, f.read())])
+            os.remove(self.tmp_path)
+        else:
+            os.chmod(self.tmp_path, 0o444) # contents are immutable
+            store._place(self.tmp_path, key)
+        self.key = key
+        store.metrics.tick()
+        return key
+
+    def abort(self):
+        self.f.close()
+        if self.key is None and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.abort()
@@ -0,0 +1,80 @@
+# ## Hash from inode
+# * Associates inodes in the hash pile with their keys
+# * Use: skip re-hashing files that are already linked into the pile
+# * Construct or re-construct by scan of hash subtree
+# * Update with assimilations
+# * Entries can go stale (inode numbers get reused), so a hit must be
+#   confirmed against the pile before it is trusted
+
+import os
+import threading
+
+from .db import connect
+from .pile import decode_key, scan_pile
+
+
+class InodeIndex():
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self._conn()
+
+    def _conn(self):
+        # sqlite connections are per-thread; WAL makes them safe across processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.path)
+            conn.execute("CREATE TABLE IF NOT EXISTS inode_key ("
+                         " dev INTEGER NOT NULL,"
+                         " ino INTEGER NOT NULL,"
+                         " key BLOB NOT NULL,"
+                         " PRIMARY KEY (dev, ino)) WITHOUT ROWID")
+            self._local.conn = conn
+        return conn
+
+    def get(self, dev, ino):
+        row = self._conn().execute(
+            "SELECT key FROM inode_key WHERE dev = ? AND ino = ?", (dev, ino)).fetchone()
+        return row and row[0]
+
+    def put(self, dev, ino, key):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO inode_key (dev, ino, key) VALUES (?, ?, ?)",
+            (dev, ino, key))
+
+    def delete(self, dev, ino):
+        self._conn().execute(
+            "DELETE FROM inode_key WHERE dev = ? AND ino = ?", (dev, ino))
+
+    def __len__(self):
+        return self._conn().execute("SELECT count(*) FROM inode_key").fetchone()[0]
+
+    def rebuild(self, pile_directory, batch=10000):
+        # Replace the contents with what a scan of the hash subtree finds
+        # Entries from scandir give the inode number without a stat
+        dev = os.stat(pile_directory).st_dev
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM inode_key")
+            rows = []
+            for e in scan_pile(pile_directory):
+                try:
+                    key = decode_key(e.name)
+                except ValueError:
+                    continue
+                rows.append((dev, e.inode(), key))
+                if len(rows) >= batch:
+                    conn.executemany("INSERT OR REPLACE INTO inode_key VALUES (?, ?, ?)", rows)
+                    rows = []
+            conn.executemany("INSERT OR REPLACE INTO inode_key VALUES (?, ?, ?)", rows)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
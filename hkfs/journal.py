@@ -0,0 +1,244 @@
+# ## Ingest journal
+# * Every add, link and delete in a pile, appended as a record: sequence
+#   number, op, key
+# * Segment files of at most segment_bytes, named by their first sequence number
+# * Records are written as they come, but fsynced in groups: every
+#   sync_every records or sync_interval seconds, and on flush and close
+# * One writer at a time, by flock of the journal directory's lock file;
+#   readers need no lock, and stop at a torn record at the end
+# * A checkpoint is a sequence number. export_since copies the pile files
+#   added after one, so a backup costs the churn, not the size of the pile;
+#   packed objects go across as plain files
+
+import fcntl
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+from collections import namedtuple
+
+from .compress import SUFFIX
+from .pack import PackStore
+from .pile import encode_key
+
+
+ADD, LINK, DELETE = 1, 2, 3
+OP_NAMES = {ADD: 'add', LINK: 'link', DELETE: 'delete'}
+
+# crc32 of the rest, sequence number, op, key length; then the key
+_HEADER = struct.Struct('<IQBB')
+
+Record = namedtuple('Record', ['seq', 'op', 'key'])
+ExportResult = namedtuple('ExportResult', ['checkpoint', 'copied', 'deleted'])
+
+
+def _segment_name(first_seq):
+    return f"{first_seq:020d}.jnl"
+
+def segments(directory):
+    # (first sequence number, path) of each segment, in order
+    rv = []
+    for name in os.listdir(directory):
+        if name.endswith('.jnl') and name[:-4].isdigit():
+            rv.append((int(name[:-4]), os.path.join(directory, name)))
+    rv.sort()
+    return rv
+
+def _read_segment(path):
+    # Yield (Record, end offset) up to the end or the first bad record
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + _HEADER.size <= len(data):
+        crc, seq, op, key_len = _HEADER.unpack_from(data, pos)
+        end = pos + _HEADER.size + key_len
+        if end > len(data) or zlib.crc32(data[pos + 4:end]) != crc:
+            return # torn
+        yield Record(seq, op, bytes(data[pos + _HEADER.size:end])), end
+        pos = end
+
+def records(directory, since=0):
+    # Yield the Records with sequence numbers greater than since
+    segs = segments(directory)
+    # the segment holding since + 1 is the last that starts at or before it
+    start = 0
+    for i, (first_seq, _) in enumerate(segs):
+        if first_seq <= since + 1:
+            start = i
+    for _, path in segs[start:]:
+        for record, _ in _read_segment(path):
+            if record.seq > since:
+                yield record
+
+
+class Journal():
+    def __init__(self, directory, segment_bytes=64 << 20, sync_every=256, sync_interval=1.0):
+        self.directory = str(directory)
+        self.segment_bytes = segment_bytes
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(self.directory, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise BlockingIOError(f"journal {self.directory} has another writer") from None
+        self._lock = threading.Lock()
+        self._f = None
+        self._unsynced = 0
+        self._t_sync = time.monotonic()
+        self.seq = 0 # of the last record
+        segs = segments(self.directory)
+        if segs:
+            self._resume(segs[-1][1])
+
+    def _resume(self, path):
+        # Find the last sequence number, and cut off a torn record at the end
+        good = 0
+        for record, end in _read_segment(path):
+            self.seq, good = record.seq, end
+        self._f = open(path, 'ab')
+        if self._f.tell() != good:
+            self._f.truncate(good)
+            self._f.seek(good)
+        if good == 0:
+            # an empty segment takes its name from its first record
+            self.seq = int(os.path.basename(path)[:-4]) - 1
+
+    def _rotate(self):
+        if self._f is not None:
+            self._sync()
+            self._f.close()
+        path = os.path.join(self.directory, _segment_name(self.seq + 1))
+        self._f = open(path, 'ab')
+        dir_fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def append(self, op, key):
+        # Returns the sequence number of the record
+        with self._lock:
+            if self._f is None or self._f.tell() >= self.segment_bytes:
+                self._rotate()
+            self.seq += 1
+            body = struct.pack('<QBB', self.seq, op, len(key)) + key
+            self._f.write(struct.pack('<I', zlib.crc32(body)) + body)
+            self._unsynced += 1
+            if (self._unsynced >= self.sync_every
+                or time.monotonic() - self._t_sync >= self.sync_interval):
+                self._sync()
+            return self.seq
+
+    def add(self, key):
+        return self.append(ADD, key)
+
+    def link(self, key):
+        return self.append(LINK, key)
+
+    def delete(self, key):
+        return self.append(DELETE, key)
+
+    def _sync(self):
+        if self._unsynced:
+            self._f.flush()
+            os.fdatasync(self._f.fileno())
+            self._unsynced = 0
+        self._t_sync = time.monotonic()
+
+    def flush(self):
+        # Make everything appended so far durable; returns the checkpoint
+        with self._lock:
+            if self._f is not None:
+                self._sync()
+            return self.seq
+
+    def records(self, since=0):
+        self.flush()
+        return records(self.directory, since)
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._sync()
+                self._f.close()
+                self._f = None
+            if self._lock_fd is not None:
+                os.close(self._lock_fd) # drops the flock
+                self._lock_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_since(journal, pile_directory, dest_directory, since=0):
+    # Copy to dest_directory, in the same layout, the pile files added after
+    # the checkpoint since and not deleted again. journal is a Journal or
+    # the path of a journal directory. Keys deleted after the checkpoint are
+    # reported, not removed from the destination; that's for the caller to
+    # decide. The checkpoint returned is the one to pass next time.
+    if isinstance(journal, Journal):
+        recs = journal.records(since)
+    else:
+        recs = records(journal, since)
+    last = {} # key -> last add or delete, in order of first appearance
+    checkpoint = since
+    for record in recs:
+        # a link names contents already there: it neither adds nor removes them
+        if record.op != LINK:
+            last[record.key] = record.op
+        checkpoint = record.seq
+    copied, deleted = [], []
+    # packed objects are copied out as plain files
+    pack_directory = os.path.join(str(pile_directory), '.pack')
+    pack = PackStore(pack_directory) if os.path.isdir(pack_directory) else None
+    try:
+        for key, op in last.items():
+            if op == DELETE:
+                deleted.append(key)
+            elif op == ADD and _copy_key(key, pile_directory, dest_directory, pack):
+                copied.append(key)
+    finally:
+        if pack is not None:
+            pack.close()
+    return ExportResult(checkpoint, copied, deleted)
+
+def _copy_key(key, pile_directory, dest_directory, pack=None):
+    name = encode_key(key)
+    rel = os.path.join(name[:2], name[2:4], name)
+    dest = os.path.join(str(dest_directory), rel)
+    if os.path.exists(dest) or os.path.exists(dest + SUFFIX):
+        return False # contents are immutable, so it's the same
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(dest), f".tmp-{os.getpid()}-{name}")
+    src = os.path.join(str(pile_directory), rel)
+    for suffix in ('', SUFFIX):
+        # plain, or moved to the compressed tier since
+        try:
+            shutil.copy2(src + suffix, tmp)
+        except FileNotFoundError:
+            continue
+        os.rename(tmp, dest + suffix)
+        return True
+    if pack is not None:
+        try:
+            data = pack.get(key)
+        except KeyError:
+            pass
+        else:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, dest)
+            return True
+    # gone from the pile without a journal record
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    return False
@@ -0,0 +1,111 @@
+# ## Key presence filter
+# * A Bloom filter of the keys in a pile: "no" means not there, "maybe" has
+#   to be confirmed on disk
+# * Bit positions come straight from the key bytes, which are already
+#   uniformly distributed digests; short keys are hashed first
+# * Build from a scan of the pile, or load a saved one; add keys as they're
+#   created. Deleted keys stay in (a Bloom filter can't drop them), which
+#   only costs a disk check.
+# * With other writers on the pile, a "no" may be out of date. Creation
+#   paths treat a "no" as a hint and cope with finding the key there after
+#   all; exists trusts a "no" only from an authoritative filter, one the
+#   caller knows sees every write.
+# * Safe to share between threads: a lost bit would be a false "no"
+
+import hashlib
+import math
+import os
+import struct
+import threading
+
+from .compress import SUFFIX
+from .pack import PackStore
+from .pile import decode_key, scan_pile
+
+
+_HEADER = struct.Struct('<4sQIQ') # magic, bits, hashes, keys added
+_MAGIC = b'HKBF'
+
+
+class KeyFilter():
+    def __init__(self, capacity=1 << 20, fp_rate=0.01, authoritative=False):
+        # Sized for capacity keys at a false positive rate of fp_rate
+        capacity = max(1, capacity)
+        self.n_bits = max(64, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0 # keys added
+        self.authoritative = authoritative
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        if len(key) < 16:
+            key = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        m = self.n_bits
+        return [(h1 + i * h2) % m for i in range(self.n_hashes)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        bits = self.bits
+        with self._lock:
+            for p in positions:
+                bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        # False: certainly never added. True: probably added.
+        positions = self._positions(key)
+        bits = self.bits
+        with self._lock:
+            for p in positions:
+                if not bits[p >> 3] & (1 << (p & 7)):
+                    return False
+        return True
+
+    @classmethod
+    def from_pile(cls, directory, fp_rate=0.01, headroom=2.0, authoritative=False):
+        # Scan the pile; sized for headroom times the keys found, to leave
+        # room for growth. Packed keys (FHK_CRD's .pack) are included.
+        keys = [decode_key(e.name[:-len(SUFFIX)] if e.name.endswith(SUFFIX) else e.name)
+                for e in scan_pile(directory)]
+        pack_dir = os.path.join(str(directory), '.pack')
+        if os.path.isdir(pack_dir):
+            pack = PackStore(pack_dir)
+            keys.extend(pack.keys())
+            pack.close()
+        rv = cls(int(len(keys) * headroom) + 1024, fp_rate, authoritative)
+        rv.update(keys)
+        return rv
+
+    def save(self, path):
+        # Atomically, by way of a temporary beside path
+        path = str(path)
+        tmp = f"{path}.tmp-{os.getpid()}"
+        with self._lock:
+            count, bits = self.count, bytes(self.bits)
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, self.n_bits, self.n_hashes, count))
+            f.write(bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, authoritative=False):
+        with open(str(path), 'rb') as f:
+            magic, n_bits, n_hashes, count = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError(f"not a key filter: {path}")
+            bits = bytearray(f.read())
+        if len(bits) != (n_bits + 7) // 8:
+            raise ValueError(f"truncated key filter: {path}")
+        rv = cls.__new__(cls)
+        rv.n_bits, rv.n_hashes, rv.count = n_bits, n_hashes, count
+        rv.bits = bits
+        rv.authoritative = authoritative
+        rv._lock = threading.Lock()
+        return rv
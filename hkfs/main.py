@@ -1,5 +1,23 @@
+import argparse
 import sys
 
-def main():
-    print("hkfs here")
+from .server import serve
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if not args:
+        print("hkfs here")
+        sys.exit(0)
+    parser = argparse.ArgumentParser(prog='hkfs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('serve', help="serve a hash pile's objects to local readers")
+    p.add_argument('directory', help="the pile")
+    p.add_argument('--socket', help="listen on this Unix socket, not TCP")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8080)
+    p.add_argument('--max-open', type=int, default=256, help="files kept open")
+    args = parser.parse_args(args)
+    if args.command == 'serve':
+        serve(args.directory, args.socket, args.host, args.port, args.max_open)
     sys.exit(0)
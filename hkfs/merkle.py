@@ -0,0 +1,177 @@
+# ## Hash of hashes for directories
+# * A directory's key is the hash, with LJ's hash, of its sorted entries:
+#   kind, name and key of each
+# * Wherever two directory keys match, the subtrees match as to file contents
+#   and tree structure (not permissions or times)
+# * Keys are stored in sqlite, so only dirty directories are recomputed
+# * The walk is depth-first and streams: memory is one directory's entries
+#   per level of depth, not the whole tree
+
+import os
+
+from collections import namedtuple
+from struct import pack
+
+from .db import connect
+
+
+DirRow = namedtuple('DirRow', ['key', 'dirty', 'mtime_ns', 'bytes'])
+
+
+class MerkleIndex():
+    def __init__(self, lj, db_path, batch=1000):
+        self.lj = lj # for its hash (lj.h) and file keys (lj.key_from_path)
+        self.conn = connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dir_key ("
+                          " path TEXT PRIMARY KEY,"
+                          " parent TEXT,"
+                          " key BLOB NOT NULL,"
+                          " dirty INTEGER NOT NULL DEFAULT 0,"
+                          " mtime_ns INTEGER NOT NULL,"
+                          " bytes INTEGER NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS dir_key_key ON dir_key (key)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS dir_key_parent ON dir_key (parent)")
+        self.batch = batch
+        self._writes = 0
+        self.recomputed = 0 # directories scanned by the last update
+
+    def update(self, root, force=False, detect_changes=False):
+        # Bring the key of root, and everything under it, up to date.
+        # force: recompute everything. detect_changes: also catch changes
+        # nobody marked dirty, by comparing stored directory mtimes (this
+        # stats every directory, but no files).
+        root = os.path.abspath(root)
+        self.recomputed = 0
+        self.conn.execute("BEGIN")
+        try:
+            key, _ = self._dir_key(root, os.path.dirname(root), force, detect_changes)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return key
+
+    def key(self, path):
+        row = self._row(os.path.abspath(path))
+        return row and not row.dirty and row.key or None
+
+    def mark_dirty(self, path):
+        # Call when something at or under path changed. Marks the nearest
+        # directory indexed at or above path (for a new file or directory,
+        # the first ancestor that was there last time) and all its ancestors.
+        path = os.path.abspath(path)
+        while self._row(path) is None:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return # nothing above it indexed
+            path = parent
+        while True:
+            if self.conn.execute("UPDATE dir_key SET dirty = 1 WHERE path = ?",
+                                 (path,)).rowcount == 0:
+                break
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    def duplicates(self, min_bytes=0):
+        # Yield (key, bytes, [paths]) for every set of matching subtrees
+        cursor = self.conn.execute(
+            "SELECT key, bytes, path FROM dir_key WHERE dirty = 0 AND bytes >= ? AND key IN"
+            " (SELECT key FROM dir_key WHERE dirty = 0 GROUP BY key HAVING count(*) > 1)"
+            " ORDER BY bytes DESC, key, path", (min_bytes,))
+        current, size, paths = None, 0, []
+        for key, nbytes, path in cursor:
+            if key != current:
+                if paths:
+                    yield current, size, paths
+                current, size, paths = key, nbytes, []
+            paths.append(path)
+        if paths:
+            yield current, size, paths
+
+    def close(self):
+        self.conn.close()
+
+    def _row(self, path):
+        row = self.conn.execute(
+            "SELECT key, dirty, mtime_ns, bytes FROM dir_key WHERE path = ?", (path,)).fetchone()
+        return row and DirRow(*row)
+
+    def _dir_key(self, path, parent, force, detect):
+        # -> (key, bytes) of the directory at path
+        row = None if force else self._row(path)
+        if row is not None and not row.dirty:
+            if not detect:
+                return row.key, row.bytes
+            if os.lstat(path).st_mtime_ns == row.mtime_ns:
+                # Same entries here; the subdirectories might still have changed
+                if self._subdirs_unchanged(path):
+                    return row.key, row.bytes
+                detect = False # the subdirectories are up to date now
+        return self._compute(path, parent, force, detect)
+
+    def _subdirs_unchanged(self, path):
+        unchanged = True
+        children = self.conn.execute(
+            "SELECT path, key FROM dir_key WHERE parent = ?", (path,)).fetchall()
+        for child, key in children:
+            if self._dir_key(child, path, False, True)[0] != key:
+                unchanged = False
+        return unchanged
+
+    def _compute(self, path, parent, force, detect):
+        self.recomputed += 1
+        st = os.lstat(path)
+        entries = []
+        subdirs = set()
+        nbytes = 0
+        with os.scandir(path) as it:
+            children = sorted(it, key=lambda e: e.name)
+        for e in children:
+            name = os.fsencode(e.name)
+            if e.is_dir(follow_symlinks=False):
+                subdirs.add(e.path)
+                key, size = self._dir_key(e.path, path, force, detect)
+                kind = b'd'
+            elif e.is_file(follow_symlinks=False):
+                est = e.stat(follow_symlinks=False)
+                key, size = self.lj.key_from_path(e.path, est), est.st_size
+                kind = b'f'
+            elif e.is_symlink():
+                key, size = self.lj.h(os.fsencode(os.readlink(e.path))).digest(), 0
+                kind = b'l'
+            else:
+                key, size = b'', 0
+                kind = b'o'
+            nbytes += size
+            entries.append(kind + pack('>I', len(name)) + name + pack('>I', len(key)) + key)
+        hasher = self.lj.h()
+        for entry in entries:
+            hasher.update(entry)
+        key = hasher.digest()
+        self._forget_missing(path, subdirs)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO dir_key (path, parent, key, dirty, mtime_ns, bytes)"
+            " VALUES (?, ?, ?, 0, ?, ?)", (path, parent, key, st.st_mtime_ns, nbytes))
+        self._wrote()
+        return key, nbytes
+
+    def _forget_missing(self, path, subdirs):
+        # Drop rows for subdirectories of path that are gone, and all under them
+        gone = [child for (child,) in self.conn.execute(
+            "SELECT path FROM dir_key WHERE parent = ?", (path,)).fetchall()
+            if child not in subdirs]
+        for child in gone:
+            prefix = os.path.join(child, '')
+            self.conn.execute(
+                "DELETE FROM dir_key WHERE path = ? OR substr(path, 1, ?) = ?",
+                (child, len(prefix), prefix))
+
+    def _wrote(self):
+        # Commit in batches, so other processes aren't locked out for a whole walk
+        self._writes += 1
+        if self._writes >= self.batch:
+            self._writes = 0
+            self.conn.execute("COMMIT")
+            self.conn.execute("BEGIN")
@@ -0,0 +1,162 @@
+# ## Instrumentation
+# * Counters, and latency histograms per phase (hash, link, mkdir, lstat, walk, ...)
+# * Sinks get a snapshot at most every interval seconds: StatsSink keeps the
+#   latest, ProgressSink prints a line
+# * Disabled (NULL_METRICS, the default), a phase is a shared no-op context
+#   manager and a count is an empty call
+
+import sys
+import threading
+import time
+
+from contextlib import nullcontext
+
+
+class Histogram():
+    # Latencies in power-of-two buckets of nanoseconds
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, ns):
+        self.buckets[min(63, ns.bit_length())] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile, in seconds
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min(1 << i, self.max_ns) / 1e9
+        return self.max_ns / 1e9
+
+    def summary(self):
+        return {'count': self.count, 'total_s': self.total_ns / 1e9,
+                'mean_s': self.total_ns / self.count / 1e9 if self.count else 0.0,
+                'p50_s': self.quantile(0.5), 'p99_s': self.quantile(0.99),
+                'max_s': self.max_ns / 1e9}
+
+
+class _Phase():
+    __slots__ = ('metrics', 'name', 't0')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter_ns() - self.t0)
+
+
+class Metrics():
+    enabled = True
+
+    def __init__(self, sinks=(), interval=5.0):
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.counters = {}
+        self.phases = {}
+        self.t_start = time.monotonic()
+        self._t_emit = self.t_start
+        self._lock = threading.Lock()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def record(self, name, ns):
+        with self._lock:
+            h = self.phases.get(name)
+            if h is None:
+                h = self.phases[name] = Histogram()
+            h.add(ns)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def tick(self):
+        # Give the sinks a snapshot if the interval has passed
+        if self.sinks and time.monotonic() - self._t_emit >= self.interval:
+            self.emit()
+
+    def emit(self):
+        self._t_emit = time.monotonic()
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.emit(snapshot)
+
+    def snapshot(self):
+        with self._lock:
+            return {'elapsed_s': time.monotonic() - self.t_start,
+                    'counters': dict(self.counters),
+                    'phases': {name: h.summary() for name, h in self.phases.items()}}
+
+
+class _NullMetrics():
+    enabled = False
+    _null = nullcontext()
+
+    def phase(self, name):
+        return self._null
+
+    def record(self, name, ns):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def tick(self):
+        pass
+
+    def emit(self):
+        pass
+
+    def snapshot(self):
+        return {'elapsed_s': 0.0, 'counters': {}, 'phases': {}}
+
+
+NULL_METRICS = _NullMetrics()
+
+
+class StatsSink():
+    # Keeps the latest snapshot
+    def __init__(self):
+        self.last = None
+
+    def emit(self, snapshot):
+        self.last = snapshot
+
+
+class ProgressSink():
+    # One line per snapshot, such as
+    #   12.0s files 1500 (125/s) added 1200 linked 300 hashed 1.5 GB (125.0 MB/s)
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def emit(self, snapshot):
+        c = snapshot['counters']
+        t = snapshot['elapsed_s'] or 1e-9
+        parts = [f"{snapshot['elapsed_s']:.1f}s"]
+        if 'files' in c:
+            parts.append(f"files {c['files']} ({c['files'] / t:.0f}/s)")
+        for name in ('added', 'linked'):
+            if name in c:
+                parts.append(f"{name} {c[name]}")
+        if 'bytes_hashed' in c:
+            parts.append(f"hashed {c['bytes_hashed'] / 1e9:.1f} GB ({c['bytes_hashed'] / t / 1e6:.1f} MB/s)")
+        slowest = sorted(snapshot['phases'].items(), key=lambda kv: -kv[1]['total_s'])[:3]
+        if slowest:
+            parts.append("time in " + ", ".join(f"{n} {p['total_s']:.1f}s" for n, p in slowest))
+        print(" ".join(parts), file=self.stream, flush=True)
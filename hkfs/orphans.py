@@ -0,0 +1,84 @@
+# ## Find the orphan hash tree files
+# * In LJ's design every name in the human-readable tree is a hard link to a
+#   pile file, so a pile file with st_nlink == 1 is referenced from nowhere
+# * Stat only, no contents read; first-level fan-out directories are scanned
+#   in parallel
+# * Sweep removes orphans that have been orphans for a grace period (their
+#   ctime, which changes with the link count, is older than that), after
+#   checking each again just before removing it
+# * Not for FHK_CRD, whose files are never linked elsewhere
+
+import os
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .journal import DELETE
+from .pile import decode_key, leaf_dirs, scan_fanout_dir, top_dirs
+
+
+Orphan = namedtuple('Orphan', ['path', 'size', 'ino', 'ctime'])
+
+
+class OrphanReport():
+    def __init__(self):
+        self.orphans = []
+        self.files = 0 # pile files looked at
+        self.removed = [] # by a sweep, or that would be with dry_run
+
+    @property
+    def count(self):
+        return len(self.orphans)
+
+    @property
+    def bytes(self):
+        return sum(o.size for o in self.orphans)
+
+    @property
+    def removed_bytes(self):
+        return sum(o.size for o in self.removed)
+
+
+def _scan_top(top):
+    # -> (files looked at, [Orphan, ...]) under one first-level directory
+    files = 0
+    orphans = []
+    for leaf in leaf_dirs(top):
+        for e in scan_fanout_dir(leaf):
+            files += 1
+            st = e.stat(follow_symlinks=False)
+            if st.st_nlink == 1:
+                orphans.append(Orphan(e.path, st.st_size, st.st_ino, st.st_ctime))
+    return files, orphans
+
+def find_orphans(pile_directory, workers=8):
+    report = OrphanReport()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for files, orphans in pool.map(_scan_top, top_dirs(pile_directory)):
+            report.files += files
+            report.orphans.extend(orphans)
+    return report
+
+def sweep_orphans(pile_directory, grace_seconds=24 * 3600, dry_run=True, workers=8,
+                  journal=None):
+    # Remove orphans older than the grace period. With dry_run, only report
+    # what would go. Removals are recorded in journal, if given.
+    report = find_orphans(pile_directory, workers)
+    cutoff = time.time() - grace_seconds
+    for orphan in report.orphans:
+        if orphan.ctime > cutoff:
+            continue
+        try:
+            st = os.lstat(orphan.path)
+        except FileNotFoundError:
+            continue
+        # linked again since the scan, or replaced: leave it
+        if st.st_nlink != 1 or st.st_ino != orphan.ino or st.st_ctime > cutoff:
+            continue
+        if not dry_run:
+            os.remove(orphan.path)
+            if journal is not None:
+                journal.append(DELETE, decode_key(os.path.basename(orphan.path)))
+        report.removed.append(orphan)
+    return report
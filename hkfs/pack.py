@@ -0,0 +1,252 @@
+# ## Packed storage for small objects
+# * Small objects are appended to large segment files, instead of each
+#   taking a file (an inode, a block, an open per read)
+# * A record is a header (magic, key length, data length), the key, then the data,
+#   so a segment describes itself
+# * The index, key -> (segment, offset, length), is an sqlite table beside
+#   the segments; data is flushed to its segment before it is indexed
+# * Deletion drops the index entry and counts the record as dead in its
+#   segment; compact copies the live records out of mostly-dead segments,
+#   then removes them
+# * One writing process at a time; any number of readers
+
+import os
+import struct
+import threading
+
+from .db import connect
+
+
+_MAGIC = b'HKP1'
+_HEADER = struct.Struct('<4sBI')
+
+
+class PackStore():
+    def __init__(self, directory, segment_bytes=256 << 20):
+        self.d = str(directory)
+        self.segment_bytes = segment_bytes
+        os.makedirs(self.d, exist_ok=True)
+        self.index_path = os.path.join(self.d, 'index.db')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._fds = {} # segment -> fd for reading
+        self._out = None # (segment, file) being appended to
+        self.durable = False # fsync records before indexing them, and the index
+        self._conn()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.index_path)
+            conn.execute("CREATE TABLE IF NOT EXISTS objects ("
+                         " key BLOB PRIMARY KEY,"
+                         " segment INTEGER NOT NULL,"
+                         " offset INTEGER NOT NULL,"
+                         " length INTEGER NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS objects_segment ON objects (segment)")
+            conn.execute("CREATE TABLE IF NOT EXISTS segments ("
+                         " segment INTEGER PRIMARY KEY,"
+                         " dead INTEGER NOT NULL DEFAULT 0)")
+            self._local.conn = conn
+        if self.durable and not getattr(self._local, 'durable', False):
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.durable = True
+        return conn
+
+    def _segment_path(self, segment):
+        return os.path.join(self.d, f"{segment:08d}.pack")
+
+    def _writable(self, size):
+        # The segment file to append a record of size bytes to, and its number
+        if self._out is not None:
+            segment, f = self._out
+            if f.tell() == 0 or f.tell() + size <= self.segment_bytes:
+                return segment, f
+            f.close()
+        row = self._conn().execute("SELECT max(segment) FROM segments").fetchone()
+        segment = row[0] or 0
+        if not segment or os.path.getsize(self._segment_path(segment)) + size > self.segment_bytes:
+            segment += 1
+            self._conn().execute("INSERT INTO segments (segment) VALUES (?)", (segment,))
+        f = open(self._segment_path(segment), 'ab')
+        self._out = segment, f
+        return segment, f
+
+    def _append(self, key, data):
+        # Write a record; -> (segment, offset of the data). Caller holds the lock.
+        segment, f = self._writable(_HEADER.size + len(key) + len(data))
+        offset = f.tell()
+        f.write(_HEADER.pack(_MAGIC, len(key), len(data)))
+        f.write(key)
+        f.write(data)
+        return segment, offset + _HEADER.size + len(key)
+
+    def put(self, key, data):
+        # -> True if stored, False if the key was already here
+        return bool(self.put_many([(key, data)]))
+
+    def put_many(self, items):
+        # items: (key, data) pairs; one flush and one index transaction for
+        # them all. Returns the keys that were new.
+        with self._lock:
+            conn = self._conn()
+            rows = []
+            seen = set()
+            for key, data in items:
+                if key in seen or self.locate(key) is not None:
+                    continue
+                seen.add(key)
+                segment, offset = self._append(key, data)
+                rows.append((key, segment, offset, len(data)))
+            if not rows:
+                return []
+            self._out[1].flush()
+            if self.durable:
+                os.fsync(self._out[1].fileno())
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT INTO objects (key, segment, offset, length)"
+                                 " VALUES (?, ?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return [row[0] for row in rows]
+
+    def locate(self, key):
+        # (segment, offset, length) of key's data, or None
+        return self._conn().execute(
+            "SELECT segment, offset, length FROM objects WHERE key = ?", (key,)).fetchone()
+
+    def span(self, key):
+        # (segment file path, offset, length) of key's data, or None, for a
+        # reader doing its own I/O. Compaction may move it at any time.
+        loc = self.locate(key)
+        if loc is None:
+            return None
+        segment, offset, length = loc
+        return self._segment_path(segment), offset, length
+
+    def exists(self, key):
+        return self.locate(key) is not None
+
+    def __len__(self):
+        return self._conn().execute("SELECT count(*) FROM objects").fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self._conn().execute("SELECT key FROM objects")]
+
+    def _fd(self, segment):
+        fd = self._fds.get(segment)
+        if fd is None:
+            with self._lock:
+                fd = self._fds.get(segment)
+                if fd is None:
+                    fd = self._fds[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return fd
+
+    def get(self, key, offset=0, len=1<<31):
+        # Range read; KeyError if the key isn't here
+        loc = self.locate(key)
+        if loc is None:
+            raise KeyError(key)
+        segment, start, length = loc
+        n = max(0, min(len, length - offset))
+        return os.pread(self._fd(segment), n, start + offset) if n else b''
+
+    def read_into(self, key, buf, offset=0):
+        loc = self.locate(key)
+        if loc is None:
+            raise KeyError(key)
+        segment, start, length = loc
+        view = memoryview(buf).cast('B')
+        n = max(0, min(view.nbytes, length - offset))
+        total = 0
+        while total < n:
+            got = os.preadv(self._fd(segment), [view[total:n]], start + offset + total)
+            if got == 0:
+                break
+            total += got
+        return total
+
+    def delete(self, key):
+        # -> True if the key was here
+        with self._lock:
+            conn = self._conn()
+            loc = self.locate(key)
+            if loc is None:
+                return False
+            segment, _, length = loc
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM objects WHERE key = ?", (key,))
+                conn.execute("UPDATE segments SET dead = dead + ? WHERE segment = ?",
+                             (_HEADER.size + len(key) + length, segment))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return True
+
+    def sync(self):
+        # Make appended records durable
+        with self._lock:
+            if self._out is not None:
+                self._out[1].flush()
+                os.fsync(self._out[1].fileno())
+
+    def compact(self, min_dead_fraction=0.5):
+        # Rewrite the live records of segments at least min_dead_fraction
+        # dead, and remove those segments. Returns the bytes reclaimed.
+        reclaimed = 0
+        with self._lock:
+            conn = self._conn()
+            # never the segment being appended to
+            if self._out is not None:
+                current = self._out[0]
+            else:
+                current = conn.execute("SELECT max(segment) FROM segments").fetchone()[0]
+            for segment, dead in conn.execute(
+                    "SELECT segment, dead FROM segments WHERE dead > 0").fetchall():
+                if segment == current:
+                    continue
+                path = self._segment_path(segment)
+                size = os.path.getsize(path)
+                if dead < min_dead_fraction * size:
+                    continue
+                live = conn.execute("SELECT key, offset, length FROM objects"
+                                    " WHERE segment = ?", (segment,)).fetchall()
+                rows = []
+                with open(path, 'rb') as f:
+                    for key, offset, length in live:
+                        f.seek(offset)
+                        new_segment, new_offset = self._append(key, f.read(length))
+                        rows.append((new_segment, new_offset, key))
+                if self._out is not None:
+                    self._out[1].flush()
+                    os.fsync(self._out[1].fileno())
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany("UPDATE objects SET segment = ?, offset = ?"
+                                     " WHERE key = ?", rows)
+                    conn.execute("DELETE FROM segments WHERE segment = ?", (segment,))
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                fd = self._fds.pop(segment, None)
+                if fd is not None:
+                    os.close(fd)
+                os.remove(path)
+                reclaimed += size - sum(_HEADER.size + len(key) + length
+                                        for key, _, length in live)
+        return reclaimed
+
+    def close(self):
+        with self._lock:
+            if self._out is not None:
+                self._out[1].close()
+                self._out = None
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
@@ -0,0 +1,49 @@
+# ## Hash pile layout
+# * Files named by the urlsafe base64 of their key, without padding
+# * Two levels of fan-out directories, from the first four characters of the name
+# * Shared by LJ in lj.py and FHK_CRD in hkv.py
+
+import os
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+
+def encode_key(kb):
+    return urlsafe_b64encode(kb).rstrip(b'=').decode('ascii')
+
+def decode_key(name):
+    # Inverse of encode_key. Raises ValueError for names that aren't keys
+    if len(name) % 4 == 1:
+        raise ValueError(f"not an encoded key: {name!r}")
+    return urlsafe_b64decode(name + '=' * (-len(name) % 4))
+
+def fanout_dirs(directory):
+    # Yield the paths of the leaf fan-out directories, in sorted order
+    for top in top_dirs(directory):
+        yield from leaf_dirs(top)
+
+def top_dirs(directory):
+    # Paths of the first-level fan-out directories, sorted
+    directory = str(directory)
+    return [os.path.join(directory, name) for name in sorted(_subdirs(directory))]
+
+def leaf_dirs(top):
+    # Paths of the leaf fan-out directories under a first-level one, sorted
+    return [os.path.join(top, name) for name in sorted(_subdirs(top))]
+
+def _subdirs(directory):
+    with os.scandir(directory) as it:
+        return [e.name for e in it
+                if len(e.name) == 2 and e.is_dir(follow_symlinks=False)]
+
+def scan_fanout_dir(leaf):
+    # Yield os.DirEntry for each pile file in one leaf fan-out directory.
+    # Dot-names are temporaries, not pile entries.
+    with os.scandir(leaf) as it:
+        for e in it:
+            if not e.name.startswith('.') and e.is_file(follow_symlinks=False):
+                yield e
+
+def scan_pile(directory):
+    for leaf in fanout_dirs(directory):
+        yield from scan_fanout_dir(leaf)
@@ -0,0 +1,369 @@
+# ## Local read server for a hash pile
+# * So other processes read objects without knowing the pile's layout
+# * HTTP/1.1, over a Unix socket or localhost TCP: GET or HEAD /<encoded key>,
+#   with at most one Range: bytes=a-b, answered 200, 206, 404 or 416
+# * Contents go from the page cache to the socket by sendfile, without
+#   passing through Python; packed objects too, from their segment file
+# * Compressed objects (and any not yet placed) are decompressed and sent
+# * Open files are pooled, so a popular object costs no open per request
+# * asyncio for the connections; opens and decompression in threads
+# * Connections are kept alive until the client closes them or asks to
+
+import asyncio
+import os
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .compress import SUFFIX, CompressedReader
+from .hkv import FHK_CRD
+from .pile import decode_key, encode_key
+
+
+_REASONS = {200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 416: 'Range Not Satisfiable'}
+_MAX_HEADERS = 100
+_CHUNK = 1 << 20
+
+
+class FilePool():
+    # Open files by path. The least recently used idle ones are closed past
+    # max_open; a file in use is never closed under its user. A pooled file
+    # whose name is gone (its link count is 0) is not handed out again.
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        self._files = OrderedDict() # path -> file
+        self._users = {} # file -> users
+        self._lock = threading.Lock()
+        self.opened = 0 # files opened, for the curious
+
+    def acquire(self, path):
+        # (file, size); FileNotFoundError if there's no such file
+        with self._lock:
+            f = self._files.get(path)
+            if f is not None:
+                st = os.fstat(f.fileno())
+                if st.st_nlink:
+                    self._files.move_to_end(path)
+                    self._users[f] += 1
+                    return f, st.st_size
+                del self._files[path]
+                if not self._users[f]:
+                    del self._users[f]
+                    f.close()
+            f = open(path, 'rb')
+            self._files[path] = f
+            self._users[f] = 1
+            self.opened += 1
+            self._evict()
+            return f, os.fstat(f.fileno()).st_size
+
+    def release(self, f):
+        with self._lock:
+            if f not in self._users:
+                f.close() # the pool was closed meanwhile
+                return
+            self._users[f] -= 1
+            if not self._users[f] and self._files.get(f.name) is not f:
+                del self._users[f]
+                f.close()
+            self._evict()
+
+    def _evict(self):
+        excess = len(self._files) - self.max_open
+        for path, f in list(self._files.items()):
+            if excess <= 0:
+                break
+            if not self._users[f]:
+                del self._files[path]
+                del self._users[f]
+                f.close()
+                excess -= 1
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+            self._users.clear()
+
+
+class Unsatisfiable(Exception):
+    pass
+
+
+def parse_range(value, size):
+    # (start, end), end exclusive, for a Range header of contents of size
+    # bytes; None to send them all, as for a range we don't do (more than
+    # one, or other units). Unsatisfiable if it starts past the end.
+    unit, _, spec = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, dash, last = spec.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = size if not last else int(last) + 1
+            if last and end <= start:
+                return None # last before first: not a range at all
+        else:
+            start, end = size - int(last), size
+    except ValueError:
+        return None
+    start = max(0, start)
+    if start >= size:
+        raise Unsatisfiable(size)
+    return start, min(end, size)
+
+
+class PileServer():
+    # store: the FHK_CRD whose objects are served
+    def __init__(self, store, max_open=256, executor=None, max_workers=8):
+        self.store = store
+        self.files = FilePool(max_open)
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self._servers = []
+        self._clients = {} # writer -> task serving it
+        self.requests = 0 # for the curious
+        self.bytes_sent = 0
+
+    async def start_unix(self, path):
+        server = await asyncio.start_unix_server(self._client, path)
+        self._servers.append(server)
+        return server
+
+    async def start_tcp(self, host='127.0.0.1', port=0):
+        server = await asyncio.start_server(self._client, host, port)
+        self._servers.append(server)
+        return server
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+        tasks = list(self._clients.values())
+        for writer in list(self._clients):
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+        if self._own_executor:
+            self.executor.shutdown()
+        self.files.close()
+
+    async def _in_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _client(self, reader, writer):
+        self._clients[writer] = asyncio.current_task()
+        try:
+            while await self._request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+
+    async def _request(self, reader, writer):
+        # Answer one request; False when the connection is done with
+        try:
+            line = await reader.readline()
+            if not line:
+                return False
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if not header:
+                    return False
+                if header in (b'\r\n', b'\n'):
+                    break
+                name, sep, value = header.decode('latin-1').partition(':')
+                if not sep or len(headers) >= _MAX_HEADERS:
+                    await self._reply(writer, 400, keep=False)
+                    return False
+                headers[name.strip().lower()] = value.strip()
+        except ValueError: # a line past the reader's limit
+            await self._reply(writer, 400, keep=False)
+            return False
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            await self._reply(writer, 400, keep=False)
+            return False
+        method, target, version = parts
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep = connection == 'keep-alive'
+        else:
+            keep = connection != 'close'
+        if headers.get('content-length', '0') != '0' or 'transfer-encoding' in headers:
+            keep = False # a body we won't read
+        if method not in ('GET', 'HEAD'):
+            await self._reply(writer, 405, keep, [('Allow', 'GET, HEAD')])
+            return keep
+        self.requests += 1
+        try:
+            key = decode_key(target[1:]) if target.startswith('/') else b''
+        except ValueError:
+            key = b''
+        if len(key) < 4:
+            await self._reply(writer, 404, keep)
+        else:
+            await self._object(writer, key, method == 'HEAD', headers.get('range'), keep)
+        return keep
+
+    async def _reply(self, writer, status, keep, headers=(), body=b'', length=None):
+        lines = [f"HTTP/1.1 {status} {_REASONS[status]}"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        lines.append(f"Content-Length: {len(body) if length is None else length}")
+        if not keep:
+            lines.append("Connection: close")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def _object(self, writer, key, head_only, range_value, keep):
+        opened = await self._in_thread(self._open, key)
+        if opened is None:
+            await self._object_read(writer, key, head_only, range_value, keep)
+            return
+        f, base, size = opened
+        try:
+            span = await self._head(writer, key, size, range_value, keep)
+            if span and not head_only:
+                await self._sendfile(writer, f, base + span[0], span[1] - span[0])
+                self.bytes_sent += span[1] - span[0]
+        finally:
+            self.files.release(f)
+
+    async def _object_read(self, writer, key, head_only, range_value, keep):
+        # Contents sendfile can't send, read and sent a chunk at a time
+        reader = await self._in_thread(self._open_compressed, key)
+        if reader is not None:
+            size, read = reader.size, reader.read
+        else:
+            # not placed yet: rare, and read whole
+            try:
+                data = await self._in_thread(self.store.read, key)
+            except FileNotFoundError:
+                await self._reply(writer, 404, keep)
+                return
+            size, read = len(data), lambda offset, n: data[offset:offset + n]
+        try:
+            span = await self._head(writer, key, size, range_value, keep)
+            if span and not head_only:
+                start, end = span
+                while start < end:
+                    chunk = await self._in_thread(read, start, min(_CHUNK, end - start))
+                    writer.write(chunk)
+                    await writer.drain()
+                    start += len(chunk)
+                self.bytes_sent += span[1] - span[0]
+        finally:
+            if reader is not None:
+                os.close(reader.fd)
+
+    async def _head(self, writer, key, size, range_value, keep):
+        # Send the status line and headers; the (start, end) of the
+        # contents to follow, or None if none do
+        try:
+            span = parse_range(range_value, size) if range_value else None
+        except Unsatisfiable:
+            await self._reply(writer, 416, keep, [('Content-Range', f"bytes */{size}")])
+            return None
+        headers = [('Content-Type', 'application/octet-stream'),
+                   ('Accept-Ranges', 'bytes'),
+                   ('ETag', f'"{encode_key(key)}"')] # contents never change
+        if span:
+            headers.append(('Content-Range', f"bytes {span[0]}-{span[1] - 1}/{size}"))
+        start, end = span or (0, size)
+        await self._reply(writer, 206 if span else 200, keep, headers, length=end - start)
+        return (start, end) if end > start else None
+
+    async def _sendfile(self, writer, f, offset, count):
+        loop = asyncio.get_running_loop()
+        try:
+            sent = await loop.sendfile(writer.transport, f, offset, count, fallback=False)
+        except asyncio.SendfileNotAvailableError:
+            # Not on this transport. Copy by pread, which unlike the
+            # fallback doesn't move the shared file's position.
+            sent = 0
+            while sent < count:
+                chunk = await self._in_thread(os.pread, f.fileno(),
+                                              min(_CHUNK, count - sent), offset + sent)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+                sent += len(chunk)
+        if sent < count:
+            raise ConnectionResetError("contents shorter than they were")
+
+    def _open(self, key):
+        # (file, offset, size) of contents sendfile can send, from the pool,
+        # or None if they aren't in a plain or packed file
+        pack = self.store.pack
+        if pack is not None:
+            for _ in range(3):
+                span = pack.span(key)
+                if span is None:
+                    break
+                path, offset, size = span
+                try:
+                    f, _ = self.files.acquire(path)
+                except FileNotFoundError:
+                    continue # compacted away since; look again
+                return f, offset, size
+        try:
+            f, size = self.files.acquire(self._path(key))
+        except FileNotFoundError:
+            return None
+        return f, 0, size
+
+    def _open_compressed(self, key):
+        # A CompressedReader on key's compressed form, its fd for the caller
+        # to close, or None if there's none
+        try:
+            fd = os.open(self._path(key) + SUFFIX, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            return CompressedReader(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def _path(self, key):
+        name = encode_key(key)
+        return os.path.join(str(self.store.d), name[:2], name[2:4], name)
+
+
+def serve(directory, socket_path=None, host='127.0.0.1', port=8080, max_open=256):
+    # Serve the pile in directory until interrupted. The pack threshold is
+    # only so that packed objects are found.
+    packed = os.path.isdir(os.path.join(directory, '.pack'))
+    store = FHK_CRD(directory, pack_threshold=1 if packed else 0)
+
+    async def run():
+        server = PileServer(store, max_open)
+        if socket_path:
+            listening = await server.start_unix(socket_path)
+            where = socket_path
+        else:
+            listening = await server.start_tcp(host, port)
+            where = f"http://{host}:{listening.sockets[0].getsockname()[1]}"
+        print(f"serving {directory} on {where}", flush=True)
+        try:
+            await listening.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
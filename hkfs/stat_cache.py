@@ -0,0 +1,109 @@
+# ## Key from stat signature
+# * Remembers the key of a source file by (path, size, mtime_ns, ctime_ns, inode)
+# * Use: re-ingest of the same source trees without re-reading contents
+# * A lookup whose signature doesn't match drops the entry, unless told not
+#   to (a dry run changes nothing)
+# * Paranoid mode: a random sample of hits is reported as a miss, so the
+#   caller rehashes, and store() notes any key that disagrees
+
+import os
+import random
+import threading
+
+from .db import connect
+
+
+class StatCache():
+    def __init__(self, path, paranoia=0.0, seed=None):
+        self.path = str(path)
+        self.paranoia = paranoia # fraction of hits to rehash anyway
+        self.mismatches = [] # paths whose content changed under an unchanged signature
+        self._random = random.Random(seed)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conn()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect(self.path)
+            conn.execute("CREATE TABLE IF NOT EXISTS stat_key ("
+                         " path TEXT PRIMARY KEY,"
+                         " size INTEGER NOT NULL,"
+                         " mtime_ns INTEGER NOT NULL,"
+                         " ctime_ns INTEGER NOT NULL,"
+                         " ino INTEGER NOT NULL,"
+                         " key BLOB NOT NULL) WITHOUT ROWID")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _signature(st):
+        return st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino
+
+    def lookup(self, path, st, forget=True):
+        path = os.path.abspath(path)
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT size, mtime_ns, ctime_ns, ino, key FROM stat_key WHERE path = ?",
+            (path,)).fetchone()
+        if row is None:
+            return None
+        if tuple(row[:4]) != self._signature(st):
+            if forget:
+                conn.execute("DELETE FROM stat_key WHERE path = ?", (path,))
+            return None
+        if self.paranoia:
+            with self._lock:
+                sampled = self._random.random() < self.paranoia
+            if sampled:
+                return None
+        return row[4]
+
+    def store(self, path, st, key):
+        path = os.path.abspath(path)
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT size, mtime_ns, ctime_ns, ino, key FROM stat_key WHERE path = ?",
+            (path,)).fetchone()
+        if row is not None and tuple(row[:4]) == self._signature(st) and row[4] != key:
+            with self._lock:
+                self.mismatches.append(path)
+        conn.execute(
+            "INSERT OR REPLACE INTO stat_key (path, size, mtime_ns, ctime_ns, ino, key)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (path,) + self._signature(st) + (key,))
+
+    def forget(self, path):
+        self._conn().execute("DELETE FROM stat_key WHERE path = ?", (os.path.abspath(path),))
+
+    def prune(self, prefix=None):
+        # Drop entries whose path no longer matches its signature, under prefix if given
+        conn = self._conn()
+        if prefix is None:
+            rows = conn.execute("SELECT path, size, mtime_ns, ctime_ns, ino FROM stat_key")
+        else:
+            prefix = os.path.join(os.path.abspath(prefix), '')
+            rows = conn.execute(
+                "SELECT path, size, mtime_ns, ctime_ns, ino FROM stat_key"
+                " WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+        stale = []
+        for path, *signature in rows.fetchall():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stale.append((path,))
+                continue
+            if tuple(signature) != self._signature(st):
+                stale.append((path,))
+        conn.executemany("DELETE FROM stat_key WHERE path = ?", stale)
+        return len(stale)
+
+    def __len__(self):
+        return self._conn().execute("SELECT count(*) FROM stat_key").fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,180 @@
+# ## Verify hash corresponds to file path
+# * Rehashes every file in a pile (LJ's or FHK_CRD's layout) with a pool of
+#   threads, and checks its name against its contents
+# * Objects in FHK_CRD's packfiles are checked too, after the fan-out
+#   directories, as one more unit of work
+# * Progress is checkpointed per fan-out directory, so an interrupted run
+#   resumes where it stopped
+# * Optional cap on bytes read per second, to run alongside ingest
+# * Findings go to a JSON-lines report
+
+import json
+import lzma
+import os
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .compress import SUFFIX, CompressedReader
+from .pile import fanout_dirs, scan_fanout_dir
+
+
+class TokenBucket():
+    # Shared by threads: consume(n) returns once n bytes are allowed
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = 0.0
+        self.t = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+            self.t = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class _Throttled():
+    # A reader whose reads are paid for from a TokenBucket
+    def __init__(self, f, bucket):
+        self.f = f
+        self.bucket = bucket
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.bucket.consume(n)
+        return n
+
+    def read(self, n=-1):
+        b = self.f.read(n)
+        self.bucket.consume(len(b))
+        return b
+
+
+class Verifier():
+    def __init__(self, store, state_dir, workers=4, max_bytes_per_sec=None):
+        # store: an LJ or FHK_CRD, for its directory, hash and key encoding
+        self.store = store
+        self.state_dir = str(state_dir)
+        self.workers = workers
+        self.bucket = TokenBucket(max_bytes_per_sec) if max_bytes_per_sec else None
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.checkpoint_path = os.path.join(self.state_dir, 'verified')
+        self.report_path = os.path.join(self.state_dir, 'report.jsonl')
+
+    def done(self):
+        # The fan-out directories already verified, relative to the pile
+        try:
+            with open(self.checkpoint_path) as f:
+                return {line.rstrip('\n') for line in f if line.endswith('\n')}
+        except FileNotFoundError:
+            return set()
+
+    def reset(self):
+        for path in (self.checkpoint_path, self.report_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run(self, limit=None):
+        # Verify the fan-out directories not yet done; at most limit of them.
+        # Returns counts for this run.
+        base = str(self.store.d)
+        done = self.done()
+        units = [(leaf, self._verify_leaf) for leaf in fanout_dirs(base)]
+        if getattr(self.store, 'pack', None) is not None:
+            units.append((self.store.pack.d, self._verify_pack))
+        todo = ((leaf, fn) for leaf, fn in units
+                if os.path.relpath(leaf, base) not in done)
+        summary = {'dirs': 0, 'files': 0, 'bytes': 0, 'problems': 0}
+        with open(self.report_path, 'a') as report, \
+             open(self.checkpoint_path, 'a') as checkpoint, \
+             ThreadPoolExecutor(max_workers=self.workers) as pool:
+            window = []
+            def finish_one():
+                leaf, fut = window.pop(0)
+                files, nbytes, problems = fut.result()
+                for problem in problems:
+                    report.write(json.dumps(problem) + '\n')
+                report.flush()
+                os.fsync(report.fileno())
+                # only once its findings are safe is a directory marked done
+                checkpoint.write(os.path.relpath(leaf, base) + '\n')
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                summary['dirs'] += 1
+                summary['files'] += files
+                summary['bytes'] += nbytes
+                summary['problems'] += len(problems)
+            for n, (leaf, fn) in enumerate(todo):
+                if limit is not None and n >= limit:
+                    break
+                window.append((leaf, pool.submit(fn, leaf)))
+                if len(window) >= 2 * self.workers:
+                    finish_one()
+            while window:
+                finish_one()
+        return summary
+
+    def _verify_leaf(self, leaf):
+        # -> (files, bytes, [problem, ...]) for one fan-out directory
+        files = nbytes = 0
+        problems = []
+        prefix = os.path.basename(os.path.dirname(leaf)) + os.path.basename(leaf)
+        for e in scan_fanout_dir(leaf):
+            files += 1
+            name = e.name
+            try:
+                with open(e.path, 'rb') as f:
+                    if name.endswith(SUFFIX):
+                        # compressed: the key is of the decompressed contents
+                        name = name[:-len(SUFFIX)]
+                        cr = CompressedReader(f.fileno())
+                        nbytes += cr.size
+                        reader = cr.stream()
+                    else:
+                        nbytes += os.fstat(f.fileno()).st_size
+                        reader = f
+                    if self.bucket is not None:
+                        reader = _Throttled(reader, self.bucket)
+                    digest = self.store.file_hasher.hash_file(reader)
+            except (OSError, ValueError, zlib.error, lzma.LZMAError) as ex:
+                problems.append({'path': e.path, 'problem': 'unreadable', 'error': str(ex)})
+                continue
+            actual = self.store._encode_key(digest)
+            if actual != name:
+                problems.append({'path': e.path, 'problem': 'mismatch', 'actual': actual})
+            elif not name.startswith(prefix):
+                problems.append({'path': e.path, 'problem': 'misplaced'})
+        return files, nbytes, problems
+
+    def _verify_pack(self, pack_dir):
+        # -> (objects, bytes, [problem, ...]) for the packed objects
+        pack = self.store.pack
+        objects = nbytes = 0
+        problems = []
+        for key in pack.keys():
+            name = self.store._encode_key(key)
+            try:
+                data = pack.get(key)
+            except KeyError:
+                continue # deleted meanwhile
+            except OSError as ex:
+                problems.append({'path': pack_dir, 'key': name, 'problem': 'unreadable',
+                                 'error': str(ex)})
+                continue
+            objects += 1
+            nbytes += len(data)
+            if self.bucket is not None:
+                self.bucket.consume(len(data))
+            actual = self.store._encode_key(self.store.key(data))
+            if actual != name:
+                problems.append({'path': pack_dir, 'key': name, 'problem': 'mismatch',
+                                 'actual': actual})
+        return objects, nbytes, problems
@@ -1,41 +1,218 @@
 # link juggler
 
 import os
+import tarfile
+import tempfile
 
 from base64 import urlsafe_b64encode
 from blake3 import blake3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import count
 from pathlib import Path
 
+from hkfs.dirfd import DirFds
+from hkfs.durability import Durability, NONE
+from hkfs.hashing import FileHasher
+from hkfs.journal import ADD, LINK
+from hkfs.metrics import NULL_METRICS
+from hkfs.physorder import ORDERS, advise_done, advise_reading, ordered_files
+
 
 class LJ():
-    def __init__(self, directory, post_assimilation=lambda name, sk: True):
+    def __init__(self, directory, post_assimilation=lambda name, sk: True, workers=1,
+                 inode_index=None, stat_cache=None, dir_fds=False, metrics=None,
+                 journal=None, key_filter=None, durability=NONE, order='walk',
+                 fadvise=False):
         self.d = Path(directory)
         #self.dh = os.open(str(Path(directory)), os.O_RDONLY)
         self.post_assimilation = post_assimilation
         self.h = blake3
         self.buf_len = 1<<20
+        self.file_hasher = FileHasher(self.h, buf_len=self.buf_len)
+        self.workers = workers # hashing threads for assimilate_tree
+        self.max_in_flight_per_worker = 4
+        self.inode_index = inode_index # optional hkfs.inode_index.InodeIndex
+        self.stat_cache = stat_cache # optional hkfs.stat_cache.StatCache
+        # Keep the fan-out directories open and work relative to them
+        self.dir_fds = DirFds(self.d) if dir_fds else None
+        self.metrics = metrics or NULL_METRICS # optional hkfs.metrics.Metrics
+        self.journal = journal # optional hkfs.journal.Journal, of adds and links
+        self.key_filter = key_filter # optional hkfs.keyfilter.KeyFilter
+        self._tmp_seq = count()
+        # 'none', 'object' or 'group', or an hkfs.durability.Durability
+        if isinstance(durability, str):
+            durability = Durability(durability)
+        self.durability = durability
+        # assimilate_tree visits files in os.walk order, or in physical order
+        # ('inode' or 'extent', see hkfs.physorder), order_batch at a time;
+        # post_assimilation sees them in that order
+        if order not in ORDERS:
+            raise ValueError(f"order must be one of {ORDERS}, not {order!r}")
+        self.order = order
+        self.order_batch = 10000
+        self.fadvise = fadvise # page cache hints around hashing a file
+
+    def close(self):
+        self.flush()
+        if self.dir_fds is not None:
+            self.dir_fds.close()
+
+    def flush(self):
+        # Sync the directories changed since the last group commit
+        if self.durability.level != NONE:
+            self.durability.sync_dirs()
 
     def _assimilate(self, f):
-        key = self.key_from_file(f)
-        hashdir_path, hashfile_path = self._dir_and_path_from_key(key)
-        real_f_path = os.path.realpath(f.name) # FIXME: is this necessary?
-        hashfile_path_str = str(hashfile_path)
-        if hashfile_path.exists():
-            # replace f with link
-            # TODO: make safer
-            os.remove(f.name)
-            os.link(hashfile_path_str, real_f_path)
-            what = "linked"
-        else:
-            hashdir_path.mkdir(parents=True, exist_ok=True)
-            # link f into hash pile
-            os.link(f.name, str(hashfile_path))
-            #return f"linked {f.name} to {hashfile_path}"
-            what = "added"
-        status = os.lstat(hashfile_path_str)
+        st = os.fstat(f.fileno())
+        known = self._indexed_result(st)
+        if known is not None:
+            return self._done(known)
+        key = None
+        if self.stat_cache is not None:
+            key = self.stat_cache.lookup(f.name, st)
+        if key is None:
+            key = self.key_from_file(f)
+        return self._done(self._link_in(f.name, key, st))
+
+    def _done(self, result):
+        m = self.metrics
+        m.count('files')
+        m.count(result[0])
+        m.tick()
+        return result
+
+    def _indexed_result(self, st):
+        # If the inode index says st is already in the pile, and the pile
+        # agrees, there is nothing to hash and nothing to link
+        if self.inode_index is None:
+            return None
+        with self.metrics.phase('index'):
+            key = self.inode_index.get(st.st_dev, st.st_ino)
+        if key is None:
+            return None
+        status = self._pile_lstat(key)
+        if status is None or not os.path.samestat(status, st):
+            # stale: the inode number has been reused, or the pile entry is gone
+            self.inode_index.delete(st.st_dev, st.st_ino)
+            return None
+        self.metrics.count('index_hits')
+        return "linked", key, st.st_ino
+
+    def _link_in(self, name, key, st=None):
+        # Put the file called name, whose contents hash to key, into the pile.
+        # st, if given, is the stat of the file, to spot one that's already in.
+        # Other processes may be ingesting into the same pile, and the same
+        # trees: an entry can appear (another ingester added it) or go (an
+        # orphan sweep) between any two steps. Each step is a single link or
+        # rename that either happens or doesn't, and the name is never
+        # without contents.
+        m = self.metrics
+        real_f_path = os.path.realpath(name) # FIXME: is this necessary?
+        with self._pile_entry(key) as (dir_fd, entry):
+            status = None
+            # a key filter's "no" saves looking
+            if self.key_filter is None or key in self.key_filter:
+                try:
+                    with m.phase('lstat'):
+                        status = os.lstat(entry, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    pass
+            while True:
+                what = None
+                if status is None:
+                    if dir_fd is None:
+                        with m.phase('mkdir'):
+                            os.makedirs(os.path.dirname(entry), exist_ok=True)
+                    # link f into hash pile
+                    try:
+                        with m.phase('link'):
+                            os.link(name, entry, dst_dir_fd=dir_fd)
+                        what = "added"
+                    except FileExistsError:
+                        pass # put there by another writer
+                    try:
+                        with m.phase('lstat'):
+                            status = os.lstat(entry, dir_fd=dir_fd)
+                    except FileNotFoundError:
+                        continue # and gone again
+                changed = True
+                if what is None:
+                    if st is None or not os.path.samestat(status, st):
+                        # replace f with a link to the pile entry
+                        try:
+                            with m.phase('link'):
+                                self._link_over(entry, real_f_path, src_dir_fd=dir_fd)
+                        except FileNotFoundError:
+                            status = None # the entry went; put f there instead
+                            continue
+                    else:
+                        changed = False
+                    what = "linked"
+                break
+        if changed:
+            self._changed(entry if what == "added" else real_f_path)
+        if self.key_filter is not None:
+            self.key_filter.add(key)
         inode = status.st_ino
+        if self.inode_index is not None:
+            self.inode_index.put(status.st_dev, inode, key)
+        if changed and self.stat_cache is not None:
+            # linking changes ctime, and maybe the inode, of the name
+            self.stat_cache.store(name, os.stat(name), key)
+        if changed and self.journal is not None:
+            self.journal.append(ADD if what == "added" else LINK, key)
         return what, key, inode
 
+    def _changed(self, path):
+        # A name has been added or replaced at path
+        d = self.durability
+        if d.level == NONE:
+            return
+        parent = os.path.dirname(path)
+        if self.dir_fds is not None and not os.path.isabs(path):
+            parent = os.path.join(str(self.d), path[:2], path[2:4]) # a pile entry
+        if parent.startswith(str(self.d)):
+            d.changed(parent, str(self.d))
+        else:
+            d.changed(parent, parent)
+        if d.op():
+            d.sync_dirs()
+
+    @contextmanager
+    def _pile_entry(self, key):
+        # (dir_fd, entry) naming the pile entry for key, for os calls that
+        # take dir_fd. Without dir fds, dir_fd is None and entry a full path.
+        # With them, the fan-out directory is made if need be.
+        if self.dir_fds is None:
+            yield None, str(self._path_from_key(key))
+            return
+        encoded_key = self._encode_key(key)
+        with self.metrics.phase('dirfd'):
+            fd = self.dir_fds.acquire(encoded_key, create=True)
+        try:
+            yield fd, encoded_key
+        finally:
+            self.dir_fds.release(encoded_key)
+
+    def _pile_lstat(self, key):
+        # lstat of the pile entry for key, or None if there's none
+        with self.metrics.phase('lstat'):
+            return self._pile_lstat_untimed(key)
+
+    def _pile_lstat_untimed(self, key):
+        try:
+            if self.dir_fds is None:
+                return os.lstat(self._path_from_key(key))
+            encoded_key = self._encode_key(key)
+            with self.dir_fds.leaf(encoded_key) as fd:
+                if fd is None:
+                    return None
+                return os.lstat(encoded_key, dir_fd=fd)
+        except FileNotFoundError:
+            return None
+
     def assimilate(self, f):
         return self._assimilate(f)[0]
 
@@ -43,15 +220,22 @@ class LJ():
         return self._assimilate(f)[1]
 
     def exists(self, key):
-        return self._path_from_key(key).exists()
+        kf = self.key_filter
+        if kf is not None and kf.authoritative and key not in kf:
+            return False
+        if self.dir_fds is None:
+            return self._path_from_key(key).exists()
+        return self._pile_lstat(key) is not None
 
     def key_from_file(self, f):
-        hasher = self.h()
-        buf = f.read(self.buf_len)
-        while buf:
-            hasher.update(buf)
-            buf = f.read(self.buf_len)
-        return hasher.digest()
+        m = self.metrics
+        if not m.enabled:
+            return self.file_hasher.hash_file(f)
+        pos = f.tell()
+        with m.phase('hash'):
+            key = self.file_hasher.hash_file(f)
+        m.count('bytes_hashed', f.tell() - pos)
+        return key
 
     def _encode_key(self, kb):
         return urlsafe_b64encode(kb).rstrip(b'=').decode('ascii')
@@ -69,10 +253,274 @@ class LJ():
         _, rv = self._dir_and_path_from_key(key)
         return rv
 
-    def assimilate_tree(self, dirname):
-        paf = self.post_assimilation
-        for root, dirs, files in os.walk(dirname):
+    def key_from_path(self, path, st=None):
+        # With an inode index or a stat cache, a file may not need opening
+        if self.inode_index is not None:
+            if st is None:
+                st = os.stat(path)
+            known = self._indexed_result(st)
+            if known is not None:
+                return known[1]
+        return self._hash_path(path, st)
+
+    def _hash_path(self, path, st=None):
+        # With a stat cache, a file whose signature is unchanged isn't opened
+        if self.stat_cache is None:
+            with open(path, 'rb') as f:
+                return self._key_from_opened(f)
+        if st is None:
+            st = os.stat(path)
+        key = self.stat_cache.lookup(path, st)
+        if key is None:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                key = self._key_from_opened(f)
+            self.stat_cache.store(path, st, key)
+        return key
+
+    def _key_from_opened(self, f):
+        if not self.fadvise:
+            return self.key_from_file(f)
+        advise_reading(f.fileno())
+        try:
+            return self.key_from_file(f)
+        finally:
+            advise_done(f.fileno())
+
+    def _walk_files(self, dirname):
+        if self.order != 'walk':
+            it = ordered_files(dirname, self.order, self.order_batch)
+            while True:
+                with self.metrics.phase('walk'):
+                    path = next(it, None)
+                if path is None:
+                    return
+                yield path
+        walker = os.walk(dirname)
+        while True:
+            with self.metrics.phase('walk'):
+                try:
+                    root, dirs, files = next(walker)
+                except StopIteration:
+                    return
             directory = Path(root)
             for name in files:
-                with open(directory / name, 'rb') as f:
-                    paf(name, self._assimilate(f))
+                yield directory / name
+
+    def assimilate_tree(self, dirname, workers=None):
+        if workers is None:
+            workers = self.workers
+        if workers > 1:
+            self._assimilate_tree_parallel(dirname, workers)
+        else:
+            self._assimilate_tree_serial(dirname)
+        # the last group's directories now, not whenever the next operation comes
+        self.flush()
+
+    def _assimilate_tree_serial(self, dirname):
+        paf = self.post_assimilation
+        seen = {} # (st_dev, st_ino) -> key, for hard-link groups in this walk
+        for path in self._walk_files(dirname):
+            with self.metrics.phase('stat'):
+                st = os.stat(path)
+            ident = st.st_dev, st.st_ino
+            result = self._indexed_result(st)
+            if result is None:
+                key = seen.get(ident)
+                if key is None:
+                    key = self._hash_path(path, st)
+                result = self._link_in(str(path), key, st)
+            if st.st_nlink > 1:
+                seen[ident] = result[1]
+            paf(path.name, self._done(result))
+
+    def _assimilate_tree_parallel(self, dirname, workers):
+        # Hashing runs in a pool of threads (blake3 releases the GIL), while
+        # the link/mkdir step stays here, one file at a time in walk order,
+        # so post_assimilation sees the same sequence as the serial walk.
+        paf = self.post_assimilation
+        max_in_flight = workers * self.max_in_flight_per_worker
+        window = deque()
+        seen = {} # (st_dev, st_ino) -> Future of key, for hard-link groups
+
+        def finish_one():
+            path, st, fut, result = window.popleft()
+            if result is None:
+                result = self._link_in(str(path), fut.result(), st)
+            paf(path.name, self._done(result))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                for path in self._walk_files(dirname):
+                    with self.metrics.phase('stat'):
+                        st = os.stat(path)
+                    ident = st.st_dev, st.st_ino
+                    fut = None
+                    result = self._indexed_result(st)
+                    if result is None:
+                        fut = seen.get(ident)
+                        if fut is None:
+                            fut = pool.submit(self._hash_path, path, st)
+                            if st.st_nlink > 1:
+                                seen[ident] = fut
+                    window.append((path, st, fut, result))
+                    if len(window) >= max_in_flight:
+                        finish_one()
+                while window:
+                    finish_one()
+            except BaseException:
+                for _, _, fut, _ in window:
+                    if fut is not None:
+                        fut.cancel()
+                raise
+
+    def assimilate_tar(self, source, dirname):
+        # Ingest a tar archive, read once as a stream, into the pile and a
+        # human-readable tree at dirname. source is a path or a file object,
+        # which need not be seekable. Each file's contents are hashed while
+        # being spooled to a temporary in the pile directory, so no scratch
+        # space is used outside the pile.
+        paf = self.post_assimilation
+        root = os.path.realpath(dirname)
+        os.makedirs(root, exist_ok=True)
+        directories = []
+        keys = {} # dest -> key, of the files ingested, for hard links to them
+        if isinstance(source, (str, os.PathLike)):
+            tf = tarfile.open(source, mode='r|*')
+        else:
+            tf = tarfile.open(fileobj=source, mode='r|*')
+        with tf:
+            for member in tf:
+                dest = self._tar_dest(root, member.name)
+                if member.isdir():
+                    if os.path.islink(dest):
+                        # its metadata would be set on wherever that points
+                        raise ValueError(f"tar directory over a symlink: {member.name!r}")
+                    os.makedirs(dest, exist_ok=True)
+                    directories.append((dest, member))
+                elif member.isfile():
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    with tf.extractfile(member) as src:
+                        result = self._spool_in(src, member)
+                    self._replace_with_link(self._path_from_key(result[1]), dest)
+                    keys[dest] = result[1]
+                    paf(os.path.basename(dest), self._done(result))
+                elif member.issym():
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    if os.path.lexists(dest):
+                        os.remove(dest)
+                    keys.pop(dest, None)
+                    os.symlink(member.linkname, dest)
+                elif member.islnk():
+                    # a hard link to an earlier member, which is in the pile by now
+                    target = self._tar_dest(root, member.linkname)
+                    self._replace_with_link(target, dest)
+                    key = keys.get(target)
+                    if key is None:
+                        key = self.key_from_path(target) # not one of ours
+                    keys[dest] = key
+                    paf(os.path.basename(dest), self._done(("linked", key, os.lstat(dest).st_ino)))
+                # devices and fifos have no contents to keep; they are skipped
+        # Directory metadata last, since filling them changes their mtimes
+        for dest, member in reversed(directories):
+            self._set_tar_metadata(dest, member)
+        self.flush()
+
+    def _tar_dest(self, root, name):
+        # Where member name goes under root, refusing to go outside it
+        parent, base = os.path.split(os.path.normpath(name.lstrip('/')))
+        parent = os.path.realpath(os.path.join(root, parent))
+        if os.path.commonpath([root, parent]) != root or base == '..':
+            raise ValueError(f"tar member outside the destination: {name!r}")
+        if base in ('', '.'):
+            return parent
+        return os.path.join(parent, base)
+
+    def _replace_with_link(self, target, dest):
+        # As tar does, a later member of the same name replaces an earlier one
+        self._link_over(target, dest)
+        self._changed(dest)
+
+    def _link_over(self, target, dest, src_dir_fd=None):
+        # Make dest a link to target by linking a temporary name beside dest,
+        # then renaming that over dest, so dest is never missing, and is left
+        # as it was if anything fails
+        tmp = os.path.join(os.path.dirname(dest),
+                           f".hkfs-tmp-{os.getpid()}-{next(self._tmp_seq)}")
+        os.link(target, tmp, src_dir_fd=src_dir_fd)
+        try:
+            os.rename(tmp, dest)
+        finally:
+            # rename does nothing if both are already links to the same file
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+
+    def _spool_in(self, src, member):
+        # Copy src into a temporary in the pile, hashing as it goes, then
+        # move it into place or drop it if its key is already there
+        fd, tmp = tempfile.mkstemp(dir=self.d, prefix='.tmp-')
+        try:
+            with open(fd, 'wb') as out, self.metrics.phase('hash'):
+                key = self.file_hasher.copy_file(src, out, member.size)
+                out.flush()
+                self.durability.sync_file(out.fileno()) # new contents, before they're named
+            self.metrics.count('bytes_hashed', member.size)
+            hashdir_path, hashfile_path = self._dir_and_path_from_key(key)
+            what = "linked"
+            if (self.key_filter is None or key in self.key_filter) and hashfile_path.exists():
+                os.remove(tmp)
+            else:
+                self._set_tar_metadata(tmp, member)
+                hashdir_path.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(tmp, hashfile_path)
+                    what = "added"
+                except FileExistsError:
+                    pass # there after all
+                os.remove(tmp)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        status = os.lstat(hashfile_path)
+        if self.inode_index is not None:
+            self.inode_index.put(status.st_dev, status.st_ino, key)
+        if self.key_filter is not None:
+            self.key_filter.add(key)
+        if what == "added":
+            self._changed(str(hashfile_path))
+        if self.journal is not None:
+            self.journal.append(ADD if what == "added" else LINK, key)
+        return what, key, status.st_ino
+
+    def _set_tar_metadata(self, path, member):
+        if os.geteuid() == 0:
+            try:
+                os.chown(path, member.uid, member.gid)
+            except OSError:
+                pass
+        os.chmod(path, member.mode & 0o7777)
+        os.utime(path, (member.mtime, member.mtime))
+
+
+def _ingest_tree(directory, tree, workers):
+    counts = {"added": 0, "linked": 0}
+    def count_one(name, result):
+        counts[result[0]] += 1
+    lj = LJ(directory, post_assimilation=count_one, workers=workers)
+    try:
+        lj.assimilate_tree(tree)
+    finally:
+        lj.close()
+    return counts
+
+def ingest_trees(directory, trees, processes=None, workers=1):
+    # Assimilate several source trees into the pile at directory at once,
+    # one process per tree, up to processes at a time (default: one per
+    # CPU), each with workers hashing threads. Returns {tree: {"added": n,
+    # "linked": n}}.
+    trees = list(trees)
+    processes = processes or max(1, min(len(trees), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(_ingest_tree, str(directory), str(tree), workers) for tree in trees]
+        return {tree: fut.result() for tree, fut in zip(trees, futures)}
@@ -0,0 +1,6 @@
+import pytest
+
+
+@pytest.fixture
+def tmpdirname(tmp_path):
+    return str(tmp_path)
@@ -8,7 +8,7 @@ from base64 import urlsafe_b64decode
 from blake3 import blake3
 from pathlib import Path
 
-from lj import LJ
+from lj import LJ, ingest_trees
 
 def test_LJ_create():
     # create an LJ
@@ -170,3 +170,216 @@ def test_LJ_assimilate_tree_log():
                 [('t.1', '04e0bb39f30b1a3feb89f536c93be15055482df748674b00d26e5a75777702e9'),
                  ('t.2', 'f2e897eed7d206cd855d441598fa521abc75aa96953e97c030c9612c30c1293d'),
                  ('t.3', '04e0bb39f30b1a3feb89f536c93be15055482df748674b00d26e5a75777702e9')]
+
+def test_LJ_assimilate_tree_parallel():
+    contents_by_relpath = {"t.1": "foo", "t.2": "bar", "t.3": "foo",
+                           "a/t.4": "baz", "a/t.5": "foo", "a/b/t.6": "bar",
+                           "c/t.7": "qux"}
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as hashdirname:
+        results = []
+        def record_result(name, res):
+            results.append((name, res[0], res[1]))
+        lj = LJ(hashdirname, record_result, workers=4)
+
+        with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+            for relpath, contents in contents_by_relpath.items():
+                p = Path(tmpdirname) / relpath
+                p.parent.mkdir(parents=True, exist_ok=True)
+                p.write_text(contents)
+            walk_order = [p.name for p in lj._walk_files(tmpdirname)]
+
+            lj.assimilate_tree(tmpdirname)
+
+            # results arrive in walk order, and added/linked are as if serial
+            assert [r[0] for r in results] == walk_order
+            assert [r[1] for r in results].count("added") == 4
+            assert [r[1] for r in results].count("linked") == 3
+            assert len({r[2] for r in results}) == 4
+            for relpath in contents_by_relpath:
+                p = Path(tmpdirname) / relpath
+                assert os.lstat(p).st_ino == os.lstat(lj._path_from_key(lj.key_from_path(p))).st_ino
+
+def make_tar(members, mtime=1_000_000_000):
+    # members: list of (name, contents) for files, (name, None) for dirs,
+    # (name, ("sym", target)) or (name, ("lnk", target)) for links
+    import io
+    import tarfile
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tf:
+        for name, contents in members:
+            ti = tarfile.TarInfo(name)
+            ti.mtime = mtime
+            if contents is None:
+                ti.type = tarfile.DIRTYPE
+                ti.mode = 0o755
+                tf.addfile(ti)
+            elif isinstance(contents, tuple):
+                ti.type = tarfile.SYMTYPE if contents[0] == "sym" else tarfile.LNKTYPE
+                ti.linkname = contents[1]
+                tf.addfile(ti)
+            else:
+                ti.size = len(contents)
+                ti.mode = 0o640
+                tf.addfile(ti, io.BytesIO(contents))
+    return buf.getvalue()
+
+class Unseekable():
+    def __init__(self, data):
+        import io
+        self.f = io.BytesIO(data)
+    def read(self, n=-1):
+        return self.f.read(n)
+
+def test_LJ_assimilate_tar():
+    members = [("top", None), ("top/t.1", b"foo"), ("top/t.2", b"bar"),
+               ("top/sub/t.3", b"foo"), ("top/sub/t.4", b"new"),
+               ("top/sym", ("sym", "t.1")), ("top/hard", ("lnk", "top/t.2"))]
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        pile = Path(tmpdirname) / "pile"
+        pile.mkdir()
+        results = []
+        lj = LJ(pile, lambda name, res: results.append((name, res[0])))
+        # "new" is already in the pile
+        (Path(tmpdirname) / "n").write_bytes(b"new")
+        with open(Path(tmpdirname) / "n", 'rb') as f:
+            lj.assimilate(f)
+        results.clear()
+
+        dest = Path(tmpdirname) / "out"
+        hashed = []
+        key_from_path = lj.key_from_path
+        lj.key_from_path = lambda p: hashed.append(p) or key_from_path(p)
+        lj.assimilate_tar(Unseekable(make_tar(members)), dest)
+        del lj.key_from_path
+        # the hard link's key is remembered, not hashed again
+        assert hashed == []
+
+        assert results == [("t.1", "added"), ("t.2", "added"), ("t.3", "linked"),
+                           ("t.4", "linked"), ("hard", "linked")]
+        assert (dest / "top/sub/t.3").read_bytes() == b"foo"
+        assert os.readlink(dest / "top/sym") == "t.1"
+        assert os.path.samefile(dest / "top/t.1", dest / "top/sub/t.3")
+        assert os.path.samefile(dest / "top/t.2", dest / "top/hard")
+        assert os.path.samefile(dest / "top/sub/t.4", Path(tmpdirname) / "n")
+        assert os.path.samefile(dest / "top/t.1", lj._path_from_key(lj.key_from_path(dest / "top/t.1")))
+        st = os.lstat(dest / "top/t.1")
+        assert st.st_mtime == 1_000_000_000
+        assert stat.S_IMODE(st.st_mode) == 0o640
+        assert os.lstat(dest / "top").st_mtime == 1_000_000_000
+        # no temporaries left in the pile
+        assert [p for p in pile.iterdir() if p.name.startswith('.')] == []
+
+def test_LJ_assimilate_tar_refuses_escape():
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        lj = LJ(tmpdirname)
+        tarpath = Path(tmpdirname) / "evil.tar"
+        tarpath.write_bytes(make_tar([("../escaped", b"foo")]))
+        with pytest.raises(ValueError):
+            lj.assimilate_tar(tarpath, Path(tmpdirname) / "out")
+        assert not (Path(tmpdirname) / "escaped").exists()
+
+def test_LJ_assimilate_tar_refuses_directory_over_symlink():
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        outside = Path(tmpdirname) / "outside"
+        outside.mkdir(mode=0o700)
+        lj = LJ(tmpdirname)
+        tarpath = Path(tmpdirname) / "evil.tar"
+        tarpath.write_bytes(make_tar([("top", ("sym", str(outside))), ("top", None)]))
+        with pytest.raises(ValueError):
+            lj.assimilate_tar(tarpath, Path(tmpdirname) / "out")
+        assert stat.S_IMODE(os.stat(outside).st_mode) == 0o700
+
+def test_LJ_dir_fds():
+    contents_by_filename = {"t.1": "foo", "t.2": "bar", "t.3": "foo"}
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as hashdirname:
+        results = []
+        lj = LJ(hashdirname, lambda name, res: results.append((name, res[0])), dir_fds=True)
+        with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+            for fname, contents in contents_by_filename.items():
+                with open(os.path.join(tmpdirname, fname), 'w') as f:
+                    f.write(contents)
+            lj.assimilate_tree(tmpdirname)
+            assert sorted(r[1] for r in results) == ["added", "added", "linked"]
+            k = lj.key_from_path(os.path.join(tmpdirname, "t.1"))
+            assert lj.exists(k)
+            assert not lj.exists(b"\0" * 32)
+            assert os.path.samefile(lj._path_from_key(k), os.path.join(tmpdirname, "t.3"))
+        lj.close()
+
+def test_LJ_ingest_trees():
+    # Several processes ingest overlapping trees into one pile at once
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        pile = os.path.join(tmpdirname, "pile")
+        os.mkdir(pile)
+        trees = []
+        for t in range(4):
+            tree = Path(tmpdirname) / f"tree{t}"
+            for i in range(50):
+                p = tree / f"d{i % 5}" / f"shared.{i}"
+                p.parent.mkdir(parents=True, exist_ok=True)
+                p.write_text(f"shared {i}")
+                (tree / f"own.{i}").write_text(f"tree {t} file {i}")
+            trees.append(tree)
+        results = ingest_trees(pile, trees, processes=4)
+        assert sum(r["added"] for r in results.values()) == 50 + 4 * 50
+        assert sum(r["linked"] for r in results.values()) == 3 * 50
+        lj = LJ(pile)
+        for t, tree in enumerate(trees):
+            for i in range(50):
+                p = tree / f"d{i % 5}" / f"shared.{i}"
+                assert p.read_text() == f"shared {i}"
+                assert os.path.samefile(p, lj._path_from_key(lj.key_from_path(p)))
+                assert (tree / f"own.{i}").read_text() == f"tree {t} file {i}"
+        # no temporaries left behind
+        assert not [n for tree in trees for _, _, names in os.walk(tree)
+                    for n in names if n.startswith(".hkfs-tmp-")]
+
+def test_LJ_entry_vanishes():
+    # The pile entry goes (as by an orphan sweep) after it's been seen but
+    # before the name is linked to it: the name's contents go in instead
+    class SweptLJ(LJ):
+        def _link_over(self, target, dest, src_dir_fd=None):
+            if not hasattr(self, 'swept'):
+                self.swept = target
+                os.remove(target)
+            return super()._link_over(target, dest, src_dir_fd)
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as hashdirname:
+        with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+            for fname in ("t.1", "t.2"):
+                with open(os.path.join(tmpdirname, fname), 'w') as f:
+                    f.write("foo")
+            lj = SweptLJ(hashdirname)
+            with open(os.path.join(tmpdirname, "t.1"), 'rb') as f:
+                assert lj.assimilate(f) == "added"
+            with open(os.path.join(tmpdirname, "t.2"), 'rb') as f:
+                assert lj.assimilate(f) == "added"
+            t2 = os.path.join(tmpdirname, "t.2")
+            with open(t2) as f:
+                assert f.read() == "foo"
+            assert os.path.samefile(lj._path_from_key(lj.key_from_path(t2)), t2)
+
+def test_LJ_physical_order():
+    from hkfs.physorder import first_extent, ordered_files
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        src = Path(tmpdirname) / "src"
+        for i in range(30):
+            p = src / f"d{i % 3}" / f"f{i}"
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p.write_text(f"file {i % 20}")
+        (src / "link").symlink_to("d0/f0")
+        walked = sorted(str(Path(d) / n) for d, _, names in os.walk(src) for n in names)
+        for order in ("inode", "extent"):
+            paths = list(ordered_files(src, order, batch=7))
+            assert sorted(map(str, paths)) == walked
+        inodes = [os.lstat(p).st_ino for p in ordered_files(src, "inode", batch=100)]
+        assert inodes == sorted(inodes)
+        assert first_extent(src / "d0" / "f0") is None or first_extent(src / "d0" / "f0") >= 0
+        with pytest.raises(ValueError):
+            LJ(tmpdirname, order="random")
+        pile = Path(tmpdirname) / "pile"
+        pile.mkdir()
+        (src / "link").unlink()
+        results = []
+        lj = LJ(pile, lambda name, res: results.append(res[0]), order="extent", fadvise=True)
+        lj.assimilate_tree(src)
+        assert sorted(results) == ["added"] * 20 + ["linked"] * 10
@@ -0,0 +1,89 @@
+import pytest
+
+import asyncio
+import os
+import threading
+import time
+
+from hkfs import AsyncFHK_CRD, AsyncLJ, DeviceLimiter, FHK_CRD
+from lj import LJ
+
+
+def test_create_read_exists_delete(tmpdirname):
+    async def go():
+        ahk = AsyncFHK_CRD(FHK_CRD(tmpdirname))
+        datas = [f"This is the {i}th string".encode('utf8') for i in range(200)]
+        keys = await asyncio.gather(*(ahk.create(d) for d in datas))
+        assert all(await asyncio.gather(*(ahk.exists(k) for k in keys)))
+        assert await asyncio.gather(*(ahk.read(k) for k in keys)) == datas
+        await asyncio.gather(*(ahk.delete(k) for k in keys))
+        assert not any(await asyncio.gather(*(ahk.exists(k) for k in keys)))
+        ahk.close()
+    asyncio.run(go())
+
+def test_in_flight_limited_per_device(tmpdirname):
+    class SlowStore(FHK_CRD):
+        def exists(self, key):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+            return super().exists(key)
+    lock = threading.Lock()
+    active, peak = [0], [0]
+    os.mkdir(os.path.join(tmpdirname, "a"))
+    os.mkdir(os.path.join(tmpdirname, "b"))
+
+    async def go():
+        limiter = DeviceLimiter(max_in_flight=3)
+        # two stores on one device share its limit
+        stores = [AsyncFHK_CRD(SlowStore(os.path.join(tmpdirname, n)), max_workers=10,
+                               limiter=limiter) for n in ("a", "b")]
+        await asyncio.gather(*(s.exists(b"0123" * 8) for s in stores for _ in range(20)))
+        for s in stores:
+            s.close()
+    asyncio.run(go())
+    assert peak[0] == 3
+
+def test_cancelled_stream_leaves_nothing(tmpdirname):
+    async def go():
+        ahk = AsyncFHK_CRD(FHK_CRD(tmpdirname))
+        started = asyncio.Event()
+        async def upload():
+            yield b"first part"
+            started.set()
+            await asyncio.sleep(10)
+            yield b"never sent"
+        task = asyncio.create_task(ahk.create_from_aiter(upload()))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        async def whole():
+            for chunk in (b"foo", b"bar"):
+                yield chunk
+        k = await ahk.create_from_aiter(whole())
+        assert await ahk.read(k) == b"foobar"
+        ahk.close()
+    asyncio.run(go())
+    assert [n for n in os.listdir(tmpdirname) if n.startswith('.')] == []
+
+def test_assimilate(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    src = os.path.join(tmpdirname, "src")
+    os.mkdir(pile)
+    os.mkdir(src)
+    for i, contents in enumerate(["foo", "bar", "foo"]):
+        with open(os.path.join(src, f"t.{i}"), 'w') as f:
+            f.write(contents)
+    async def go():
+        alj = AsyncLJ(LJ(pile))
+        whats = [await alj.assimilate(os.path.join(src, f"t.{i}")) for i in range(3)]
+        assert whats == ["added", "added", "linked"]
+        k = await alj.assimilate_tell_key(os.path.join(src, "t.0"))
+        assert await alj.exists(k)
+        await alj.assimilate_tree(src)
+        alj.close()
+    asyncio.run(go())
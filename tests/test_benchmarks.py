@@ -0,0 +1,37 @@
+import json
+import os
+
+from benchmarks import suite, synth
+
+
+def test_make_tree(tmpdirname):
+    a, b = os.path.join(tmpdirname, "a"), os.path.join(tmpdirname, "b")
+    files, nbytes = synth.make_tree(a, 50, "fixed:100@1,uniform:1:10@1", 0.5, depth=2, fanout=2, seed=3)
+    assert synth.make_tree(b, 50, "fixed:100@1,uniform:1:10@1", 0.5, depth=2, fanout=2, seed=3) == (files, nbytes)
+    contents = []
+    for d, _, names in os.walk(a):
+        for n in names:
+            with open(os.path.join(d, n), 'rb') as f:
+                contents.append(f.read())
+            with open(os.path.join(b, os.path.relpath(d, a), n), 'rb') as f:
+                assert f.read() == contents[-1]
+    assert len(contents) == 50
+    assert sum(map(len, contents)) == nbytes
+    assert 5 < len(set(contents)) < 45
+    assert len(synth.dir_paths(2, 2)) == 7
+
+def test_suite_writes_json(tmpdirname):
+    out = os.path.join(tmpdirname, "results.json")
+    suite.main(["--dir", tmpdirname, "--out", out, "--files", "20", "--objects", "20",
+                "--sizes", "fixed:1000", "--cache", "cold", "warm"])
+    with open(out) as f:
+        rv = json.load(f)
+    names = {(r['name'], r['cache']) for r in rv['results']}
+    assert ("LJ.assimilate_tree", "cold") in names
+    assert ("LJ.assimilate_tree order=inode", "cold") in names
+    assert ("LJ.assimilate_tree order=extent", "warm") in names
+    assert ("FHK_CRD.read", "warm") in names
+    assert all(r['files'] == 20 for r in rv['results'])
+    assert rv['params']['files'] == 20
+    # only the results file is left in the scratch directory
+    assert os.listdir(tmpdirname) == ["results.json"]
@@ -0,0 +1,75 @@
+import pytest
+
+import os
+
+from hkfs import BlockCache, FHK_CRD, Metrics
+
+
+def counting_fetch(contents):
+    fetched = []
+    def fetch(key, offset, length):
+        fetched.append((offset, length))
+        return contents[key][offset:offset + length]
+    return fetch, fetched
+
+def test_blocks_and_stats():
+    contents = {b"k": bytes(range(256)) * 4}
+    fetch, fetched = counting_fetch(contents)
+    cache = BlockCache(block_size=100, readahead=0)
+    assert cache.read(b"k", 150, 100, fetch) == contents[b"k"][150:250]
+    assert fetched == [(100, 100), (200, 100)]
+    assert cache.read(b"k", 120, 20, fetch) == contents[b"k"][120:140]
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 2
+    # past the end
+    assert cache.read(b"k", 1000, 100, fetch) == contents[b"k"][1000:]
+    assert cache.read(b"k", 2000, 100, fetch) == b""
+
+def test_readahead():
+    contents = {b"k": os.urandom(1000)}
+    fetch, fetched = counting_fetch(contents)
+    cache = BlockCache(block_size=100, readahead=3)
+    data = b"".join(cache.read(b"k", off, 100, fetch) for off in range(0, 1000, 100))
+    assert data == contents[b"k"]
+    # sequential from the second block on: block 0, then 1 with 3 more, ...
+    assert fetched == [(0, 100), (100, 400), (500, 400), (900, 400)]
+    assert cache.stats['readahead'] == 7
+
+def test_eviction_and_invalidate():
+    contents = {b"a": os.urandom(500), b"b": os.urandom(500)}
+    fetch, fetched = counting_fetch(contents)
+    cache = BlockCache(max_bytes=300, block_size=100, readahead=0)
+    cache.read(b"a", 0, 300, fetch)
+    cache.read(b"b", 0, 200, fetch)
+    assert cache.bytes <= 300
+    assert cache.stats['evictions'] == 2
+    cache.invalidate(b"b")
+    assert len(cache) == 1
+    assert cache.bytes == 100
+
+def test_fhk_read_cache(tmpdirname):
+    cache = BlockCache(block_size=4, readahead=0)
+    hk = FHK_CRD(tmpdirname, read_cache=cache)
+    k = hk.create(b"0123456789")
+    assert hk.read(k, 2, 5) == b"23456"
+    assert hk.read(k, 1, 2) == b"12"
+    assert cache.stats['hits'] == 1
+    assert hk.read(k) == b"0123456789"
+    buf = bytearray(4)
+    assert hk.read_into(k, buf, 8) == 2
+    assert buf[:2] == b"89"
+    hk.delete(k)
+    assert len(cache) == 0
+    with pytest.raises(FileNotFoundError):
+        hk.read(k)
+
+def test_fhk_read_cache_metrics(tmpdirname):
+    metrics = Metrics()
+    hk = FHK_CRD(tmpdirname, read_cache=BlockCache(block_size=4, readahead=0),
+                 metrics=metrics)
+    k = hk.create(b"0123456789")
+    assert hk.read(k, 2, 5) == b"23456" # a miss, fetching 8 bytes of blocks
+    assert hk.read(k, 2, 1) == b"2" # a hit
+    # what the callers asked for, once a read
+    assert metrics.counters['bytes_read'] == 6
+    assert metrics.phases['read'].count == 2
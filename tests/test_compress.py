@@ -0,0 +1,65 @@
+import pytest
+
+import io
+import os
+import time
+
+from hkfs import FHK_CRD, KeyFilter, Verifier
+from hkfs.compress import CompressedReader, compress_file, recompress, SUFFIX
+
+
+def compressible(n):
+    return b"".join(b"line %d of something compressible\n" % i for i in range(n))
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_range_reads(tmpdirname, codec):
+    data = compressible(5000)
+    src = os.path.join(tmpdirname, "src")
+    with open(src, 'wb') as f:
+        f.write(data)
+    dst = os.path.join(tmpdirname, "dst.z")
+    size = compress_file(src, dst, codec, frame_size=1000)
+    assert size < len(data) / 2
+    with open(dst, 'rb') as f:
+        cr = CompressedReader(f.fileno())
+        assert cr.size == len(data)
+        assert cr.read() == data
+        for offset, length in ((0, 10), (999, 2), (1500, 3000), (len(data) - 5, 100), (len(data), 1)):
+            assert cr.read(offset, length) == data[offset:offset + length]
+        assert cr.stream().read() == data
+
+def test_fhk_compressed_tier(tmpdirname):
+    hk = FHK_CRD(tmpdirname)
+    data = compressible(2000)
+    k = hk.create(data)
+    hot = hk.create(compressible(1000))
+    tiny = hk.create(b"tiny")
+    # make k look idle
+    path = str(hk._path_from_key(k))
+    old = time.time() - 3600
+    os.utime(path, (old, old))
+    report = recompress(tmpdirname, min_idle_seconds=60)
+    assert report['files'] == 1
+    assert not os.path.exists(path) and os.path.exists(path + SUFFIX)
+    assert os.path.exists(hk._path_from_key(hot))
+    assert hk.exists(k)
+    assert hk.exists_many([k, hot, tiny]) == [True, True, True]
+    assert hk.read(k) == data
+    assert hk.read(k, 1000, 50) == data[1000:1050]
+    buf = bytearray(20)
+    assert hk.read_into(k, buf, 100) == 20 and buf == data[100:120]
+    with hk.view(k, 5, 10) as v:
+        assert v == data[5:15]
+    assert hk.read_many([hot, k], 0, 10) == [compressible(1000)[:10], data[:10]]
+    assert k in KeyFilter.from_pile(tmpdirname)
+    # creating it again doesn't bring back a plain copy
+    assert hk.create(data) == k
+    assert hk.create_many([data]) == [k]
+    assert hk.create_from_file(io.BytesIO(data)) == k
+    assert not os.path.exists(path)
+    summary = Verifier(hk, os.path.join(tmpdirname, ".state")).run()
+    assert summary['files'] == 3 and summary['problems'] == 0
+    hk.delete(k)
+    assert not hk.exists(k)
+    with pytest.raises(FileNotFoundError):
+        hk.read(k)
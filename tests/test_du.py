@@ -0,0 +1,55 @@
+import pytest
+
+import os
+
+from pathlib import Path
+
+from hkfs import du, unique_files
+from lj import LJ
+
+from .test_inode_index import make_tree
+
+
+@pytest.fixture
+def archive(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    tree = os.path.join(tmpdirname, "tree")
+    os.mkdir(pile)
+    make_tree(tree, {
+        "a/x": "shared with b",   # 13 bytes
+        "a/y": "twice in a",      # 10
+        "a/sub/y2": "twice in a",
+        "a/only": "only in a!",   # 10
+        "b/z": "shared with b",
+        "b/mine": "b's own",      # 7
+    })
+    LJ(pile).assimilate_tree(tree)
+    return Path(tree)
+
+def test_du(archive):
+    usage = {os.path.relpath(u.path, archive): u for u in du(archive)}
+    a = usage["a"]
+    assert a.files == 4
+    assert a.bytes == 13 + 10 + 10
+    assert a.unique_bytes == 10 + 10
+    assert a.shared_bytes == 13
+    sub = usage[os.path.join("a", "sub")]
+    assert (sub.files, sub.bytes, sub.unique_bytes) == (1, 10, 0)
+    top = usage["."]
+    assert top.files == 6
+    assert top.bytes == top.unique_bytes == 13 + 10 + 10 + 7
+    # subdirectories come before their parents
+    order = [u.path for u in du(archive)]
+    assert order.index(str(archive / "a")) < order.index(str(archive))
+    assert [u.path for u in du(archive, max_depth=0)] == [str(archive)]
+
+def test_du_plain_tree(tmpdirname):
+    make_tree(tmpdirname, {"p": "12345", "q": "678"})
+    os.link(os.path.join(tmpdirname, "p"), os.path.join(tmpdirname, "p2"))
+    top, = du(tmpdirname, pile_links=0)
+    assert (top.files, top.bytes, top.unique_bytes) == (3, 8, 8)
+
+def test_unique_files(archive):
+    assert unique_files(archive / "a") == sorted(
+        str(archive / p) for p in ("a/only", "a/sub/y2", "a/y"))
+    assert unique_files(archive / "b") == [str(archive / "b/mine")]
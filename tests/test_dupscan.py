@@ -0,0 +1,68 @@
+import os
+
+from pathlib import Path
+
+from hkfs import DupScanner, StatCache
+from lj import LJ
+
+
+def snapshot(dirname):
+    return sorted((str(p), os.lstat(p)) for p in Path(dirname).rglob("*"))
+
+def test_scan(tmpdirname):
+    src = Path(tmpdirname) / "src"
+    (src / "a").mkdir(parents=True)
+    big = os.urandom(300000)
+    (src / "big.1").write_bytes(big)
+    (src / "a" / "big.2").write_bytes(big)
+    # same size as big, different head: never fully read
+    (src / "big.3").write_bytes(b"X" + big[1:])
+    (src / "t.1").write_text("foo")
+    (src / "a" / "t.2").write_text("foo")
+    (src / "t.3").write_text("bar")
+    (src / "unique").write_text("only one of this size")
+    os.link(src / "t.3", src / "a" / "t.3.link")
+    (src / "e.1").write_bytes(b"")
+    (src / "e.2").write_bytes(b"")
+    before = snapshot(tmpdirname)
+
+    lj = LJ(tmpdirname)
+    scanner = DupScanner(lj, partial_len=4096)
+    report = scanner.scan(str(src))
+    assert snapshot(tmpdirname) == before
+    assert report.files == 10
+
+    by_size = {g.size: g for g in report.groups}
+    assert sorted(by_size) == [0, 3, 300000]
+    assert by_size[300000].paths == sorted([str(src / "big.1"), str(src / "a" / "big.2")])
+    assert by_size[300000].key == lj.key_from_path(src / "big.1")
+    assert by_size[3].paths == sorted([str(src / "t.1"), str(src / "a" / "t.2")])
+    assert by_size[3].inodes == 2
+    assert by_size[0].inodes == 2
+    assert report.reclaimable_bytes == 300000 + 3
+
+    # big.3 was ruled out by its head, and the hard link to t.3 not read at all
+    assert report.bytes_read == 2 * 300000 + 3 * 2 * 4096 + 3 * 3
+
+    d = report.as_dict(lj._encode_key)
+    assert {g['key'] for g in d['groups']} >= {lj._encode_key(by_size[3].key)}
+
+def test_scan_reads_stat_cache_only(tmpdirname):
+    src = Path(tmpdirname) / "src"
+    src.mkdir()
+    for name in ("a.1", "a.2", "b.1", "b.2"):
+        (src / name).write_text(name[0] * 10)
+    cache = StatCache(os.path.join(tmpdirname, "cache.db"))
+    lj = LJ(tmpdirname, stat_cache=cache)
+    ka = lj.key_from_path(src / "a.1")
+    lj.key_from_path(src / "a.2")
+    lj.key_from_path(src / "b.1")
+    (src / "b.1").write_text("c" * 10) # stale in the cache now
+    assert len(cache) == 3
+
+    report = DupScanner(lj).scan(str(src))
+    assert {g.key for g in report.groups} == {ka}
+    # a.1 and a.2 came from the cache; b.1 and b.2 were read
+    assert report.bytes_read == 2 * 10
+    # the stale entry kept, nothing stored for b.2
+    assert len(cache) == 3
@@ -0,0 +1,150 @@
+import pytest
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+from hkfs import FHK_CRD, Verifier
+from hkfs.durability import Durability
+from lj import LJ
+
+from .test_inode_index import make_tree
+
+
+def pile_names(directory):
+    return [n for _, _, names in os.walk(directory) for n in names if not n.startswith('.')]
+
+def test_levels():
+    with pytest.raises(ValueError):
+        Durability('sometimes')
+
+def test_fhk_object(tmpdirname):
+    hk = FHK_CRD(tmpdirname, durability='object')
+    keys = [hk.create(b"object %d" % i) for i in range(10)]
+    assert [hk.read(k) for k in keys] == [b"object %d" % i for i in range(10)]
+    # each object's contents and leaf directory, and new directories' parents
+    assert hk.durability.syncs >= 20
+
+def test_fhk_group(tmpdirname):
+    hk = FHK_CRD(tmpdirname, durability=Durability('group', group_ops=8, group_ms=60000))
+    keys = [hk.create(b"group %d" % i) for i in range(5)]
+    # acknowledged and readable, but not yet in place
+    assert pile_names(tmpdirname) == []
+    assert hk.exists(keys[0])
+    assert hk.read(keys[4]) == b"group 4"
+    keys += [hk.create(b"group %d" % i) for i in range(5, 8)]
+    assert len(pile_names(tmpdirname)) == 8
+    hk.create(b"group 8")
+    hk.close()
+    assert len(pile_names(tmpdirname)) == 9
+    assert FHK_CRD(tmpdirname).read(keys[7]) == b"group 7"
+
+def test_fhk_group_commits_on_timer(tmpdirname):
+    hk = FHK_CRD(tmpdirname, durability=Durability('group', group_ops=10**9, group_ms=20))
+    key = hk.create(b"lonely")
+    # no further operation comes along, yet it's placed by the deadline
+    deadline = time.monotonic() + 5
+    while not pile_names(tmpdirname) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert FHK_CRD(tmpdirname).read(key) == b"lonely"
+    hk.close()
+
+def test_fhk_group_commits_at_exit(tmpdirname):
+    script = f"""
+from hkfs import FHK_CRD
+from hkfs.durability import Durability
+hk = FHK_CRD({tmpdirname!r}, durability=Durability('group', group_ops=10**9, group_ms=10**9))
+hk.create(b"at exit")
+"""
+    subprocess.run([sys.executable, '-c', script], check=True)
+    assert FHK_CRD(tmpdirname).read(FHK_CRD(tmpdirname).key(b"at exit")) == b"at exit"
+
+def test_fhk_group_fewer_syncs(tmpdirname):
+    syncs = {}
+    for level in ('object', 'group'):
+        d = os.path.join(tmpdirname, level)
+        os.mkdir(d)
+        hk = FHK_CRD(d, durability=Durability(level, group_ops=64, group_ms=60000))
+        for i in range(64):
+            hk.create(b"same dirs %d" % (i % 4) + b" " * i)
+        hk.close()
+        syncs[level] = hk.durability.syncs
+    assert syncs['group'] < syncs['object']
+
+def test_lj_group(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    tree = os.path.join(tmpdirname, "tree")
+    os.mkdir(pile)
+    make_tree(tree, {"a": "foo", "b": "foo", "c/d": "bar"})
+    lj = LJ(pile, durability='group')
+    lj.assimilate_tree(tree)
+    lj.close()
+    assert lj.durability.syncs > 0
+    assert os.path.samefile(os.path.join(tree, "a"), os.path.join(tree, "b"))
+
+def test_lj_group_tail_synced(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    tree = os.path.join(tmpdirname, "tree")
+    os.mkdir(pile)
+    make_tree(tree, {"a": "foo", "c/d": "bar"})
+    lj = LJ(pile, durability=Durability('group', group_ops=10**9, group_ms=10**9))
+    # the walk's last group is synced when it ends, not left to the next operation
+    lj.assimilate_tree(tree)
+    assert lj.durability.syncs > 0 and not lj.durability._dirs
+
+def test_group_syncs_on_timer(tmpdirname):
+    lj = LJ(tmpdirname, durability=Durability('group', group_ops=10**9, group_ms=20))
+    Path(tmpdirname, "f").write_bytes(b"lone")
+    with open(os.path.join(tmpdirname, "f"), 'rb') as f:
+        lj.assimilate(f)
+    deadline = time.monotonic() + 5
+    while lj.durability.syncs < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # the leaf, its parent and the pile, though nothing else came along
+    assert lj.durability.syncs == 3
+    assert not lj.durability._dirs
+
+CHILD = """
+import sys
+sys.path.insert(0, {repo!r})
+from hkfs import FHK_CRD
+from hkfs.durability import Durability
+hk = FHK_CRD({pile!r}, durability=Durability({level!r}, group_ops=10**9, group_ms=10**9))
+i = 0
+while True:
+    hk.create(b"%d " % i * (i % 50 + 1))
+    i += 1
+    if {level!r} == 'object':
+        print(i, flush=True)
+    elif i % 16 == 0:
+        hk.flush()
+        print(i, flush=True)
+"""
+
+@pytest.mark.parametrize("level", ["object", "group"])
+def test_crash(tmpdirname, level):
+    # Kill a writer at an arbitrary point: everything acknowledged is there,
+    # and nothing in the pile is torn
+    repo = str(Path(__file__).resolve().parent.parent)
+    child = subprocess.Popen(
+        [sys.executable, "-c", CHILD.format(repo=repo, pile=tmpdirname, level=level)],
+        stdout=subprocess.PIPE, text=True)
+    acked = 0
+    for line in child.stdout:
+        acked = int(line)
+        if acked >= 200:
+            break
+    child.send_signal(signal.SIGKILL)
+    child.wait()
+    child.stdout.close()
+    hk = FHK_CRD(tmpdirname)
+    for i in range(acked):
+        data = b"%d " % i * (i % 50 + 1)
+        assert hk.read(hk.key(data)) == data
+    summary = Verifier(hk, os.path.join(tmpdirname, ".verify")).run()
+    assert summary['files'] >= acked
+    assert summary['problems'] == 0
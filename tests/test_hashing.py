@@ -0,0 +1,55 @@
+import pytest
+
+import hashlib
+import io
+import os
+import tempfile
+
+from blake3 import blake3
+
+from hkfs import FHK_CRD, FileHasher
+
+
+sizes = [0, 1, 4095, 4096, 4097, 3 * 4096 + 5]
+
+@pytest.mark.parametrize("size", sizes)
+@pytest.mark.parametrize("mmap_threshold", [None, 1])
+@pytest.mark.parametrize("mt_threshold", [None, 1])
+def test_streaming(tmpdirname, size, mmap_threshold, mt_threshold):
+    data = os.urandom(size)
+    fh = FileHasher(blake3, buf_len=4096, mmap_threshold=mmap_threshold, mt_threshold=mt_threshold)
+    with tempfile.TemporaryFile(dir=tmpdirname) as f:
+        f.write(data)
+        f.seek(0)
+        assert fh.hash_file(f) == blake3(data).digest()
+        assert f.read() == b""
+        # from the current position
+        f.seek(min(size, 7))
+        assert fh.hash_file(f) == blake3(data[7:]).digest()
+
+@pytest.mark.parametrize("size", sizes)
+def test_one_shot(tmpdirname, size):
+    data = os.urandom(size)
+    fh = FileHasher(hashfun=lambda x: hashlib.blake2b(x).digest())
+    with tempfile.TemporaryFile(dir=tmpdirname) as f:
+        f.write(data)
+        f.seek(0)
+        assert fh.hash_file(f) == hashlib.blake2b(data).digest()
+    assert fh.hash_file(io.BytesIO(data)) == hashlib.blake2b(data).digest()
+    assert fh.hash_bytes(data) == hashlib.blake2b(data).digest()
+
+def test_not_a_file():
+    fh = FileHasher(hashlib.sha256, buf_len=3, mmap_threshold=1)
+    assert fh.hash_file(io.BytesIO(b"foobar")) == hashlib.sha256(b"foobar").digest()
+
+def test_fhk_key_from_file(tmpdirname):
+    data = os.urandom(10000)
+    with tempfile.TemporaryFile(dir=tmpdirname) as f:
+        f.write(data)
+        for hk, expected in [
+                (FHK_CRD(tmpdirname), hashlib.sha256(data).digest()),
+                (FHK_CRD(tmpdirname, hasher=blake3), blake3(data).digest()),
+                (FHK_CRD(tmpdirname, hashfun=lambda x: hashlib.blake2b(x).digest()),
+                 hashlib.blake2b(data).digest())]:
+            assert hk.key_from_file(f) == expected
+            assert hk.key(data) == expected
@@ -64,3 +64,143 @@ def test_create_many():
         for k in keys:
             assert hk.read(k) == expected_v_from_k[k]
             hk.delete(k)
+
+def test_create_hashes_once():
+    calls = []
+    class Counting():
+        def __init__(self, data=b""):
+            calls.append('new')
+            self.h = hashlib.sha256(data)
+        def update(self, data):
+            calls.append('update')
+            self.h.update(data)
+        def digest(self):
+            return self.h.digest()
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        hk = HK(tmpdirname, hasher=Counting)
+        k = hk.create(b"once")
+        assert calls == ['new']
+        assert k == hashlib.sha256(b"once").digest()
+        assert hk.read(k) == b"once"
+
+def test_create_from_file():
+    import io, os
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        hk = HK(tmpdirname)
+        hk.buf_len = hk.file_hasher.buf_len = 1000
+        data = os.urandom(5555)
+        k = hk.create_from_file(io.BytesIO(data))
+        assert k == hk.key(data)
+        assert hk.read(k) == data
+        # creating it again is harmless
+        assert hk.create_from_file(io.BytesIO(data)) == k
+        assert [n for n in os.listdir(tmpdirname) if n.startswith('.')] == []
+
+def test_create_from_iter():
+    from blake3 import blake3
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        for hk in (HK(tmpdirname), HK(tmpdirname, hasher=blake3),
+                   HK(tmpdirname, hashfun=lambda x: hashlib.blake2b(x).digest())):
+            chunks = [b"foo", b"", b"bar" * 1000]
+            k = hk.create_from_iter(iter(chunks))
+            assert k == hk.key(b"".join(chunks))
+            assert hk.read(k) == b"".join(chunks)
+
+def test_writer_abort_leaves_nothing():
+    import os
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        hk = HK(tmpdirname)
+        with pytest.raises(RuntimeError):
+            with hk.writer() as w:
+                w.write(b"partial")
+                raise RuntimeError("interrupted")
+        assert os.listdir(tmpdirname) == []
+        assert not hk.exists(hk.key(b"partial"))
+
+def test_create_many_failure_leaves_no_temporary(monkeypatch):
+    import os
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        hk = HK(tmpdirname)
+        write = os.write
+        calls = []
+        def failing_write(fd, data):
+            calls.append(fd)
+            if len(calls) == 2:
+                raise OSError(28, "No space left on device")
+            return write(fd, data)
+        monkeypatch.setattr(os, 'write', failing_write)
+        with pytest.raises(OSError):
+            hk.create_many([b"first", b"second", b"third"])
+        monkeypatch.undo()
+        assert [n for _, _, names in os.walk(tmpdirname) for n in names
+                if n.startswith('.tmp-')] == []
+
+def test_read_into_and_view():
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        hk = HK(tmpdirname)
+        data = bytes(range(256)) * 10
+        k = hk.create(data)
+        buf = bytearray(100)
+        assert hk.read_into(k, buf, 50) == 100
+        assert buf == data[50:150]
+        assert hk.read_into(k, buf, len(data) - 30) == 30
+        assert buf[:30] == data[-30:]
+        with hk.view(k) as v:
+            assert v == data
+        with hk.view(k, 10, 20) as v:
+            assert bytes(v) == data[10:30]
+        with hk.view(k, len(data) + 5) as v:
+            assert len(v) == 0
+        e = hk.create(b"")
+        with hk.view(e) as v:
+            assert bytes(v) == b""
+
+def test_batches():
+    import os
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        hk = HK(tmpdirname)
+        hk.listdir_threshold = 2
+        datas = [f"This is the {i}th string".encode('utf8') for i in range(300)]
+        datas.append(datas[0]) # a repeat
+        keys = hk.create_many(datas)
+        assert keys == [hk.key(d) for d in datas]
+        assert hk.read_many(keys) == datas
+        assert hk.read_many(keys[:3], 8, 3) == [d[8:11] for d in datas[:3]]
+        missing = [hk.key(b"missing %d" % i) for i in range(20)]
+        assert hk.exists_many(keys + missing) == [True] * len(keys) + [False] * 20
+        hk.listdir_threshold = 1000
+        assert hk.exists_many(keys + missing) == [True] * len(keys) + [False] * 20
+        hk.delete_many(keys[:100])
+        assert hk.exists_many(keys) == [False] * 100 + [True] * 200 + [False]
+        with pytest.raises(FileNotFoundError):
+            hk.delete_many(keys[:1])
+        hk.delete_many(keys, missing_ok=True)
+        assert not any(hk.exists_many(keys))
+        # no temporaries left behind
+        assert not [n for _, _, files in os.walk(tmpdirname) for n in files]
+
+def test_dir_fds():
+    with tempfile.TemporaryDirectory(prefix="/roto/tmp/") as tmpdirname:
+        hk = HK(tmpdirname, dir_fds=True)
+        hk.dir_fds.max_open = 4
+        k1 = hk.create(b"foo")
+        assert hk.exists(k1)
+        assert hk.read(k1) == b"foo"
+        assert not hk.exists(hk.key(b"never"))
+        with pytest.raises(FileNotFoundError):
+            hk.read(hk.key(b"never"))
+        datas = [f"This is the {i}th string".encode('utf8') for i in range(50)]
+        keys = hk.create_many(datas)
+        assert hk.read_many(keys) == datas
+        assert all(hk.exists_many(keys))
+        buf = bytearray(4)
+        assert hk.read_into(keys[7], buf, 8) == 4 and buf == datas[7][8:12]
+        with hk.view(keys[7]) as v:
+            assert v == datas[7]
+        assert len(hk.dir_fds._leaves) <= 4
+        # a plain store sees the same layout
+        assert HK(tmpdirname).read_many(keys) == datas
+        hk.delete_many(keys)
+        hk.delete(k1)
+        assert not any(hk.exists_many(keys + [k1]))
+        hk.close()
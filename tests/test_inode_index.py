@@ -0,0 +1,106 @@
+import os
+
+from pathlib import Path
+
+from hkfs import InodeIndex
+from lj import LJ
+
+
+def make_tree(root, contents_by_relpath):
+    for relpath, contents in contents_by_relpath.items():
+        p = Path(root) / relpath
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text(contents)
+
+def counting_key_from_file(lj):
+    hashed = []
+    real_key_from_file = lj.key_from_file
+    def key_from_file(f):
+        hashed.append(f.name)
+        return real_key_from_file(f)
+    lj.key_from_file = key_from_file
+    return hashed
+
+def test_put_get_delete(tmpdirname):
+    idx = InodeIndex(os.path.join(tmpdirname, "idx.db"))
+    assert idx.get(1, 2) is None
+    idx.put(1, 2, b"k" * 32)
+    assert idx.get(1, 2) == b"k" * 32
+    assert len(idx) == 1
+    # a second connection, as from another process, sees it
+    assert InodeIndex(os.path.join(tmpdirname, "idx.db")).get(1, 2) == b"k" * 32
+    idx.delete(1, 2)
+    assert idx.get(1, 2) is None
+    idx.close()
+
+def test_reassimilate_does_not_rehash(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    src = os.path.join(tmpdirname, "src")
+    os.mkdir(pile)
+    make_tree(src, {"t.1": "foo", "t.2": "bar", "a/t.3": "foo"})
+    idx = InodeIndex(os.path.join(tmpdirname, "idx.db"))
+    lj = LJ(pile, inode_index=idx)
+    hashed = counting_key_from_file(lj)
+    lj.assimilate_tree(src)
+    assert len(hashed) == 3
+    assert len(idx) == 2
+
+    hashed.clear()
+    results = []
+    lj.post_assimilation = lambda name, res: results.append(res[0])
+    lj.assimilate_tree(src)
+    assert hashed == []
+    assert results == ["linked"] * 3
+
+    hashed.clear()
+    lj.assimilate_tree(src, workers=3)
+    assert hashed == []
+
+def test_stale_entry_is_dropped(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    os.mkdir(pile)
+    idx = InodeIndex(os.path.join(tmpdirname, "idx.db"))
+    lj = LJ(pile, inode_index=idx)
+    p = Path(tmpdirname) / "t.1"
+    p.write_text("foo")
+    st = os.stat(p)
+    # claim this inode is the pile file for some other content
+    idx.put(st.st_dev, st.st_ino, b"\x01" * 32)
+    with open(p, 'rb') as f:
+        assert lj.assimilate(f) == "added"
+    assert idx.get(st.st_dev, st.st_ino) == lj.key_from_path(p)
+
+def test_hard_link_group_hashed_once(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    src = os.path.join(tmpdirname, "src")
+    os.mkdir(pile)
+    make_tree(src, {"t.1": "foo", "t.2": "bar"})
+    os.link(os.path.join(src, "t.1"), os.path.join(src, "t.1a"))
+    os.link(os.path.join(src, "t.1"), os.path.join(src, "t.1b"))
+    for workers in (1, 2):
+        lj = LJ(pile, workers=workers)
+        hashed = counting_key_from_file(lj)
+        lj.assimilate_tree(src)
+        assert len(hashed) == 2
+    st = os.stat(os.path.join(src, "t.1"))
+    assert st.st_nlink == 4
+    assert os.path.samestat(st, os.stat(os.path.join(src, "t.1b")))
+
+def test_rebuild(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    src = os.path.join(tmpdirname, "src")
+    os.mkdir(pile)
+    make_tree(src, {"t.1": "foo", "t.2": "bar", "t.3": "baz"})
+    LJ(pile).assimilate_tree(src)
+    # a dot-name temporary in a fan-out dir isn't a pile entry
+    leaf = next(Path(pile).glob("*/*"))
+    (leaf / ".tmp-partial").write_text("x")
+
+    idx = InodeIndex(os.path.join(tmpdirname, "idx.db"))
+    idx.put(0, 0, b"junk")
+    idx.rebuild(pile)
+    assert len(idx) == 3
+    lj = LJ(pile, inode_index=idx)
+    for name in ("t.1", "t.2", "t.3"):
+        st = os.stat(os.path.join(src, name))
+        assert idx.get(st.st_dev, st.st_ino) == lj.key_from_path(os.path.join(src, name))
@@ -0,0 +1,116 @@
+import pytest
+
+import os
+
+from pathlib import Path
+
+from hkfs import FHK_CRD, Journal, export_since
+from hkfs.journal import ADD, DELETE, LINK, records, segments
+from hkfs.pile import scan_pile
+from lj import LJ
+
+
+def test_append_read(tmpdirname):
+    jdir = os.path.join(tmpdirname, "journal")
+    with Journal(jdir) as j:
+        assert j.add(b"k" * 32) == 1
+        assert j.link(b"k" * 32) == 2
+        assert j.delete(b"j" * 32) == 3
+        assert [(r.seq, r.op) for r in j.records()] == [(1, ADD), (2, LINK), (3, DELETE)]
+    assert [r.seq for r in records(jdir, since=1)] == [2, 3]
+    # a new writer carries on the sequence
+    with Journal(jdir) as j:
+        assert j.add(b"m" * 32) == 4
+
+def test_single_writer(tmpdirname):
+    with Journal(tmpdirname):
+        with pytest.raises(BlockingIOError):
+            Journal(tmpdirname)
+    Journal(tmpdirname).close()
+
+def test_rotation(tmpdirname):
+    with Journal(tmpdirname, segment_bytes=200) as j:
+        for i in range(20):
+            j.add(bytes([i]) * 32)
+    assert len(segments(tmpdirname)) > 1
+    assert [r.seq for r in records(tmpdirname)] == list(range(1, 21))
+    assert [r.seq for r in records(tmpdirname, since=17)] == [18, 19, 20]
+
+def test_torn_tail(tmpdirname):
+    with Journal(tmpdirname) as j:
+        j.add(b"a" * 32)
+        j.add(b"b" * 32)
+    _, path = segments(tmpdirname)[-1]
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 5)
+    assert [r.key for r in records(tmpdirname)] == [b"a" * 32]
+    with Journal(tmpdirname) as j:
+        assert j.add(b"c" * 32) == 2
+    assert [r.key for r in records(tmpdirname)] == [b"a" * 32, b"c" * 32]
+
+def test_fhk_export_since(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    backup = os.path.join(tmpdirname, "backup")
+    os.mkdir(pile)
+    with Journal(os.path.join(tmpdirname, "journal")) as j:
+        hk = FHK_CRD(pile, journal=j)
+        k1 = hk.create(b"one")
+        k2 = hk.create(b"two")
+        result = export_since(j, pile, backup)
+        assert set(result.copied) == {k1, k2}
+        assert sorted(e.name for e in scan_pile(backup)) == sorted(e.name for e in scan_pile(pile))
+        # only the churn since the checkpoint goes across
+        k3 = hk.create(b"three")
+        hk.create(b"one") # already there: not journaled
+        hk.delete(k2)
+        k4, k5 = hk.create_many([b"four", b"five"])
+        hk.delete(k5)
+        again = export_since(j, pile, backup, result.checkpoint)
+        assert again.copied == [k3, k4]
+        assert again.deleted == [k2, k5]
+        assert export_since(j, pile, backup, again.checkpoint).copied == []
+    assert FHK_CRD(backup).read(k3) == b"three"
+
+def test_create_many_journals_new_only(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    os.mkdir(pile)
+    with Journal(os.path.join(tmpdirname, "journal")) as j:
+        hk = FHK_CRD(pile, journal=j)
+        a, b = hk.create_many([b"a", b"b"])
+        st = os.stat(hk._path_from_key(a))
+        assert hk.create_many([b"a", b"b", b"b"]) == [a, b, b]
+        assert [(r.op, r.key) for r in j.records()] == [(ADD, a), (ADD, b)]
+        # left alone, not renamed over
+        assert os.stat(hk._path_from_key(a)).st_ino == st.st_ino
+
+def test_lj_journal(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    tree = Path(tmpdirname) / "tree"
+    os.mkdir(pile)
+    tree.mkdir()
+    (tree / "a").write_text("foo")
+    (tree / "b").write_text("foo")
+    with Journal(os.path.join(tmpdirname, "journal")) as j:
+        lj = LJ(pile, journal=j)
+        lj.assimilate_tree(tree)
+        assert [r.op for r in j.records()] == [ADD, LINK]
+        # nothing changes the second time
+        lj.assimilate_tree(tree)
+        assert j.seq == 2
+
+def test_lj_export_since_with_duplicate(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    backup = os.path.join(tmpdirname, "backup")
+    tree = Path(tmpdirname) / "tree"
+    os.mkdir(pile)
+    tree.mkdir()
+    (tree / "a").write_text("foo")
+    (tree / "b").write_text("foo")
+    (tree / "c").write_text("bar")
+    with Journal(os.path.join(tmpdirname, "journal")) as j:
+        lj = LJ(pile, journal=j)
+        lj.assimilate_tree(tree)
+        result = export_since(j, pile, backup)
+    assert len(result.copied) == 2
+    assert result.deleted == []
+    assert sorted(e.name for e in scan_pile(backup)) == sorted(e.name for e in scan_pile(pile))
@@ -0,0 +1,83 @@
+import pytest
+
+import os
+import threading
+
+from pathlib import Path
+
+from hkfs import FHK_CRD, KeyFilter
+from lj import LJ
+
+
+def test_membership():
+    kf = KeyFilter(capacity=1000, fp_rate=0.01)
+    keys = [os.urandom(32) for _ in range(1000)]
+    kf.update(keys)
+    assert all(key in kf for key in keys)
+    others = [os.urandom(32) for _ in range(10000)]
+    assert sum(key in kf for key in others) < 300
+    kf.add(b"short")
+    assert b"short" in kf
+
+def test_threaded_adds():
+    kf = KeyFilter(capacity=100000)
+    keys = [os.urandom(32) for _ in range(40000)]
+    threads = [threading.Thread(target=kf.update, args=(keys[i::8],)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert kf.count == len(keys)
+    assert all(k in kf for k in keys)
+
+def test_save_load(tmpdirname):
+    kf = KeyFilter(capacity=100)
+    kf.add(b"k" * 32)
+    path = os.path.join(tmpdirname, "keys.bf")
+    kf.save(path)
+    loaded = KeyFilter.load(path, authoritative=True)
+    assert b"k" * 32 in loaded
+    assert loaded.count == 1 and loaded.authoritative
+    with open(path, 'r+b') as f:
+        f.truncate(40)
+    with pytest.raises(ValueError):
+        KeyFilter.load(path)
+
+def test_from_pile(tmpdirname):
+    hk = FHK_CRD(tmpdirname, pack_threshold=4)
+    keys = [hk.create(b"big one"), hk.create(b"sm")]
+    kf = KeyFilter.from_pile(tmpdirname)
+    assert all(key in kf for key in keys)
+
+def test_fhk_authoritative(tmpdirname):
+    kf = KeyFilter(capacity=100, authoritative=True)
+    hk = FHK_CRD(tmpdirname, key_filter=kf)
+    k = hk.create(b"foo")
+    k2, = hk.create_many([b"bar"])
+    assert k in kf and k2 in kf
+    assert hk.exists(k)
+    # an authoritative "no" isn't checked on disk
+    other = FHK_CRD(tmpdirname)
+    k3 = other.create(b"baz")
+    assert not hk.exists(k3)
+    assert hk.exists_many([k, k2, k3]) == [True, True, False]
+    kf.authoritative = False
+    assert hk.exists(k3)
+    assert hk.exists_many([k, k2, k3]) == [True, True, True]
+
+def test_lj_stale_filter(tmpdirname):
+    # Another writer adds a key the filter doesn't know; ingest still links
+    pile = os.path.join(tmpdirname, "pile")
+    os.mkdir(pile)
+    tree = Path(tmpdirname) / "tree"
+    tree.mkdir()
+    (tree / "a").write_text("foo")
+    (tree / "b").write_text("foo")
+    kf = KeyFilter(capacity=100)
+    lj = LJ(pile, key_filter=kf)
+    with open(tree / "a", 'rb') as f:
+        assert LJ(pile).assimilate(f) == "added"
+    with open(tree / "b", 'rb') as f:
+        assert lj.assimilate(f) == "linked"
+    assert os.stat(tree / "a").st_ino == os.stat(tree / "b").st_ino
+    assert lj.exists(lj.key_from_path(tree / "a"))
@@ -0,0 +1,88 @@
+import os
+
+from pathlib import Path
+
+from hkfs import MerkleIndex
+from lj import LJ
+
+from .test_inode_index import make_tree
+
+
+subtree = {"x/t.1": "foo", "x/t.2": "bar", "x/y/t.3": "baz"}
+
+def make_archive(root):
+    tree = {}
+    for top in ("a", "b/c", "d"):
+        tree.update({f"{top}/{k}": v for k, v in subtree.items()})
+    tree["d/x/y/t.4"] = "extra"
+    tree["e.txt"] = "foo"
+    make_tree(root, tree)
+
+def test_duplicate_subtrees(tmpdirname):
+    root = os.path.join(tmpdirname, "archive")
+    make_archive(root)
+    mi = MerkleIndex(LJ(tmpdirname), os.path.join(tmpdirname, "merkle.db"))
+    mi.update(root)
+    dups = {tuple(paths): nbytes for key, nbytes, paths in mi.duplicates()}
+    j = lambda p: os.path.join(root, p)
+    assert dups == {
+        (j("a"), j("b/c")): 9,
+        (j("a/x"), j("b/c/x")): 9,
+        (j("a/x/y"), j("b/c/x/y")): 3,
+    }
+    # names matter, not just contents
+    assert mi.key(j("a/x")) != mi.key(j("d/x"))
+
+def test_only_dirty_paths_recomputed(tmpdirname):
+    root = os.path.join(tmpdirname, "archive")
+    make_archive(root)
+    mi = MerkleIndex(LJ(tmpdirname), os.path.join(tmpdirname, "merkle.db"))
+    k0 = mi.update(root)
+    assert mi.recomputed == 11
+    assert mi.update(root) == k0
+    assert mi.recomputed == 0
+
+    Path(root, "d/x/y/t.4").unlink()
+    mi.mark_dirty(os.path.join(root, "d/x/y/t.4"))
+    k1 = mi.update(root)
+    assert k1 != k0
+    # d/x/y, d/x, d and the root
+    assert mi.recomputed == 4
+    assert len([p for _, _, p in mi.duplicates()][0]) == 3
+
+def test_file_in_new_subdirectory(tmpdirname):
+    root = os.path.join(tmpdirname, "archive")
+    make_archive(root)
+    mi = MerkleIndex(LJ(tmpdirname), os.path.join(tmpdirname, "merkle.db"))
+    k0 = mi.update(root)
+    make_tree(root, {"a/new/y": "fresh"})
+    mi.mark_dirty(os.path.join(root, "a/new/y"))
+    k1 = mi.update(root)
+    assert k1 != k0
+    # a, the root, and the new directory
+    assert mi.recomputed == 3
+    fresh = MerkleIndex(LJ(tmpdirname), os.path.join(tmpdirname, "fresh.db"))
+    assert fresh.update(root) == k1
+
+def test_detect_changes(tmpdirname):
+    root = os.path.join(tmpdirname, "archive")
+    make_archive(root)
+    mi = MerkleIndex(LJ(tmpdirname), os.path.join(tmpdirname, "merkle.db"))
+    k0 = mi.update(root)
+    Path(root, "b/c/x/y/t.5").write_text("new")
+    assert mi.update(root) == k0
+    k1 = mi.update(root, detect_changes=True)
+    assert k1 != k0
+    assert mi.recomputed == 5
+    assert mi.update(root, force=True) == k1
+
+def test_removed_subtree_forgotten(tmpdirname):
+    root = os.path.join(tmpdirname, "archive")
+    make_archive(root)
+    mi = MerkleIndex(LJ(tmpdirname), os.path.join(tmpdirname, "merkle.db"))
+    mi.update(root)
+    os.rename(os.path.join(root, "b"), os.path.join(tmpdirname, "b"))
+    mi.mark_dirty(os.path.join(root, "b"))
+    mi.update(root)
+    assert mi.key(os.path.join(root, "b/c/x")) is None
+    assert list(mi.duplicates()) == []
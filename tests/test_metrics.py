@@ -0,0 +1,95 @@
+import pytest
+
+import io
+import os
+
+from hkfs import FHK_CRD, Metrics, NULL_METRICS, ProgressSink, StatsSink
+from hkfs.metrics import Histogram
+from lj import LJ
+
+from .test_inode_index import make_tree
+
+
+def test_histogram():
+    h = Histogram()
+    for ns in (1000, 2000, 3000, 1000000):
+        h.add(ns)
+    s = h.summary()
+    assert s['count'] == 4
+    assert s['max_s'] == pytest.approx(1e-3)
+    assert h.quantile(0.5) <= 2048e-9
+    assert h.quantile(1.0) == pytest.approx(1e-3)
+
+def test_null_metrics():
+    with NULL_METRICS.phase('hash'):
+        pass
+    NULL_METRICS.count('files')
+    NULL_METRICS.tick()
+    assert NULL_METRICS.snapshot()['counters'] == {}
+
+def test_lj_tree_metrics(tmpdirname):
+    tree = os.path.join(tmpdirname, "tree")
+    make_tree(tree, {"a": "foo", "b": "foo", "d/c": "bar, baz"})
+    sink = StatsSink()
+    metrics = Metrics(sinks=[sink], interval=0)
+    lj = LJ(os.path.join(tmpdirname, "pile"), metrics=metrics)
+    os.mkdir(lj.d)
+    lj.assimilate_tree(tree)
+    c = sink.last['counters']
+    assert c['files'] == 3
+    assert c['added'] == 2
+    assert c['linked'] == 1
+    assert c['bytes_hashed'] == 3 + 3 + 8
+    phases = sink.last['phases']
+    for name in ('walk', 'stat', 'hash', 'lstat', 'link', 'mkdir'):
+        assert phases[name]['count'] > 0
+    assert phases['stat']['count'] == 3
+
+def test_fhk_metrics(tmpdirname):
+    metrics = Metrics()
+    hk = FHK_CRD(tmpdirname, metrics=metrics)
+    k = hk.create(b"foo")
+    hk.create(b"foo")
+    assert hk.exists(k)
+    assert hk.read(k, 1) == b"oo"
+    hk.delete(k)
+    s = metrics.snapshot()
+    assert s['counters'] == {'bytes_hashed': 6, 'bytes_written': 6, 'created': 1, 'existed': 1,
+                             'bytes_read': 2}
+    assert {'hash', 'write', 'link', 'unlink', 'exists', 'read', 'delete'} <= set(s['phases'])
+
+def test_fhk_sink_and_batches(tmpdirname):
+    sink = StatsSink()
+    metrics = Metrics(sinks=[sink], interval=0)
+    hk = FHK_CRD(tmpdirname, metrics=metrics)
+    k = hk.create(b"foo")
+    # each operation gives the sinks a look
+    assert sink.last['counters']['created'] == 1
+    keys = hk.create_many([b"one", b"three"])
+    assert hk.exists_many(keys) == [True, True]
+    assert hk.read_many(keys) == [b"one", b"three"]
+    hk.delete_many(keys + [k])
+    c = sink.last['counters']
+    assert c['created'] == 3
+    assert c['bytes_hashed'] == 3 + 3 + 5
+    assert c['bytes_read'] == 8
+    phases = sink.last['phases']
+    for name in ('create_many', 'exists_many', 'read_many', 'delete_many'):
+        assert phases[name]['count'] == 1
+
+def test_progress_sink():
+    out = io.StringIO()
+    metrics = Metrics(sinks=[ProgressSink(out)], interval=3600)
+    metrics.count('files', 10)
+    metrics.count('added', 7)
+    metrics.count('bytes_hashed', 2 * 10**9)
+    with metrics.phase('hash'):
+        pass
+    metrics.tick() # too soon
+    assert out.getvalue() == ""
+    metrics.emit()
+    line = out.getvalue()
+    assert "files 10" in line
+    assert "added 7" in line
+    assert "hashed 2.0 GB" in line
+    assert "time in hash" in line
@@ -0,0 +1,43 @@
+import os
+
+from hkfs import find_orphans, sweep_orphans
+from lj import LJ
+
+from .test_inode_index import make_tree
+
+
+def make_archive(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    src = os.path.join(tmpdirname, "src")
+    os.mkdir(pile)
+    make_tree(src, {"t.1": "foo", "t.2": "barbar", "a/t.3": "foo", "a/t.4": "bazbazbaz"})
+    lj = LJ(pile)
+    lj.assimilate_tree(src)
+    return lj, pile, src
+
+def test_find(tmpdirname):
+    lj, pile, src = make_archive(tmpdirname)
+    assert find_orphans(pile).count == 0
+    os.remove(os.path.join(src, "t.2"))
+    os.remove(os.path.join(src, "a/t.4"))
+    os.remove(os.path.join(src, "t.1")) # a/t.3 still has it
+    report = find_orphans(pile, workers=2)
+    assert report.files == 3
+    assert report.count == 2
+    assert report.bytes == 6 + 9
+    assert sorted(o.path for o in report.orphans) == sorted(
+        str(lj._path_from_key(lj.h(c).digest())) for c in (b"barbar", b"bazbazbaz"))
+
+def test_sweep(tmpdirname):
+    lj, pile, src = make_archive(tmpdirname)
+    os.remove(os.path.join(src, "t.2"))
+    # too recent
+    assert sweep_orphans(pile, grace_seconds=3600, dry_run=False).removed == []
+    report = sweep_orphans(pile, grace_seconds=0)
+    assert report.removed_bytes == 6
+    assert find_orphans(pile).count == 1 # dry run removed nothing
+    report = sweep_orphans(pile, grace_seconds=0, dry_run=False)
+    assert len(report.removed) == 1
+    assert not lj.exists(lj.h(b"barbar").digest())
+    assert find_orphans(pile).count == 0
+    assert lj.exists(lj.h(b"foo").digest())
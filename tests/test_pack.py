@@ -0,0 +1,106 @@
+import pytest
+
+import io
+import os
+
+from hkfs import FHK_CRD, Journal, Verifier, export_since
+from hkfs.pack import PackStore
+from hkfs.pile import scan_pile
+
+
+def test_put_get_delete(tmpdirname):
+    pack = PackStore(tmpdirname)
+    assert pack.put(b"k1" * 16, b"foo bar")
+    assert not pack.put(b"k1" * 16, b"foo bar")
+    assert pack.put_many([(b"k2" * 16, b"baz"), (b"k1" * 16, b"foo bar")]) == [b"k2" * 16]
+    assert pack.get(b"k1" * 16) == b"foo bar"
+    assert pack.get(b"k1" * 16, 4, 2) == b"ba"
+    assert pack.get(b"k1" * 16, 10) == b""
+    buf = bytearray(5)
+    assert pack.read_into(b"k1" * 16, buf, 2) == 5
+    assert buf == b"o bar"
+    assert len(pack) == 2
+    assert pack.delete(b"k1" * 16)
+    assert not pack.delete(b"k1" * 16)
+    with pytest.raises(KeyError):
+        pack.get(b"k1" * 16)
+    pack.close()
+    # the index is on disk
+    pack = PackStore(tmpdirname)
+    assert pack.keys() == [b"k2" * 16]
+    assert pack.get(b"k2" * 16) == b"baz"
+
+def test_segments_and_compact(tmpdirname):
+    pack = PackStore(tmpdirname, segment_bytes=1000)
+    keys = [bytes([i]) * 32 for i in range(40)]
+    for key in keys:
+        pack.put(key, key * 3)
+    segments = [n for n in os.listdir(tmpdirname) if n.endswith('.pack')]
+    assert len(segments) > 3
+    for key in keys[:30]:
+        pack.delete(key)
+    assert pack.compact() > 0
+    assert len([n for n in os.listdir(tmpdirname) if n.endswith('.pack')]) < len(segments)
+    for key in keys[30:]:
+        assert pack.get(key) == key * 3
+    assert pack.compact() == 0
+
+def test_fhk_packed(tmpdirname):
+    hk = FHK_CRD(tmpdirname, pack_threshold=64)
+    small = hk.create(b"small")
+    big = hk.create(b"b" * 100)
+    streamed = hk.create_from_file(io.BytesIO(b"streamed"))
+    assert len(hk.pack) == 2
+    # only the big one has a file of its own
+    assert [e.name for e in scan_pile(tmpdirname)] == [hk._encode_key(big)]
+    assert hk.exists(small) and hk.exists(streamed)
+    assert hk.read(small, 1, 3) == b"mal"
+    buf = bytearray(8)
+    assert hk.read_into(streamed, buf) == 8 and buf == b"streamed"
+    with hk.view(small, 2) as v:
+        assert v == b"all"
+    assert hk.read_many([big, small]) == [b"b" * 100, b"small"]
+    assert hk.exists_many([small, big, b"x" * 32]) == [True, True, False]
+    hk.delete(small)
+    assert not hk.exists(small)
+    with pytest.raises(FileNotFoundError):
+        hk.read(small)
+    keys = hk.create_many([b"one", b"c" * 100])
+    assert hk.read_many(keys) == [b"one", b"c" * 100]
+    hk.delete_many(keys + [streamed])
+    assert hk.exists_many(keys + [streamed]) == [False] * 3
+    hk.close()
+
+def test_export_and_verify_packed(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    backup = os.path.join(tmpdirname, "backup")
+    os.mkdir(pile)
+    with Journal(os.path.join(tmpdirname, "journal")) as j:
+        hk = FHK_CRD(pile, pack_threshold=64, journal=j)
+        small = hk.create(b"small")
+        big = hk.create(b"b" * 100)
+        result = export_since(j, pile, backup)
+    assert set(result.copied) == {small, big}
+    assert FHK_CRD(backup).read(small) == b"small"
+    v = Verifier(hk, os.path.join(tmpdirname, "state"))
+    assert v.run() == {'dirs': 2, 'files': 2, 'bytes': 105, 'problems': 0}
+    # a packed object whose contents don't match its key
+    hk.pack.put(hk.key(b"right"), b"wrong")
+    v.reset()
+    summary = v.run()
+    assert summary['problems'] == 1
+
+def test_delete_every_form(tmpdirname):
+    hk = FHK_CRD(tmpdirname)
+    k = hk.create(b"small")
+    j = hk.create(b"tiny")
+    # the threshold set later: a second, packed copy
+    hk = FHK_CRD(tmpdirname, pack_threshold=4096)
+    assert hk.create(b"small") == k
+    assert hk.create(b"tiny") == j
+    hk.delete(k)
+    assert not hk.exists(k)
+    hk.delete_many([j])
+    assert not hk.exists(j)
+    with pytest.raises(FileNotFoundError):
+        hk.delete(k)
@@ -0,0 +1,198 @@
+import pytest
+
+import asyncio
+import os
+import subprocess
+import sys
+
+from hkfs import FHK_CRD, PileServer, recompress
+from hkfs.pile import encode_key
+from hkfs.server import FilePool, Unsatisfiable, parse_range
+
+
+async def request(reader, writer, target, method='GET', headers=()):
+    lines = [f"{method} {target} HTTP/1.1", "Host: localhost"]
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    got = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        got[name.lower()] = value.strip()
+    length = 0 if method == 'HEAD' else int(got['content-length'])
+    return status, got, await reader.readexactly(length)
+
+def get(path, target, **kwargs):
+    async def go():
+        reader, writer = await asyncio.open_unix_connection(path)
+        try:
+            return await request(reader, writer, target, **kwargs)
+        finally:
+            writer.close()
+    return go()
+
+def run_with_server(store, test, tcp=False):
+    async def go():
+        server = PileServer(store, max_open=4)
+        if tcp:
+            where = (await server.start_tcp()).sockets[0].getsockname()[1]
+        else:
+            where = os.path.join(store.d, 'sock')
+            await server.start_unix(where)
+        try:
+            return await test(server, where)
+        finally:
+            await server.close()
+    return asyncio.run(go())
+
+
+def test_parse_range():
+    assert parse_range('bytes=0-9', 100) == (0, 10)
+    assert parse_range('bytes=90-', 100) == (90, 100)
+    assert parse_range('bytes=-10', 100) == (90, 100)
+    assert parse_range('bytes=-500', 100) == (0, 100)
+    assert parse_range('bytes=50-500', 100) == (50, 100)
+    assert parse_range('bytes=0-1,5-6', 100) is None
+    assert parse_range('items=0-1', 100) is None
+    assert parse_range('bytes=9-5', 100) is None
+    assert parse_range('bytes=x-5', 100) is None
+    with pytest.raises(Unsatisfiable):
+        parse_range('bytes=100-', 100)
+    with pytest.raises(Unsatisfiable):
+        parse_range('bytes=-0', 100)
+
+def test_get_and_ranges(tmpdirname):
+    hk = FHK_CRD(tmpdirname)
+    data = os.urandom(100000)
+    key = hk.create(data)
+    target = '/' + encode_key(key)
+    async def test(server, path):
+        status, headers, body = await get(path, target)
+        assert (status, body) == (200, data)
+        assert headers['etag'] == f'"{encode_key(key)}"'
+        status, headers, body = await get(path, target, headers=[('Range', 'bytes=10-19')])
+        assert (status, body) == (206, data[10:20])
+        assert headers['content-range'] == 'bytes 10-19/100000'
+        status, _, body = await get(path, target, headers=[('Range', 'bytes=-7')])
+        assert (status, body) == (206, data[-7:])
+        status, headers, body = await get(path, target, headers=[('Range', 'bytes=100000-')])
+        assert (status, body) == (416, b'')
+        assert headers['content-range'] == 'bytes */100000'
+        status, headers, body = await get(path, target, method='HEAD')
+        assert (status, headers['content-length'], body) == (200, '100000', b'')
+        assert server.bytes_sent == 100000 + 10 + 7
+    run_with_server(hk, test)
+
+def test_not_found_and_bad_requests(tmpdirname):
+    hk = FHK_CRD(tmpdirname)
+    key = hk.create(b"here")
+    async def test(server, path):
+        assert (await get(path, '/' + encode_key(hk.key(b"not here"))))[0] == 404
+        assert (await get(path, '/a'))[0] == 404
+        assert (await get(path, '/' + encode_key(key), method='POST'))[0] == 405
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(b"nonsense\r\n\r\n")
+        assert (await reader.readline()).startswith(b"HTTP/1.1 400")
+        writer.close()
+    run_with_server(hk, test)
+
+def test_keep_alive(tmpdirname):
+    hk = FHK_CRD(tmpdirname)
+    datas = [f"This is the {i}th string".encode('utf8') for i in range(10)]
+    keys = [hk.create(d) for d in datas]
+    async def test(server, path):
+        reader, writer = await asyncio.open_unix_connection(path)
+        for k, d in zip(keys, datas):
+            status, _, body = await request(reader, writer, '/' + encode_key(k))
+            assert (status, body) == (200, d)
+        status, headers, _ = await request(reader, writer, '/' + encode_key(keys[0]),
+                                           headers=[('Connection', 'close')])
+        assert headers['connection'] == 'close'
+        assert await reader.read() == b''
+        writer.close()
+    run_with_server(hk, test)
+
+def test_many_concurrent_clients_tcp(tmpdirname):
+    hk = FHK_CRD(tmpdirname)
+    datas = [os.urandom(1000 + i * 517) for i in range(40)]
+    keys = [hk.create(d) for d in datas]
+    async def test(server, port):
+        async def one(k):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                return (await request(reader, writer, '/' + encode_key(k)))[2]
+            finally:
+                writer.close()
+        assert await asyncio.gather(*(one(k) for k in keys * 5)) == datas * 5
+        # the pool stayed bounded
+        assert len(server.files._files) <= 4
+    run_with_server(hk, test, tcp=True)
+
+def test_packed_and_compressed(tmpdirname):
+    hk = FHK_CRD(tmpdirname, pack_threshold=1024)
+    small = b"small and packed"
+    small_key = hk.create(small)
+    big = b"compressible " * 10000
+    big_key = hk.create(big)
+    recompress(tmpdirname, min_idle_seconds=-60)
+    assert os.path.exists(str(hk._path_from_key(big_key)) + '.z')
+    async def test(server, path):
+        assert (await get(path, '/' + encode_key(small_key)))[2] == small
+        status, _, body = await get(path, '/' + encode_key(small_key),
+                                    headers=[('Range', 'bytes=6-8')])
+        assert (status, body) == (206, small[6:9])
+        assert (await get(path, '/' + encode_key(big_key)))[2] == big
+        status, headers, body = await get(path, '/' + encode_key(big_key),
+                                          headers=[('Range', 'bytes=100000-')])
+        assert (status, body) == (206, big[100000:])
+        assert headers['content-range'] == f'bytes 100000-{len(big) - 1}/{len(big)}'
+    run_with_server(hk, test)
+
+def test_deleted_while_pooled(tmpdirname):
+    hk = FHK_CRD(tmpdirname)
+    key = hk.create(b"fleeting")
+    async def test(server, path):
+        assert (await get(path, '/' + encode_key(key)))[0] == 200
+        hk.delete(key)
+        assert (await get(path, '/' + encode_key(key)))[0] == 404
+    run_with_server(hk, test)
+
+def test_file_pool(tmpdirname):
+    paths = []
+    for i in range(4):
+        paths.append(os.path.join(tmpdirname, str(i)))
+        with open(paths[-1], 'wb') as f:
+            f.write(b'x' * i)
+    pool = FilePool(max_open=2)
+    f0, size = pool.acquire(paths[0])
+    assert size == 0
+    assert pool.acquire(paths[0])[0] is f0
+    for p in paths[1:]:
+        pool.release(pool.acquire(p)[0])
+    # in use, so not closed though least recently used
+    assert not f0.closed
+    assert len(pool._files) == 2
+    pool.release(f0)
+    pool.release(f0)
+    os.remove(paths[3])
+    with pytest.raises(FileNotFoundError):
+        pool.acquire(paths[3])
+    pool.close()
+
+def test_main_serve(tmpdirname):
+    hk = FHK_CRD(tmpdirname)
+    key = hk.create(b"served by hkfs serve")
+    path = os.path.join(tmpdirname, 'sock')
+    p = subprocess.Popen([sys.executable, '-m', 'hkfs', 'serve', tmpdirname, '--socket', path],
+                         stdout=subprocess.PIPE)
+    try:
+        assert p.stdout.readline().startswith(b"serving")
+        status, _, body = asyncio.run(get(path, '/' + encode_key(key)))
+        assert (status, body) == (200, b"served by hkfs serve")
+    finally:
+        p.terminate()
+        p.wait()
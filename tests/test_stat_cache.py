@@ -0,0 +1,75 @@
+import os
+
+from pathlib import Path
+
+from hkfs import StatCache
+from lj import LJ
+
+from .test_inode_index import counting_key_from_file, make_tree
+
+
+def test_lookup_store(tmpdirname):
+    cache = StatCache(os.path.join(tmpdirname, "cache.db"))
+    p = Path(tmpdirname) / "t.1"
+    p.write_text("foo")
+    st = os.stat(p)
+    assert cache.lookup(p, st) is None
+    cache.store(p, st, b"k" * 32)
+    assert cache.lookup(p, st) == b"k" * 32
+    # any change to the signature drops the entry
+    p.write_text("foo, more")
+    assert cache.lookup(p, os.stat(p)) is None
+    assert len(cache) == 0
+
+def test_key_from_path_uses_cache(tmpdirname):
+    cache = StatCache(os.path.join(tmpdirname, "cache.db"))
+    lj = LJ(tmpdirname, stat_cache=cache)
+    hashed = counting_key_from_file(lj)
+    p = Path(tmpdirname) / "t.1"
+    p.write_text("foo")
+    k = lj.key_from_path(p)
+    assert lj.key_from_path(p) == k
+    assert len(hashed) == 1
+    p.write_text("bar")
+    assert lj.key_from_path(p) != k
+    assert len(hashed) == 2
+
+def test_paranoid_rehash_catches_mismatch(tmpdirname):
+    cache = StatCache(os.path.join(tmpdirname, "cache.db"), paranoia=1.0)
+    lj = LJ(tmpdirname, stat_cache=cache)
+    hashed = counting_key_from_file(lj)
+    p = Path(tmpdirname) / "t.1"
+    p.write_text("foo")
+    # a wrong key under the right signature
+    cache.store(p, os.stat(p), b"\0" * 32)
+    k = lj.key_from_path(p)
+    assert len(hashed) == 1
+    assert k != b"\0" * 32
+    assert cache.mismatches == [os.path.abspath(p)]
+
+def test_reingest_reads_nothing(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    src = os.path.join(tmpdirname, "src")
+    os.mkdir(pile)
+    make_tree(src, {"t.1": "foo", "t.2": "bar", "a/t.3": "baz"})
+    cache = StatCache(os.path.join(tmpdirname, "cache.db"))
+    lj = LJ(pile, stat_cache=cache)
+    hashed = counting_key_from_file(lj)
+    lj.assimilate_tree(src)
+    assert len(hashed) == 3
+    hashed.clear()
+    lj.assimilate_tree(src)
+    lj.assimilate_tree(src, workers=2)
+    assert hashed == []
+
+def test_prune(tmpdirname):
+    cache = StatCache(os.path.join(tmpdirname, "cache.db"))
+    make_tree(tmpdirname, {"t.1": "foo", "t.2": "bar", "a/t.3": "baz"})
+    for name in ("t.1", "t.2", "a/t.3"):
+        p = os.path.join(tmpdirname, name)
+        cache.store(p, os.stat(p), b"k" * 32)
+    os.remove(os.path.join(tmpdirname, "t.2"))
+    Path(tmpdirname, "a/t.3").write_text("changed")
+    assert cache.prune(os.path.join(tmpdirname, "a")) == 1
+    assert cache.prune() == 1
+    assert len(cache) == 1
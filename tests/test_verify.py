@@ -0,0 +1,68 @@
+import json
+import os
+import time
+
+from blake3 import blake3
+
+from hkfs import FHK_CRD, Verifier
+from lj import LJ
+
+
+def make_pile(directory, n=40):
+    os.mkdir(directory)
+    hk = FHK_CRD(directory, hasher=blake3)
+    return hk, [hk.create(f"This is the {i}th string".encode('utf8')) for i in range(n)]
+
+def read_report(v):
+    with open(v.report_path) as f:
+        return [json.loads(line) for line in f]
+
+def test_clean_pile(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    hk, keys = make_pile(pile)
+    # an LJ over the same pile uses the same hash and layout
+    v = Verifier(LJ(pile), os.path.join(tmpdirname, "state"), workers=3)
+    summary = v.run()
+    assert summary['files'] == 40
+    assert summary['problems'] == 0
+    assert read_report(v) == []
+
+def test_mismatch_and_misplaced(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    hk, keys = make_pile(pile)
+    bad = str(hk._path_from_key(keys[3]))
+    os.chmod(bad, 0o644)
+    with open(bad, 'ab') as f:
+        f.write(b" tampered")
+    moved = str(hk._path_from_key(keys[5]))
+    other_leaf = os.path.dirname(str(hk._path_from_key(keys[6])))
+    if os.path.dirname(moved) != other_leaf:
+        os.rename(moved, os.path.join(other_leaf, os.path.basename(moved)))
+    v = Verifier(hk, os.path.join(tmpdirname, "state"))
+    v.run()
+    problems = {p['problem']: p for p in read_report(v)}
+    assert problems['mismatch']['path'] == bad
+    assert problems['mismatch']['actual'] == hk._encode_key(blake3(b"This is the 3th string tampered").digest())
+    assert problems['misplaced']['path'].endswith(os.path.basename(moved))
+
+def test_resume(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    hk, keys = make_pile(pile)
+    state = os.path.join(tmpdirname, "state")
+    first = Verifier(hk, state).run(limit=10)
+    assert first['dirs'] == 10
+    # a new Verifier, as after a restart, picks up where that one stopped
+    rest = Verifier(hk, state).run()
+    assert first['files'] + rest['files'] == 40
+    assert Verifier(hk, state).run() == {'dirs': 0, 'files': 0, 'bytes': 0, 'problems': 0}
+
+def test_bandwidth_cap(tmpdirname):
+    pile = os.path.join(tmpdirname, "pile")
+    os.mkdir(pile)
+    hk = FHK_CRD(pile, hasher=blake3)
+    for i in range(6):
+        hk.create(os.urandom(10000))
+    v = Verifier(hk, os.path.join(tmpdirname, "state"), max_bytes_per_sec=100000)
+    t0 = time.monotonic()
+    assert v.run()['bytes'] == 60000
+    assert time.monotonic() - t0 >= 0.5